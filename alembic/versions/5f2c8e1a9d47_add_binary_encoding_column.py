@@ -0,0 +1,67 @@
+"""add binary encoding column
+
+Revision ID: 5f2c8e1a9d47
+Revises: 0b35c351f36e
+Create Date: 2026-10-18 12:04:31.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import base64
+
+
+revision = '5f2c8e1a9d47'
+down_revision = '0b35c351f36e'
+branch_labels = None
+depends_on = None
+
+batch_size = 1000
+
+memories = sa.table(
+    'memories',
+    sa.column('created_at', sa.BigInteger()),
+    sa.column('author_id', sa.BigInteger()),
+    sa.column('encoding', sa.String()),
+    sa.column('encoding_bin', sa.LargeBinary()),
+)
+
+key = (memories.c.created_at == sa.bindparam('_created_at')) & (memories.c.author_id == sa.bindparam('_author_id'))
+
+
+def upgrade():
+    op.add_column('memories', sa.Column('encoding_bin', sa.LargeBinary(), nullable=True))
+    op.alter_column('memories', 'encoding', existing_type=sa.String(), nullable=True)
+
+    # convert the ASCII85 text encodings to binary in batches
+    connection = op.get_bind()
+    while True:
+        rows = connection.execute(
+            sa.select(memories.c.created_at, memories.c.author_id, memories.c.encoding)
+            .where(memories.c.encoding_bin.is_(None), memories.c.encoding.isnot(None))
+            .limit(batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        connection.execute(
+            memories.update().where(key).values(encoding_bin=sa.bindparam('encoding_bin'), encoding=None),
+            [{'_created_at': row.created_at, '_author_id': row.author_id, 'encoding_bin': base64.a85decode(row.encoding)} for row in rows]
+        )
+
+
+def downgrade():
+    connection = op.get_bind()
+    while True:
+        rows = connection.execute(
+            sa.select(memories.c.created_at, memories.c.author_id, memories.c.encoding_bin)
+            .where(memories.c.encoding.is_(None), memories.c.encoding_bin.isnot(None))
+            .limit(batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        connection.execute(
+            memories.update().where(key).values(encoding=sa.bindparam('encoding')),
+            [{'_created_at': row.created_at, '_author_id': row.author_id, 'encoding': base64.a85encode(row.encoding_bin).decode()} for row in rows]
+        )
+
+    op.alter_column('memories', 'encoding', existing_type=sa.String(), nullable=False)
+    op.drop_column('memories', 'encoding_bin')
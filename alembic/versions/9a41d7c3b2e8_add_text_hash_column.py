@@ -0,0 +1,58 @@
+"""add text hash column
+
+Revision ID: 9a41d7c3b2e8
+Revises: 5f2c8e1a9d47
+Create Date: 2026-10-18 15:41:07.532918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import hashlib
+
+
+revision = '9a41d7c3b2e8'
+down_revision = '5f2c8e1a9d47'
+branch_labels = None
+depends_on = None
+
+batch_size = 1000
+
+memories = sa.table(
+    'memories',
+    sa.column('created_at', sa.BigInteger()),
+    sa.column('author_id', sa.BigInteger()),
+    sa.column('text', sa.String()),
+    sa.column('text_hash', sa.String(64)),
+)
+
+key = (memories.c.created_at == sa.bindparam('_created_at')) & (memories.c.author_id == sa.bindparam('_author_id'))
+
+
+def normalized_text_hash(text):
+    # kept in sync with shimeji.dedup.normalized_text_hash, migrations should not import the package
+    return hashlib.sha256(' '.join(text.lower().split()).encode('utf-8')).hexdigest()
+
+
+def upgrade():
+    op.add_column('memories', sa.Column('text_hash', sa.String(64), nullable=True))
+
+    connection = op.get_bind()
+    while True:
+        rows = connection.execute(
+            sa.select(memories.c.created_at, memories.c.author_id, memories.c.text)
+            .where(memories.c.text_hash.is_(None))
+            .limit(batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        connection.execute(
+            memories.update().where(key).values(text_hash=sa.bindparam('text_hash')),
+            [{'_created_at': row.created_at, '_author_id': row.author_id, 'text_hash': normalized_text_hash(row.text)} for row in rows]
+        )
+
+    op.create_index(op.f('ix_memories_text_hash'), 'memories', ['text_hash'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_memories_text_hash'), table_name='memories')
+    op.drop_column('memories', 'text_hash')
@@ -0,0 +1,27 @@
+"""add scope id column
+
+Revision ID: c3e7f9a2d6b1
+Revises: 9a41d7c3b2e8
+Create Date: 2026-10-18 17:12:44.381096
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = 'c3e7f9a2d6b1'
+down_revision = '9a41d7c3b2e8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('memories', sa.Column('scope_id', sa.BigInteger(), nullable=True))
+    op.create_index('ix_memories_scope_id_created_at', 'memories', ['scope_id', 'created_at'], unique=False)
+    op.create_index('ix_memories_scope_id_text_hash', 'memories', ['scope_id', 'text_hash'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_memories_scope_id_text_hash', table_name='memories')
+    op.drop_index('ix_memories_scope_id_created_at', table_name='memories')
+    op.drop_column('memories', 'scope_id')
@@ -0,0 +1,44 @@
+import asyncio
+import threading
+from typing import Callable, Dict
+from aiohttp import web
+
+HOST = '127.0.0.1'
+
+async def token(request):
+    return web.json_response({'access_token': 'token'})
+
+def serve(port: int, routes: Dict[str, Callable], **state) -> web.Application:
+    """
+    Start a mock Sukima server on a daemon thread with its own event loop, and wait until it accepts connections.
+
+    :param port: The port to listen on.
+    :type port: int
+    :param routes: The POST handlers by path, such as {'/api/v1/models/generate': generate}. The token endpoint is always served.
+    :type routes: Dict[str, Callable]
+    :param state: Values to store on the application, such as app['gpu'], created on the server's loop by calling them.
+    :return: The running application.
+    :rtype: web.Application
+    """
+    ready = threading.Event()
+    app = web.Application()
+
+    async def start():
+        for key, factory in state.items():
+            app[key] = factory()
+        app.router.add_post('/api/v1/users/token', token)
+        for path, handler in routes.items():
+            app.router.add_post(path, handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, HOST, port).start()
+        ready.set()
+
+    def run_forever():
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(start())
+        loop.run_forever()
+
+    threading.Thread(target=run_forever, daemon=True).start()
+    ready.wait()
+    return app
@@ -11,5 +11,13 @@ from .model_provider import *
 from .preprocessor import *
 from .postprocessor import *
 from .memory import *
+from .ann import *
+from .quantization import *
+from .scoring import *
+from .dedup import *
+from .cache import *
+from .batching import *
+from .background import *
+from .scheduler import *
 from .memorystore_provider import *
 from .util import *
\ No newline at end of file
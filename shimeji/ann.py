@@ -0,0 +1,352 @@
+from typing import List, Tuple
+import numpy as np
+import json
+
+from shimeji.memory import cosine_distances, cosine_similarity, top_k_indices
+
+def kmeans(data: np.array, k: int, iterations: int = 20, seed: int = 0) -> np.array:
+    """
+    Cluster vectors with k-means (Lloyd's algorithm, k-means++ initialization).
+
+    :param data: The vectors to cluster, of shape (N, d).
+    :type data: np.array
+    :param k: The number of clusters.
+    :type k: int
+    :param iterations: The number of iterations to run.
+    :type iterations: int
+    :param seed: The random seed.
+    :type seed: int
+    :return: The centroids, of shape (k, d).
+    :rtype: np.array
+    """
+    rng = np.random.default_rng(seed)
+    data = np.asarray(data, dtype=np.float32)
+    k = min(k, len(data))
+
+    centroids = np.empty((k, data.shape[1]), dtype=np.float32)
+    centroids[0] = data[rng.integers(len(data))]
+    closest = squared_distances(data, centroids[:1])[:, 0].astype(np.float64)
+    for i in range(1, k):
+        total = closest.sum()
+        if total <= 0:
+            centroids[i:] = data[rng.integers(len(data), size=k - i)]
+            break
+        centroids[i] = data[rng.choice(len(data), p=closest / total)]
+        closest = np.minimum(closest, squared_distances(data, centroids[i:i+1])[:, 0])
+
+    for _ in range(iterations):
+        assignments = np.argmin(squared_distances(data, centroids), axis=1)
+        counts = np.bincount(assignments, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, data)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+
+    return centroids
+
+def squared_distances(a: np.array, b: np.array) -> np.array:
+    """
+    Pairwise squared euclidean distances between the rows of two matrices.
+
+    :param a: A matrix of shape (N, d).
+    :type a: np.array
+    :param b: A matrix of shape (M, d).
+    :type b: np.array
+    :return: The distances, of shape (N, M).
+    :rtype: np.array
+    """
+    distances = np.sum(a * a, axis=1)[:, None] - 2 * (a @ b.T) + np.sum(b * b, axis=1)[None, :]
+    return np.maximum(distances, 0)
+
+def recall_at_k(exact: List[int], approximate: List[int]) -> float:
+    """
+    The fraction of the exact top-k results found by an approximate search.
+
+    :param exact: The ids returned by an exact search.
+    :type exact: List[int]
+    :param approximate: The ids returned by an approximate search.
+    :type approximate: List[int]
+    :rtype: float
+    """
+    if len(exact) == 0:
+        return 1.0
+    return len(set(exact) & set(approximate)) / len(exact)
+
+class IVFIndex:
+    """
+    An approximate nearest neighbour index which partitions vectors into inverted lists around k-means centroids.
+
+    A search only scores the vectors in the nprobe lists whose centroids are closest to the query, so nprobe trades
+    recall for latency. Until enough vectors have been added to train the centroids, the index searches exhaustively.
+    """
+
+    def __init__(self, nlist: int = 256, nprobe: int = 8, metric: str = 'distance', train_size: int = None, seed: int = 0):
+        """
+        Initialize an IVFIndex.
+
+        :param nlist: The number of inverted lists (k-means centroids).
+        :type nlist: int
+        :param nprobe: The number of lists to search, higher is slower but more accurate.
+        :type nprobe: int
+        :param metric: Either 'distance' for cosine_distance or 'similarity' for cosine similarity.
+        :type metric: str
+        :param train_size: The number of vectors to collect before the centroids are trained. Defaults to 39 * nlist.
+        :type train_size: int
+        :param seed: The random seed used for training.
+        :type seed: int
+        """
+        if metric not in ('distance', 'similarity'):
+            raise ValueError(f'Unknown metric: {metric}')
+
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.metric = metric
+        self.train_size = train_size if train_size is not None else 39 * nlist
+        self.seed = seed
+
+        self.dim = None
+        self.centroids = None
+        self.list_ids = []
+        self.list_vectors = []
+        self.list_sizes = []
+        # maps each id to its inverted list, or to -1 while it is pending, and to its row in that list
+        self.assignments = {}
+        self.positions = {}
+
+        # vectors added before the index is trained, in arrays which grow like the inverted lists
+        self.pending_ids = np.zeros(0, dtype=np.int64)
+        self.pending_vectors = np.zeros((0, 0), dtype=np.float32)
+        self.pending_size = 0
+
+    def __len__(self) -> int:
+        return len(self.assignments)
+
+    def __contains__(self, id: int) -> bool:
+        return int(id) in self.assignments
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def train(self, vectors: np.array = None):
+        """
+        Train the centroids and move every vector into its inverted list.
+
+        :param vectors: The vectors to train on. Defaults to the vectors in the index.
+        :type vectors: np.array
+        """
+        ids, stored = self._all()
+        if vectors is None:
+            vectors = stored
+        if len(vectors) == 0:
+            raise ValueError('Cannot train an IVFIndex without vectors')
+
+        self.dim = vectors.shape[1]
+        self.centroids = kmeans(vectors, self.nlist, seed=self.seed)
+        self.list_ids = [np.zeros(0, dtype=np.int64) for _ in range(len(self.centroids))]
+        self.list_vectors = [np.zeros((0, self.dim), dtype=np.float32) for _ in range(len(self.centroids))]
+        self.list_sizes = [0] * len(self.centroids)
+        self.assignments = {}
+        self.positions = {}
+        self.pending_ids = np.zeros(0, dtype=np.int64)
+        self.pending_vectors = np.zeros((0, 0), dtype=np.float32)
+        self.pending_size = 0
+        self._insert(ids, stored)
+
+    def add(self, ids: List[int], vectors: np.array):
+        """
+        Add vectors to the index. Once train_size vectors have been collected the index trains itself.
+
+        :param ids: The ids of the vectors.
+        :type ids: List[int]
+        :param vectors: The vectors, of shape (N, d).
+        :type vectors: np.array
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f'Vectors have {vectors.shape[1]} dimensions, but the index has {self.dim}')
+
+        if self.is_trained:
+            self._insert(ids, vectors)
+            return
+
+        size = self.pending_size
+        needed = size + len(ids)
+        self.pending_ids, self.pending_vectors = _reserve(self.pending_ids, self.pending_vectors, size, needed, self.dim)
+        self.pending_ids[size:needed] = ids
+        self.pending_vectors[size:needed] = vectors
+        self.pending_size = needed
+        for position, id in enumerate(ids.tolist(), size):
+            self.assignments[id] = -1
+            self.positions[id] = position
+        if self.pending_size >= self.train_size:
+            self.train()
+
+    def remove(self, ids: List[int]):
+        """
+        Remove vectors from the index.
+
+        :param ids: The ids of the vectors to remove.
+        :type ids: List[int]
+        """
+        for id in ids:
+            list_no = self.assignments.pop(int(id), None)
+            if list_no is None:
+                continue
+            idx = self.positions.pop(int(id))
+            if list_no == -1:
+                list_ids, list_vectors, size = self.pending_ids, self.pending_vectors, self.pending_size
+                self.pending_size = size - 1
+            else:
+                list_ids, list_vectors, size = self.list_ids[list_no], self.list_vectors[list_no], self.list_sizes[list_no]
+                self.list_sizes[list_no] = size - 1
+
+            # move the last vector of the list into the hole
+            if idx != size - 1:
+                list_ids[idx] = list_ids[size-1]
+                list_vectors[idx] = list_vectors[size-1]
+                self.positions[int(list_ids[idx])] = idx
+
+    def get(self, ids: List[int]) -> np.array:
+        """
+        Return the stored vectors of ids.
+
+        :param ids: The ids of the vectors.
+        :type ids: List[int]
+        :return: The vectors, of shape (N, d).
+        :rtype: np.array
+        """
+        vectors = np.empty((len(ids), self.dim or 0), dtype=np.float32)
+        for i, id in enumerate(ids):
+            list_no = self.assignments[int(id)]
+            list_vectors = self.pending_vectors if list_no == -1 else self.list_vectors[list_no]
+            vectors[i] = list_vectors[self.positions[int(id)]]
+        return vectors
+
+    def search(self, query: np.array, k: int, nprobe: int = None, exclude: List[int] = None) -> Tuple[np.array, np.array]:
+        """
+        Search for the vectors closest to a query.
+
+        :param query: The query vector.
+        :type query: np.array
+        :param k: The number of results to return.
+        :type k: int
+        :param nprobe: The number of lists to search. Defaults to the index's nprobe.
+        :type nprobe: int
+        :param exclude: Ids to leave out of the results.
+        :type exclude: List[int]
+        :return: The ids and scores of the results, best first.
+        :rtype: Tuple[np.array, np.array]
+        """
+        query = np.asarray(query, dtype=np.float32)
+        if self.is_trained:
+            coarse = squared_distances(query[None, :], self.centroids)[0]
+            probes = top_k_indices(coarse, nprobe if nprobe is not None else self.nprobe)
+            ids = np.concatenate([self.list_ids[p][:self.list_sizes[p]] for p in probes])
+            vectors = np.concatenate([self.list_vectors[p][:self.list_sizes[p]] for p in probes])
+        else:
+            ids, vectors = self._all()
+
+        if exclude is not None and len(exclude) > 0:
+            keep = ~np.isin(ids, np.asarray(exclude, dtype=np.int64))
+            ids, vectors = ids[keep], vectors[keep]
+        if len(ids) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        if self.metric == 'distance':
+            scores = cosine_distances(query, vectors)
+        else:
+            scores = cosine_similarity(query, vectors)
+
+        # order candidates by id so that ties are broken the same way regardless of list layout
+        order = np.argsort(ids, kind='stable')
+        ids, scores = ids[order], scores[order]
+        best = top_k_indices(scores, k, largest=(self.metric == 'similarity'))
+        return ids[best], scores[best]
+
+    def save(self, path: str):
+        """
+        Save the index to a .npz file.
+
+        :param path: The path to save to.
+        :type path: str
+        """
+        ids, vectors = self._all()
+        config = {
+            'nlist': self.nlist,
+            'nprobe': self.nprobe,
+            'metric': self.metric,
+            'train_size': self.train_size,
+            'seed': self.seed
+        }
+        np.savez(
+            path,
+            config=np.array(json.dumps(config)),
+            centroids=self.centroids if self.is_trained else np.zeros((0, 0), dtype=np.float32),
+            ids=ids,
+            vectors=vectors
+        )
+
+    @classmethod
+    def load(cls, path: str) -> 'IVFIndex':
+        """
+        Load an index saved with save().
+
+        :param path: The path to load from.
+        :type path: str
+        :rtype: IVFIndex
+        """
+        with np.load(path) as data:
+            index = cls(**json.loads(str(data['config'])))
+            ids, vectors = data['ids'], data['vectors']
+            centroids = data['centroids']
+            if centroids.size > 0:
+                index.dim = centroids.shape[1]
+                index.centroids = centroids
+                index.list_ids = [np.zeros(0, dtype=np.int64) for _ in range(len(index.centroids))]
+                index.list_vectors = [np.zeros((0, index.dim), dtype=np.float32) for _ in range(len(index.centroids))]
+                index.list_sizes = [0] * len(index.centroids)
+                index._insert(ids, vectors)
+            elif len(ids) > 0:
+                index.add(ids, vectors)
+        return index
+
+    def _all(self) -> Tuple[np.array, np.array]:
+        if not self.is_trained:
+            if self.pending_size == 0:
+                return np.zeros(0, dtype=np.int64), np.zeros((0, self.dim or 0), dtype=np.float32)
+            return self.pending_ids[:self.pending_size], self.pending_vectors[:self.pending_size]
+        ids = np.concatenate([self.list_ids[i][:size] for i, size in enumerate(self.list_sizes)])
+        vectors = np.concatenate([self.list_vectors[i][:size] for i, size in enumerate(self.list_sizes)])
+        return ids, vectors
+
+    def _insert(self, ids: np.array, vectors: np.array):
+        if len(ids) == 0:
+            return
+        assignments = np.argmin(squared_distances(vectors, self.centroids), axis=1)
+        for list_no in np.unique(assignments):
+            members = np.flatnonzero(assignments == list_no)
+            size = self.list_sizes[list_no]
+            needed = size + len(members)
+            self.list_ids[list_no], self.list_vectors[list_no] = _reserve(self.list_ids[list_no], self.list_vectors[list_no], size, needed, self.dim)
+            self.list_ids[list_no][size:needed] = ids[members]
+            self.list_vectors[list_no][size:needed] = vectors[members]
+            self.list_sizes[list_no] = needed
+            for position, id in enumerate(ids[members].tolist(), size):
+                self.assignments[id] = int(list_no)
+                self.positions[id] = position
+
+def _reserve(ids: np.array, vectors: np.array, size: int, needed: int, dim: int) -> Tuple[np.array, np.array]:
+    # grow a list's arrays, keeping its first size rows, so that they hold at least needed rows
+    if needed <= len(ids):
+        return ids, vectors
+    capacity = max(needed, 2 * len(ids), 16)
+    grown_ids = np.zeros(capacity, dtype=np.int64)
+    grown_vectors = np.zeros((capacity, dim), dtype=np.float32)
+    if size:
+        grown_ids[:size] = ids[:size]
+        grown_vectors[:size] = vectors[:size]
+    return grown_ids, grown_vectors
@@ -0,0 +1,60 @@
+from typing import Any, Awaitable
+import asyncio
+import threading
+
+class BackgroundLoop:
+    """
+    An event loop running forever on a daemon thread, so that synchronous code can run coroutines on it.
+
+    Everything the coroutines create, such as HTTP sessions, batches and prefetches, lives on the one loop, so
+    synchronous callers share them across calls the same way asynchronous callers do.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def _start(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self.loop is None or self.loop.is_closed():
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, name='shimeji-loop', daemon=True)
+                self.thread.start()
+            return self.loop
+
+    def run(self, coroutine: Awaitable) -> Any:
+        """
+        Run a coroutine on the background loop and block until it finishes.
+
+        :param coroutine: The coroutine to run.
+        :type coroutine: Awaitable
+        :return: The result of the coroutine.
+        :rtype: Any
+        :raises RuntimeError: If called from the background loop itself, which would deadlock.
+        """
+        if threading.current_thread() is self.thread:
+            coroutine.close()
+            raise RuntimeError('cannot block on the background loop from inside it, await the coroutine instead')
+        return asyncio.run_coroutine_threadsafe(coroutine, self._start()).result()
+
+    def close(self):
+        """
+        Stop the background loop and wait for its thread to exit. The loop is started again on the next run.
+        """
+        with self._lock:
+            if self.loop is None or self.loop.is_closed():
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+_shared_loop = BackgroundLoop()
+
+def background_loop() -> BackgroundLoop:
+    """
+    The BackgroundLoop shared by every ModelProvider that is not given its own.
+
+    :rtype: BackgroundLoop
+    """
+    return _shared_loop
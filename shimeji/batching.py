@@ -0,0 +1,187 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, List
+import asyncio
+import hashlib
+import json
+
+class MicroBatcher:
+    """
+    Collects concurrent requests and hands them to a handler in batches.
+
+    Requests are grouped by a key, such as the model and layer of a hidden states request. A group is sent once it
+    holds max_size requests or max_delay seconds after its first request arrived, whichever comes first, and every
+    caller receives the result at its own position in the batch.
+    """
+
+    def __init__(self, handler: Callable[[Hashable, List[Any]], Awaitable[List[Any]]], max_size: int = 32, max_delay: float = 0.005):
+        """
+        Initialize a MicroBatcher.
+
+        :param handler: A coroutine function taking a key and a list of items and returning a list of results in the same order.
+        :type handler: Callable[[Hashable, List[Any]], Awaitable[List[Any]]]
+        :param max_size: The largest number of items sent in one batch.
+        :type max_size: int
+        :param max_delay: The longest time in seconds an item waits for its batch to fill.
+        :type max_delay: float
+        """
+        self.handler = handler
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.pending = {}
+        self.timers = {}
+        self.tasks = set()
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, key: Hashable, item: Any) -> Any:
+        """
+        Add an item to the batch of its key and wait for its result.
+
+        :param key: The key of the batch, items with different keys are never sent together.
+        :type key: Hashable
+        :param item: The item.
+        :type item: Any
+        :return: The handler's result for the item.
+        :rtype: Any
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self.pending.setdefault(key, [])
+        batch.append((item, future))
+
+        if len(batch) >= self.max_size:
+            self._dispatch(key)
+        elif key not in self.timers:
+            self.timers[key] = loop.call_later(self.max_delay, self._dispatch, key)
+
+        return await future
+
+    def _dispatch(self, key: Hashable):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(key, None)
+        if not batch:
+            return
+
+        # keep a reference so the task is not garbage collected while it runs
+        task = asyncio.ensure_future(self._run(key, batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, key: Hashable, batch: list):
+        # callers which were cancelled while waiting are left out
+        batch = [(item, future) for item, future in batch if not future.done()]
+        if not batch:
+            return
+        self.batches += 1
+        self.items += len(batch)
+
+        try:
+            results = await self.handler(key, [item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def flush(self):
+        """
+        Send every waiting batch now and wait until all batches in flight have finished.
+        """
+        for key in list(self.pending):
+            self._dispatch(key)
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one call whose result every caller receives.
+
+    A caller that is cancelled stops waiting without cancelling the shared call, unless it was the last one waiting.
+    Results of calls marked as cacheable can be kept for a few seconds, so that identical calls arriving just after
+    one has finished are answered without making it again.
+    """
+
+    def __init__(self, ttl: float = 0.0, max_size: int = 1024):
+        """
+        Initialize a SingleFlight.
+
+        :param ttl: The number of seconds the result of a cacheable call is kept. If 0, results are not kept.
+        :type ttl: float
+        :param max_size: The number of results kept.
+        :type max_size: int
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.inflight = {}
+        self.results = OrderedDict()
+        self.calls = 0
+        self.coalesced = 0
+        self.hits = 0
+
+    @staticmethod
+    def key(payload: Any) -> str:
+        """
+        The key of a JSON payload, which does not depend on the order of its keys.
+
+        :param payload: The payload.
+        :type payload: Any
+        :rtype: str
+        """
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+    def _done(self, key: Hashable, cacheable: bool, task: asyncio.Task):
+        if self.inflight.get(key, (None,))[0] is task:
+            del self.inflight[key]
+        if not cacheable or self.ttl <= 0 or task.cancelled() or task.exception() is not None:
+            return
+        self.results[key] = (asyncio.get_running_loop().time() + self.ttl, task.result())
+        self.results.move_to_end(key)
+        while len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+
+    async def run(self, key: Hashable, call: Callable[[], Awaitable[Any]], cacheable: bool = False) -> Any:
+        """
+        Run a call, or wait for the call with the same key which is already running.
+
+        :param key: The key of the call.
+        :type key: Hashable
+        :param call: A coroutine function making the call.
+        :type call: Callable[[], Awaitable[Any]]
+        :param cacheable: Whether the result may be kept for the SingleFlight's ttl.
+        :type cacheable: bool
+        :return: The result of the call.
+        :rtype: Any
+        """
+        loop = asyncio.get_running_loop()
+        cached = self.results.get(key)
+        if cached is not None:
+            if cached[0] > loop.time():
+                self.hits += 1
+                return cached[1]
+            del self.results[key]
+
+        flight = self.inflight.get(key)
+        if flight is None:
+            task = asyncio.ensure_future(call())
+            # the task and the number of callers waiting for it
+            flight = self.inflight[key] = [task, 0]
+            task.add_done_callback(lambda task: self._done(key, cacheable, task))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+
+        flight[1] += 1
+        try:
+            return await asyncio.shield(flight[0])
+        except asyncio.CancelledError:
+            if flight[1] == 1:
+                flight[0].cancel()
+            raise
+        finally:
+            flight[1] -= 1
@@ -0,0 +1,151 @@
+from collections import OrderedDict
+from typing import List, Optional
+import numpy as np
+import sqlite3
+import threading
+
+from shimeji.dedup import text_hash
+
+class EmbeddingCache:
+    """
+    A content-addressed cache of hidden states, keyed by model, layer and the hash of the text.
+
+    Embeddings are kept as float32 in a bounded in-memory LRU tier. If a path is given they are also written to a
+    SQLite file, which is consulted on a memory miss and survives restarts. The file is shared by the threads using the
+    cache, such as the background loop of the synchronous API, and written once per batch of embeddings.
+    """
+
+    def __init__(self, max_size: int = 4096, path: str = None):
+        """
+        Initialize an EmbeddingCache.
+
+        :param max_size: The number of embeddings kept in memory.
+        :type max_size: int
+        :param path: The path of the SQLite file for the on-disk tier. If None, embeddings are only kept in memory.
+        :type path: str
+        """
+        self.max_size = max_size
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.db = None
+        self.lock = threading.Lock()
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)')
+            self.db.commit()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @staticmethod
+    def key(model: str, layer: int, text: str) -> str:
+        """
+        The cache key of a text's hidden states.
+
+        :param model: The model the hidden states are from.
+        :type model: str
+        :param layer: The layer the hidden states are from.
+        :type layer: int
+        :param text: The text.
+        :type text: str
+        :rtype: str
+        """
+        return f'{model}:{layer}:{text_hash(text)}'
+
+    def _remember(self, key: str, embedding: np.array):
+        # the caller holds the lock, as the LRU order is shared by the threads using the cache
+        self.entries[key] = embedding
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, model: str, layer: int, text: str) -> Optional[List[float]]:
+        """
+        Look up the hidden states of a text.
+
+        :param model: The model the hidden states are from.
+        :type model: str
+        :param layer: The layer the hidden states are from.
+        :type layer: int
+        :param text: The text.
+        :type text: str
+        :return: The hidden states, or None if they are not cached.
+        :rtype: List[float]
+        """
+        key = self.key(model, layer, text)
+        with self.lock:
+            embedding = self.entries.get(key)
+            if embedding is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            elif self.db is not None:
+                row = self.db.execute('SELECT embedding FROM embeddings WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    embedding = np.frombuffer(row[0], dtype=np.float32)
+                    self._remember(key, embedding)
+                    self.disk_hits += 1
+            if embedding is None:
+                self.misses += 1
+                return None
+        return embedding.tolist()
+
+    def put(self, model: str, layer: int, text: str, embedding: List[float]):
+        """
+        Store the hidden states of a text.
+
+        :param model: The model the hidden states are from.
+        :type model: str
+        :param layer: The layer the hidden states are from.
+        :type layer: int
+        :param text: The text.
+        :type text: str
+        :param embedding: The hidden states.
+        :type embedding: List[float]
+        """
+        self.put_many(model, layer, [text], [embedding])
+
+    def put_many(self, model: str, layer: int, texts: List[str], embeddings: List[List[float]]):
+        """
+        Store the hidden states of several texts, writing them to the on-disk tier in a single transaction.
+
+        :param model: The model the hidden states are from.
+        :type model: str
+        :param layer: The layer the hidden states are from.
+        :type layer: int
+        :param texts: The texts.
+        :type texts: List[str]
+        :param embeddings: The hidden states of each text.
+        :type embeddings: List[List[float]]
+        """
+        keys = [self.key(model, layer, text) for text in texts]
+        embeddings = [np.asarray(embedding, dtype=np.float32) for embedding in embeddings]
+        rows = [(key, embedding.tobytes()) for key, embedding in zip(keys, embeddings)]
+
+        with self.lock:
+            for key, embedding in zip(keys, embeddings):
+                self._remember(key, embedding)
+            if self.db is not None and rows:
+                self.db.executemany('INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)', rows)
+                self.db.commit()
+
+    def hit_rate(self) -> float:
+        """
+        The fraction of lookups answered from either tier.
+
+        :rtype: float
+        """
+        lookups = self.hits + self.disk_hits + self.misses
+        return (self.hits + self.disk_hits) / lookups if lookups else 0.0
+
+    def close(self):
+        """
+        Close the on-disk tier.
+        """
+        if self.db is not None:
+            with self.lock:
+                self.db.close()
+                self.db = None
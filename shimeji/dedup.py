@@ -0,0 +1,391 @@
+from collections import Counter
+from difflib import SequenceMatcher
+from typing import List, Optional, Set, Tuple
+import numpy as np
+import hashlib
+import heapq
+import zlib
+
+def text_hash(text: str) -> str:
+    """
+    Hash a text for exact duplicate detection.
+
+    :param text: The text to hash.
+    :type text: str
+    :return: The hex SHA-256 digest of the text.
+    :rtype: str
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize a text for duplicate detection by lowercasing it and collapsing whitespace.
+
+    :param text: The text to normalize.
+    :type text: str
+    :rtype: str
+    """
+    return ' '.join(text.lower().split())
+
+def normalized_text_hash(text: str) -> str:
+    """
+    Hash the normalized form of a text, so that texts differing only in case or whitespace share a hash.
+
+    :param text: The text to hash.
+    :type text: str
+    :rtype: str
+    """
+    return text_hash(normalize_text(text))
+
+def similar(a: str, b: str, ratio: float) -> bool:
+    """
+    Check whether the SequenceMatcher ratio of two texts exceeds a ratio, trying its cheap upper bounds first.
+
+    :param a: A text.
+    :type a: str
+    :param b: Another text.
+    :type b: str
+    :param ratio: The ratio to exceed.
+    :type ratio: float
+    :rtype: bool
+    """
+    matcher = SequenceMatcher(None, a, b)
+    return matcher.real_quick_ratio() > ratio and matcher.quick_ratio() > ratio and matcher.ratio() > ratio
+
+def shingles(text: str, size: int = 3) -> Set[str]:
+    """
+    Split text into its set of overlapping character n-grams.
+
+    :param text: The text to split.
+    :type text: str
+    :param size: The number of characters in each shingle.
+    :type size: int
+    :rtype: Set[str]
+    """
+    if len(text) <= size:
+        return {text}
+    return {text[i:i+size] for i in range(len(text) - size + 1)}
+
+class MinHashLSH:
+    """
+    A locality-sensitive hashing index over MinHash signatures of character shingles.
+
+    Texts whose shingle sets have a high Jaccard similarity share a bucket in at least one band with high probability,
+    so a query only has to look at a handful of buckets instead of every stored text. With the default 32 bands of 4
+    rows, texts with a Jaccard similarity of 0.5 become candidates about 87% of the time.
+    """
+
+    def __init__(self, num_perm: int = 128, bands: int = 32, shingle_size: int = 3, seed: int = 0):
+        """
+        Initialize a MinHashLSH.
+
+        :param num_perm: The number of hash functions in a signature.
+        :type num_perm: int
+        :param bands: The number of bands the signature is split into, which must divide num_perm. More bands find more candidates.
+        :type bands: int
+        :param shingle_size: The number of characters in each shingle.
+        :type shingle_size: int
+        :param seed: The random seed for the hash functions.
+        :type seed: int
+        """
+        if num_perm % bands != 0:
+            raise ValueError('bands must divide num_perm')
+
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+
+        rng = np.random.default_rng(seed)
+        # multiply-shift hashing, the multipliers must be odd
+        self.a = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.b = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = {}
+
+    def __len__(self) -> int:
+        return len(self.signatures)
+
+    def __contains__(self, key) -> bool:
+        return key in self.signatures
+
+    def signature(self, text: str) -> np.array:
+        """
+        Compute the MinHash signature of a text.
+
+        :param text: The text.
+        :type text: str
+        :rtype: np.array
+        """
+        hashes = np.array([zlib.crc32(shingle.encode('utf-8')) for shingle in shingles(text, self.shingle_size)], dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            return ((self.a[:, None] * hashes[None, :] + self.b[:, None]) >> np.uint64(32)).min(axis=1)
+
+    def _bands(self, signature: np.array) -> List[bytes]:
+        return [signature[i*self.rows:(i+1)*self.rows].tobytes() for i in range(self.bands)]
+
+    def add(self, key, text: str, signature: np.array = None):
+        """
+        Add a text to the index.
+
+        :param key: A hashable key identifying the text.
+        :param text: The text.
+        :type text: str
+        :param signature: The signature of the text if it was already computed.
+        :type signature: np.array
+        """
+        if key in self.signatures:
+            return
+        if signature is None:
+            signature = self.signature(text)
+        self.signatures[key] = signature
+        for bucket, band in zip(self.buckets, self._bands(signature)):
+            bucket.setdefault(band, set()).add(key)
+
+    def remove(self, key):
+        """
+        Remove a text from the index.
+
+        :param key: The key the text was added with.
+        """
+        signature = self.signatures.pop(key, None)
+        if signature is None:
+            return
+        for bucket, band in zip(self.buckets, self._bands(signature)):
+            keys = bucket[band]
+            keys.discard(key)
+            if not keys:
+                del bucket[band]
+
+    def query(self, text: str) -> set:
+        """
+        Return the keys of texts which share at least one band with a text.
+
+        :param text: The text.
+        :type text: str
+        :rtype: set
+        """
+        candidates = set()
+        for bucket, band in zip(self.buckets, self._bands(self.signature(text))):
+            candidates.update(bucket.get(band, ()))
+        return candidates
+
+    def top_candidates(self, text: str, limit: int, signature: np.array = None) -> list:
+        """
+        Return the keys of the texts sharing the most bands with a text, most shared bands first and then in key order.
+
+        The number of shared bands grows with the Jaccard similarity, so the near-duplicates of a text come first even
+        when common shingles put it in large buckets.
+
+        :param text: The text.
+        :type text: str
+        :param limit: The largest number of keys to return.
+        :type limit: int
+        :param signature: The signature of the text if it was already computed.
+        :type signature: np.array
+        :rtype: list
+        """
+        if signature is None:
+            signature = self.signature(text)
+        counts = Counter()
+        for bucket, band in zip(self.buckets, self._bands(signature)):
+            counts.update(bucket.get(band, ()))
+        return [key for key, _ in heapq.nsmallest(limit, counts.items(), key=lambda item: (-item[1], item[0]))]
+
+def short_text_lsh() -> MinHashLSH:
+    """
+    A MinHashLSH for texts of a few words, using 2 character shingles in 32 bands of 3 rows.
+
+    A one character edit changes up to three of the 3 character shingles of a text, which is most of them for a short
+    chat message, so the default MinHashLSH misses some of their near-duplicates. Shorter shingles in shorter bands keep
+    their Jaccard similarity high enough to share a band.
+
+    :rtype: MinHashLSH
+    """
+    return MinHashLSH(num_perm=96, bands=32, shingle_size=2)
+
+class DuplicateIndex:
+    """
+    A near-duplicate index over the texts of a MemoryStoreProvider's memories.
+
+    Exact matches, up to case and whitespace, are found with a dictionary of normalized text hashes and near-duplicates with a MinHashLSH, so only the few candidates it
+    returns are verified with SequenceMatcher. It is updated incrementally when memories are created or deleted through
+    the attached MemoryStoreProvider, and sync() catches up on memories written elsewhere.
+
+    Texts shorter than short_length are looked up in a second MinHashLSH made for short texts, see short_text_lsh(). At
+    most max_candidates candidates, the ones sharing the most bands, are verified, so a lookup takes about the same
+    time however many texts are stored. With the defaults, over 99% of the one character edits of both short chat
+    messages and longer texts are found at a duplicate_ratio of 0.8.
+    """
+
+    def __init__(self, memorystore=None, lsh: MinHashLSH = None, scope_id: int = None, short_lsh: MinHashLSH = None, short_length: int = 20, max_candidates: int = 32):
+        """
+        Initialize a DuplicateIndex.
+
+        :param memorystore: The memory store to index. The index attaches itself to it.
+        :type memorystore: MemoryStoreProvider
+        :param lsh: The MinHashLSH to use, defaults to MinHashLSH().
+        :type lsh: MinHashLSH
+        :param scope_id: Only index the memories of this scope. If None, memories from every scope are indexed.
+        :type scope_id: int
+        :param short_lsh: The MinHashLSH to look up short texts in, defaults to short_text_lsh(). It holds the texts shorter than twice short_length, which covers the near-duplicates of short texts at a duplicate_ratio of 2/3 and above.
+        :type short_lsh: MinHashLSH
+        :param short_length: Texts shorter than this many characters are looked up in short_lsh instead of lsh.
+        :type short_length: int
+        :param max_candidates: The largest number of candidates verified with SequenceMatcher per lookup.
+        :type max_candidates: int
+        """
+        self.memorystore = memorystore
+        self.lsh = lsh if lsh is not None else MinHashLSH()
+        self.short_lsh = short_lsh if short_lsh is not None else short_text_lsh()
+        self.scope_id = scope_id
+        self.short_length = short_length
+        self.max_candidates = max_candidates
+        self.texts = {}
+        self.exact = {}
+        self.last_created_at = 0
+
+        if memorystore is not None:
+            memorystore.attach_index(self)
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def add(self, memory):
+        """
+        Add a memory to the index.
+
+        :param memory: The memory to add.
+        :type memory: Memory
+        """
+        key = (memory.created_at, memory.author_id)
+        if key in self.texts or (self.scope_id is not None and memory.scope_id != self.scope_id):
+            return
+        self.texts[key] = memory.text
+        self.exact.setdefault(normalized_text_hash(memory.text), set()).add(key)
+        self.lsh.add(key, memory.text)
+        if len(memory.text) < 2 * self.short_length:
+            self.short_lsh.add(key, memory.text)
+        self.last_created_at = max(self.last_created_at, memory.created_at)
+
+    def remove(self, memory):
+        """
+        Remove a memory from the index.
+
+        :param memory: The memory to remove. It is matched by created_at and author_id.
+        :type memory: Memory
+        """
+        key = (memory.created_at, memory.author_id)
+        text = self.texts.pop(key, None)
+        if text is None:
+            return
+        digest = normalized_text_hash(text)
+        self.exact[digest].discard(key)
+        if not self.exact[digest]:
+            del self.exact[digest]
+        self.lsh.remove(key)
+        self.short_lsh.remove(key)
+
+    async def sync(self) -> int:
+        """
+        Catch up with the memory store by fetching only the memories created after the newest one in the index.
+
+        :return: The number of memories added.
+        :rtype: int
+        """
+        size = len(self)
+        async for batch in self.memorystore.stream(created_after=self.last_created_at, scope_id=self.scope_id):
+            for memory in batch:
+                self.add(memory)
+        return len(self) - size
+
+    def find(self, text: str, duplicate_ratio: Optional[float] = None) -> Optional[Tuple[int, int]]:
+        """
+        Find a memory whose text duplicates a text.
+
+        :param text: The text to look for.
+        :type text: str
+        :param duplicate_ratio: The SequenceMatcher ratio that must be exceeded for a text to count as a duplicate. If None, only exact matches, up to case and whitespace, count.
+        :type duplicate_ratio: float
+        :return: The (created_at, author_id) key of the duplicate, or None.
+        :rtype: Tuple[int, int]
+        """
+        digest = normalized_text_hash(text)
+        if digest in self.exact:
+            return min(self.exact[digest])
+        if duplicate_ratio is None:
+            return None
+
+        lsh = self.short_lsh if len(text) < self.short_length else self.lsh
+        for key in lsh.top_candidates(text, self.max_candidates):
+            if similar(self.texts[key], text, duplicate_ratio):
+                return key
+        return None
+
+    def is_duplicate(self, text: str, duplicate_ratio: Optional[float] = None) -> bool:
+        """
+        Check whether a text duplicates a memory in the index.
+
+        :param text: The text to look for.
+        :type text: str
+        :param duplicate_ratio: The SequenceMatcher ratio that must be exceeded for a text to count as a duplicate. If None, only exact matches count.
+        :type duplicate_ratio: float
+        :rtype: bool
+        """
+        return self.find(text, duplicate_ratio) is not None
+
+def deduplicate(memories: list, duplicate_ratio: Optional[float] = 0.8, lsh: MinHashLSH = None, short_lsh: MinHashLSH = None, short_length: int = 20, max_candidates: int = 32) -> list:
+    """
+    Remove duplicate memories, keeping the first memory of each group of duplicates.
+
+    Exact duplicates, up to case and whitespace, are collapsed by normalized text hash in one pass. The remaining memories are then clustered: each memory is
+    compared, through a MinHashLSH, only with the kept memories sharing the most bands with it, and joins the cluster of
+    the first one whose SequenceMatcher ratio exceeds duplicate_ratio. Memories shorter than short_length are looked up
+    in short_lsh, as in DuplicateIndex. Every memory costs at most max_candidates comparisons, and the result only
+    depends on the order of the input.
+
+    :param memories: The memories to deduplicate, usually in created_at order.
+    :type memories: List[Memory]
+    :param duplicate_ratio: The SequenceMatcher ratio that must be exceeded for memories to be near-duplicates. If None, only exact duplicates, up to case and whitespace, are removed.
+    :type duplicate_ratio: float
+    :param lsh: An empty MinHashLSH to cluster with, defaults to MinHashLSH().
+    :type lsh: MinHashLSH
+    :param short_lsh: An empty MinHashLSH to cluster short memories with, defaults to short_text_lsh().
+    :type short_lsh: MinHashLSH
+    :param short_length: Memories shorter than this many characters are looked up in short_lsh instead of lsh.
+    :type short_length: int
+    :param max_candidates: The largest number of kept memories each memory is compared with.
+    :type max_candidates: int
+    :rtype: List[Memory]
+    """
+    seen = set()
+    unique = []
+    for memory in memories:
+        digest = normalized_text_hash(memory.text)
+        if digest not in seen:
+            seen.add(digest)
+            unique.append(memory)
+
+    if duplicate_ratio is None:
+        return unique
+
+    lsh = lsh if lsh is not None else MinHashLSH()
+    short_lsh = short_lsh if short_lsh is not None else short_text_lsh()
+    kept = []
+    for memory in unique:
+        duplicate = False
+        short = len(memory.text) < short_length
+        index = short_lsh if short else lsh
+        signature = index.signature(memory.text)
+        for idx in index.top_candidates(memory.text, max_candidates, signature):
+            if similar(kept[idx].text, memory.text, duplicate_ratio):
+                duplicate = True
+                break
+        if not duplicate:
+            lsh.add(len(kept), memory.text, None if short else signature)
+            if len(memory.text) < 2 * short_length:
+                short_lsh.add(len(kept), memory.text, signature if short else None)
+            kept.append(memory)
+
+    return kept
@@ -1,10 +1,11 @@
-from typing import List
+from typing import Callable, List, Optional, Union
 import numpy as np
 import base64
 import random
 import copy
 
 from shimeji.memorystore_provider import Memory, MemoryStoreProvider
+from shimeji.util import count_line_tokens
 
 def numpybin_to_str(arr: np.array) -> str:
     return base64.a85encode(arr.tobytes()).decode()
@@ -15,12 +16,141 @@ def array_to_str(arr: list) -> str:
 def str_to_numpybin(string: str) -> np.array:
     return np.frombuffer(base64.a85decode(string), dtype=np.float32)
 
+def numpybin_to_bytes(arr: np.array) -> bytes:
+    return np.asarray(arr, dtype=np.float32).tobytes()
+
+def array_to_bytes(arr: list) -> bytes:
+    return np.array(arr, dtype=np.float32).tobytes()
+
+def encoding_to_bytes(encoding: Union[str, bytes]) -> bytes:
+    """
+    Return the raw float32 bytes of an encoding, which is either ASCII85 text or binary.
+
+    :param encoding: The encoding.
+    :type encoding: Union[str, bytes]
+    :rtype: bytes
+    """
+    if isinstance(encoding, str):
+        return base64.a85decode(encoding)
+    return encoding
+
+def decode_encoding(encoding: Union[str, bytes]) -> np.array:
+    """
+    Decode an encoding into a float32 vector. Binary encodings are wrapped with np.frombuffer without copying.
+
+    :param encoding: The encoding, either ASCII85 text or binary.
+    :type encoding: Union[str, bytes]
+    :rtype: np.array
+    """
+    if isinstance(encoding, str):
+        return str_to_numpybin(encoding)
+    return np.frombuffer(encoding, dtype=np.float32)
+
 def cosine_distance(a: np.array, b: np.array, factor=1000.0, epsilon=1e-6) -> float:
     return np.sum(np.sqrt((np.abs(b - a) / factor) + epsilon))
 
-def memory_sort(now: Memory, then: List[Memory], top_k: int = 256, cutoff_idx: int = 128, max_samples: int = 512) -> List[Memory]:
+def decode_encodings(encodings: List[Union[str, bytes]]) -> np.array:
+    """
+    Decode a list of encodings into a single contiguous (N, d) float32 matrix.
+
+    :param encodings: The encodings to decode, either ASCII85 text or binary.
+    :type encodings: List[Union[str, bytes]]
+    :return: The decoded encodings, one row per encoding.
+    :rtype: np.array
+    """
+    if not encodings:
+        return np.zeros((0, 0), dtype=np.float32)
+    buffer = b''.join(encoding_to_bytes(encoding) for encoding in encodings)
+    return np.frombuffer(buffer, dtype=np.float32).reshape(len(encodings), -1)
+
+def cosine_distances(a: np.array, b: np.array, factor=1000.0, epsilon=1e-6, chunk_size=1024) -> np.array:
+    """
+    Vectorized cosine_distance between a vector and every row of a matrix.
+
+    :param a: The query vector of shape (d,).
+    :type a: np.array
+    :param b: The candidate matrix of shape (N, d).
+    :type b: np.array
+    :param chunk_size: The number of rows to score at once, which bounds the size of temporary arrays.
+    :type chunk_size: int
+    :return: The distances of shape (N,).
+    :rtype: np.array
+    """
+    distances = np.empty(len(b), dtype=np.result_type(a, b))
+    for start in range(0, len(b), chunk_size):
+        chunk = b[start:start+chunk_size]
+        distances[start:start+len(chunk)] = np.sum(np.sqrt((np.abs(chunk - a) / factor) + epsilon), axis=1)
+    return distances
+
+def cosine_similarity(a: np.array, b: np.array, epsilon=1e-6) -> np.array:
+    """
+    Cosine similarity between a vector and every row of a matrix.
+
+    :param a: The query vector of shape (d,).
+    :type a: np.array
+    :param b: The candidate matrix of shape (N, d).
+    :type b: np.array
+    :return: The similarities of shape (N,).
+    :rtype: np.array
+    """
+    norms = np.linalg.norm(b, axis=1) * np.linalg.norm(a)
+    return (b @ a) / np.maximum(norms, epsilon)
+
+def top_k_indices(scores: np.array, k: int = None, largest: bool = False) -> np.array:
+    """
+    Return the indices of the k best scores in order, using argpartition instead of a full sort.
+    Ties are broken by index, so the result matches a stable sort of the scores.
+
+    :param scores: The scores to select from.
+    :type scores: np.array
+    :param k: The number of indices to return. None returns every index.
+    :type k: int
+    :param largest: Whether higher scores are better.
+    :type largest: bool
+    :rtype: np.array
+    """
+    scores = -scores if largest else scores
+    if k is None or k >= len(scores):
+        candidates = np.arange(len(scores))
+    elif k <= 0:
+        return np.zeros(0, dtype=np.intp)
+    else:
+        kth = np.partition(scores, k - 1)[k - 1]
+        better = np.flatnonzero(scores < kth)
+        tied = np.flatnonzero(scores == kth)[:k - len(better)]
+        candidates = np.concatenate((better, tied))
+    return candidates[np.lexsort((candidates, scores[candidates]))]
+
+def score_memories(now: Memory, then: List[Memory], metric: str = 'distance') -> np.array:
+    """
+    Score every memory against the current memory in a single vectorized pass.
+
+    :param now: The current memory.
+    :type now: Memory
+    :param then: The memories to score.
+    :type then: List[Memory]
+    :param metric: Either 'distance' for cosine_distance (lower is closer) or 'similarity' for cosine similarity (higher is closer).
+    :type metric: str
+    :rtype: np.array
+    """
+    query = decode_encoding(now.encoding)
+    matrix = decode_encodings([memory.encoding for memory in then])
+    if metric == 'distance':
+        return cosine_distances(query, matrix)
+    elif metric == 'similarity':
+        return cosine_similarity(query, matrix)
+    raise ValueError(f'Unknown metric: {metric}')
+
+def memory_sort(now: Memory, then: List[Memory], top_k: int = 256, cutoff_idx: int = 128, max_samples: int = 512, metric: str = 'distance', scorer=None) -> List[Memory]:
     """
     Sort memories based on their cosine distance to the current memory.
+    Past cutoff_idx + max_samples memories, older memories are randomly sampled. To search large memory stores
+    without sampling, use a MemoryIndex with an approximate nearest neighbour index instead.
+
+    :param metric: Either 'distance' to rank by cosine_distance or 'similarity' to rank by cosine similarity.
+    :type metric: str
+    :param scorer: A shimeji.scoring.Scorer to rank by instead of metric, such as a WeightedScorer.
+    :type scorer: Scorer
     """
 
     # get most recent memories
@@ -30,9 +160,62 @@ def memory_sort(now: Memory, then: List[Memory], top_k: int = 256, cutoff_idx: i
     else:
         memories = then
 
-    return sorted(memories, key=lambda x: cosine_distance(str_to_numpybin(now.encoding), str_to_numpybin(x.encoding)))[:top_k]
+    if not memories:
+        return []
+
+    if scorer is not None:
+        return [memories[idx] for idx in top_k_indices(scorer(now, memories), top_k, largest=scorer.largest)]
+
+    scores = score_memories(now, memories, metric)
+    return [memories[idx] for idx in top_k_indices(scores, top_k, largest=(metric == 'similarity'))]
+
+def format_memory(memory: Memory) -> str:
+    """
+    Format a memory as a line of a chat log. A leading space in the text is dropped, the memory is not modified.
+
+    :param memory: The memory to format.
+    :type memory: Memory
+    :rtype: str
+    """
+    text = memory.text[1:] if memory.text.startswith(' ') else memory.text
+    return f'{memory.author}: {text}\n'
+
+def format_memories(memories: List[Memory]) -> str:
+    """
+    Format memories as a chat log, one memory per line.
+
+    :param memories: The memories to format.
+    :type memories: List[Memory]
+    :rtype: str
+    """
+    return ''.join(format_memory(memory) for memory in memories)
+
+def pack_memories(memories: List[Memory], token_budget: int, count: Callable[[str], int] = count_line_tokens) -> List[Memory]:
+    """
+    Choose the memories whose lines fit in a token budget and return them in chronological order.
+
+    Memories are taken in the order given, so the best ranked should come first, and a memory whose line does not fit
+    in what is left of the budget is skipped. Lines are counted with a cache, so a memory is only tokenized once
+    however many turns it is retrieved in.
+
+    :param memories: The memories to choose from, best first.
+    :type memories: List[Memory]
+    :param token_budget: The maximum number of tokens the formatted memories may use.
+    :type token_budget: int
+    :param count: A function returning the number of tokens in a text.
+    :type count: Callable[[str], int]
+    :rtype: List[Memory]
+    """
+    packed = []
+    for memory in memories:
+        tokens = count(format_memory(memory))
+        if tokens <= token_budget:
+            token_budget -= tokens
+            packed.append(memory)
+
+    return sorted(packed, key=lambda memory: (memory.created_at, memory.author_id))
 
-def memory_context(now: Memory, then: List[Memory], short_term=20, long_term=10) -> str:
+def memory_context(now: Memory, then: List[Memory], short_term=20, long_term=10, token_budget: int = None, scorer=None) -> str:
     """
     Generate a context based on the current memory and the memories that are similar to it.
 
@@ -42,20 +225,335 @@ def memory_context(now: Memory, then: List[Memory], short_term=20, long_term=10)
     :type then: List[Memory]
     :param short_term: The number of recent memories to exclude from the context.
     :type short_term: int
-    :param long_term: The number of memories to include in the context.
+    :param long_term: The number of memories to include in the context. With a token_budget, this can be None to rank every memory.
     :type long_term: int
+    :param token_budget: If set, the best ranked memories which fit in this many tokens are used, in chronological order.
+    :type token_budget: int
+    :param scorer: A shimeji.scoring.Scorer to rank memories by, see memory_sort.
+    :type scorer: Scorer
     """
     if short_term is not None:
-        memories = memory_sort(now, then[:-short_term], long_term)
+        memories = memory_sort(now, then[:-short_term], long_term, scorer=scorer)
     else:
-        memories = memory_sort(now, then, long_term)
+        memories = memory_sort(now, then, long_term, scorer=scorer)
+
+    if token_budget is not None:
+        return format_memories(pack_memories(memories, token_budget))
+
     memories.reverse()
+    return format_memories(memories)
 
-    text = ""
-    for memory in memories:
-        # check if memory.text starts with a space, if so, remove it
-        if memory.text.startswith(" "):
-            memory.text = memory.text[1:]
-        text += f'{memory.author}: {memory.text}\n'
+class MemoryIndex:
+    """
+    An in-process index of memory encodings that sits next to a MemoryStoreProvider.
+
+    The encodings are kept decoded in a growable float32 matrix, in created_at order, with parallel arrays of
+    created_at and author_id keys. The index is updated incrementally when memories are created or deleted
+    through the attached MemoryStoreProvider, and sync() catches up on memories written elsewhere.
+
+    Only the metadata of each memory is kept next to the matrix. The encodings of the memories returned by search and
+    latest are rebuilt from the matrix as float32 bytes, so with a quantizer they are the decoded codes.
+
+    For large memory stores an approximate nearest neighbour index such as shimeji.ann.IVFIndex can be given, in which
+    case the encodings are kept in that index and searched in sublinear time. It must be empty, as the MemoryIndex
+    adds every memory to it under a row id of its own, since memories can share a created_at.
+
+    To reduce memory use a shimeji.quantization.Quantizer can be given instead, in which case the matrix holds
+    compressed codes and distances are computed from them. Memories may store either raw encodings or codes from
+    the same quantizer.
+
+    An index with a scope_id only holds the memories of that conversation, channel or bot, so its size and search
+    cost do not grow with the rest of the memory store.
+    """
+
+    def __init__(self, memorystore: MemoryStoreProvider = None, capacity: int = 1024, ann=None, quantizer=None, scope_id: int = None):
+        """
+        Initialize a MemoryIndex.
+
+        :param memorystore: The memory store to index. The index attaches itself to it.
+        :type memorystore: MemoryStoreProvider
+        :param capacity: The initial number of rows to allocate.
+        :type capacity: int
+        :param ann: An approximate nearest neighbour index to search instead of the exact matrix, such as an IVFIndex.
+        :type ann: IVFIndex
+        :param quantizer: A quantizer used to compress the matrix. Quantizers that need training must already be trained.
+        :type quantizer: Quantizer
+        :param scope_id: Only index the memories of this scope. If None, memories from every scope are indexed.
+        :type scope_id: int
+        """
+        if ann is not None and quantizer is not None:
+            raise ValueError('ann and quantizer cannot be used together')
+        if ann is not None and len(ann) > 0:
+            raise ValueError('the ann index must be empty')
+
+        self.memorystore = memorystore
+        self.capacity = max(capacity, 1)
+        self.size = 0
+        self.matrix = None
+        self.created_at = np.zeros(self.capacity, dtype=np.int64)
+        self.author_id = np.zeros(self.capacity, dtype=np.int64)
+        # unique ids of the rows, which the ann index is keyed by
+        self.ids = np.zeros(self.capacity, dtype=np.int64)
+        self.next_id = 0
+        self.memories = []
+        self.last_created_at = 0
+        # whether the memories already in the memory store have been fetched by sync
+        self.synced = False
+        self.ann = ann
+        self.quantizer = quantizer
+        self.scope_id = scope_id
+        self._by_id = {}
+        # how many candidates per result an ann index returns for a scorer to rerank
+        self.rerank_factor = 4
+
+        if memorystore is not None:
+            memorystore.attach_index(self)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _rows(self, memories: List[Memory]) -> np.array:
+        if self.quantizer is None or self.quantizer.dim is None:
+            vectors = decode_encodings([memory.encoding for memory in memories])
+            return vectors if self.quantizer is None else self.quantizer.encode(vectors)
+
+        buffers = [encoding_to_bytes(memory.encoding) for memory in memories]
+        is_code = np.array([self.quantizer.is_code(buffer) for buffer in buffers])
+        rows = np.empty((len(buffers), self.quantizer.code_size()), dtype=np.uint8)
+        if is_code.any():
+            rows[is_code] = self.quantizer.from_bytes([buffer for buffer, code in zip(buffers, is_code) if code])
+        if not is_code.all():
+            rows[~is_code] = self.quantizer.encode(decode_encodings([buffer for buffer, code in zip(buffers, is_code) if not code]))
+        return rows
+
+    def _query(self, now: Memory) -> np.array:
+        if self.quantizer is not None and self.quantizer.dim is not None:
+            buffer = encoding_to_bytes(now.encoding)
+            if self.quantizer.is_code(buffer):
+                return self.quantizer.decode(self.quantizer.from_bytes([buffer]))[0]
+        return decode_encoding(now.encoding)
+
+    def _restore(self, memory: Memory, vector: np.array) -> Memory:
+        return memory.copy(update={'encoding': np.asarray(vector, dtype=np.float32).tobytes()})
+
+    def _row_memory(self, idx: int) -> Memory:
+        memory = self.memories[idx]
+        if self.quantizer is not None:
+            return self._restore(memory, self.quantizer.decode(self.matrix[idx:idx+1])[0])
+        if self.matrix is not None:
+            return self._restore(memory, self.matrix[idx])
+        return self._restore(memory, self.ann.get([self.ids[idx]])[0])
+
+    def _ann_memories(self, ids: List[int]) -> List[Memory]:
+        return [self._restore(self._by_id[id], vector) for id, vector in zip(ids, self.ann.get(ids))]
+
+    def _reserve(self, size: int, dim: int, dtype=np.float32):
+        if self.ann is not None:
+            # the ann index holds the encodings, only the keys are kept here
+            if size > self.capacity:
+                while self.capacity < size:
+                    self.capacity *= 2
+                self.created_at = np.resize(self.created_at, self.capacity)
+                self.author_id = np.resize(self.author_id, self.capacity)
+                self.ids = np.resize(self.ids, self.capacity)
+            return
+
+        if self.matrix is None:
+            self.matrix = np.zeros((self.capacity, dim), dtype=dtype)
+        elif dim != self.matrix.shape[1]:
+            raise ValueError(f'Encoding has {dim} dimensions, but the index has {self.matrix.shape[1]}')
+
+        if size <= self.capacity:
+            return
+
+        while self.capacity < size:
+            self.capacity *= 2
+
+        matrix = np.zeros((self.capacity, dim), dtype=dtype)
+        matrix[:self.size] = self.matrix[:self.size]
+        self.matrix = matrix
+        self.created_at = np.resize(self.created_at, self.capacity)
+        self.author_id = np.resize(self.author_id, self.capacity)
+        self.ids = np.resize(self.ids, self.capacity)
+
+    def _find(self, memory: Memory) -> Optional[int]:
+        start = np.searchsorted(self.created_at[:self.size], memory.created_at, side='left')
+        end = np.searchsorted(self.created_at[:self.size], memory.created_at, side='right')
+        for idx in range(start, end):
+            if self.author_id[idx] == memory.author_id:
+                return idx
+        return None
+
+    def add(self, memory: Memory):
+        """
+        Add a memory to the index.
+
+        :param memory: The memory to add.
+        :type memory: Memory
+        """
+        self.extend([memory])
+
+    def extend(self, memories: List[Memory]):
+        """
+        Add several memories to the index, decoding their encodings in one pass.
+
+        :param memories: The memories to add.
+        :type memories: List[Memory]
+        """
+        memories = [memory for memory in memories if self._find(memory) is None and (self.scope_id is None or memory.scope_id == self.scope_id)]
+        if not memories:
+            return
+
+        vectors = self._rows(memories)
+        self._reserve(self.size + len(memories), vectors.shape[1], vectors.dtype)
+
+        ids = np.arange(self.next_id, self.next_id + len(memories), dtype=np.int64)
+        self.next_id += len(memories)
+        if self.ann is not None:
+            self.ann.add(ids, vectors)
+
+        for memory, vector, id in zip(memories, vectors, ids.tolist()):
+            if memory.created_at >= self.last_created_at:
+                idx = self.size
+            else:
+                # out of order, shift the newer rows up by one
+                idx = np.searchsorted(self.created_at[:self.size], memory.created_at, side='right')
+                if self.matrix is not None:
+                    self.matrix[idx+1:self.size+1] = self.matrix[idx:self.size]
+                self.created_at[idx+1:self.size+1] = self.created_at[idx:self.size]
+                self.author_id[idx+1:self.size+1] = self.author_id[idx:self.size]
+                self.ids[idx+1:self.size+1] = self.ids[idx:self.size]
+
+            if self.matrix is not None:
+                self.matrix[idx] = vector
+            self.created_at[idx] = memory.created_at
+            self.author_id[idx] = memory.author_id
+            self.ids[idx] = id
+            # the encoding is in the matrix or the ann index, keeping it here as well would undo the savings of a quantizer
+            memory = memory.copy(update={'encoding': b''})
+            self.memories.insert(idx, memory)
+            self._by_id[id] = memory
+            self.size += 1
+            self.last_created_at = max(self.last_created_at, memory.created_at)
+
+    def remove(self, memory: Memory):
+        """
+        Remove a memory from the index.
+
+        :param memory: The memory to remove. It is matched by created_at and author_id.
+        :type memory: Memory
+        """
+        idx = self._find(memory)
+        if idx is None:
+            return
+
+        id = int(self.ids[idx])
+        if self.matrix is not None:
+            self.matrix[idx:self.size-1] = self.matrix[idx+1:self.size]
+        else:
+            self.ann.remove([id])
+        del self._by_id[id]
+        self.created_at[idx:self.size-1] = self.created_at[idx+1:self.size]
+        self.author_id[idx:self.size-1] = self.author_id[idx+1:self.size]
+        self.ids[idx:self.size-1] = self.ids[idx+1:self.size]
+        del self.memories[idx]
+        self.size -= 1
+
+    async def sync(self) -> int:
+        """
+        Catch up with the memory store by fetching only the memories created after the newest one in the index.
+
+        :return: The number of memories added.
+        :rtype: int
+        """
+        size = self.size
+        async for batch in self.memorystore.stream(created_after=self.last_created_at, scope_id=self.scope_id):
+            self.extend(batch)
+        self.synced = True
+        return self.size - size
+
+    def latest(self) -> Optional[Memory]:
+        """
+        Return the most recent memory in the index.
+
+        :rtype: Memory
+        """
+        return self._row_memory(self.size - 1) if self.size else None
+
+    def search(self, now: Memory, top_k: int = 256, exclude_recent: int = 0, metric: str = 'distance', scorer=None) -> List[Memory]:
+        """
+        Return the memories closest to the current memory, closest first.
+
+        :param now: The current memory.
+        :type now: Memory
+        :param top_k: The number of memories to return.
+        :type top_k: int
+        :param exclude_recent: The number of most recent memories to leave out of the search.
+        :type exclude_recent: int
+        :param metric: Either 'distance' or 'similarity', see memory_sort.
+        :type metric: str
+        :param scorer: A shimeji.scoring.Scorer to rank by instead of metric. With an ann index, its candidates are rescored.
+        :type scorer: Scorer
+        :rtype: List[Memory]
+        """
+        end = self.size - (exclude_recent or 0)
+        if end <= 0:
+            return []
+        if scorer is not None:
+            metric = scorer.metric
+
+        query = self._query(now)
+        if self.ann is not None:
+            if metric != self.ann.metric:
+                raise ValueError(f'The ann index uses the {self.ann.metric} metric')
+            if scorer is None:
+                ids, _ = self.ann.search(query, top_k, exclude=self.ids[end:self.size])
+                return self._ann_memories(ids.tolist())
+
+            # a scorer can prefer memories the ann index does not rank highly, so the nearest and the most recent
+            # memories are both taken as candidates and rescored exactly
+            candidates = top_k * self.rerank_factor if top_k is not None else None
+            ids, _ = self.ann.search(query, candidates, exclude=self.ids[end:self.size])
+            ids = set(ids.tolist()) | set(self.ids[max(end - (candidates or end), 0):end].tolist())
+            memories = self._ann_memories(sorted(ids, key=lambda id: self._by_id[id].created_at))
+            if not memories:
+                return []
+            return memory_sort(now, memories, top_k, cutoff_idx=None, max_samples=None, scorer=scorer)
+
+        if self.quantizer is not None:
+            scores = self.quantizer.distances(query, self.matrix[:end], metric)
+        elif metric == 'distance':
+            scores = cosine_distances(query, self.matrix[:end])
+        elif metric == 'similarity':
+            scores = cosine_similarity(query, self.matrix[:end])
+        else:
+            raise ValueError(f'Unknown metric: {metric}')
+
+        if scorer is not None:
+            scores = scorer.weight(scores, self.created_at[:end], self.author_id[:end], now)
+            return [self._row_memory(idx) for idx in top_k_indices(scores, top_k, largest=scorer.largest)]
+
+        return [self._row_memory(idx) for idx in top_k_indices(scores, top_k, largest=(metric == 'similarity'))]
+
+    def context(self, now: Memory, short_term=20, long_term=10, token_budget: int = None, scorer=None) -> str:
+        """
+        Generate a context like memory_context, but from the index instead of a list of memories.
+
+        :param now: The current memory.
+        :type now: Memory
+        :param short_term: The number of recent memories to exclude from the context.
+        :type short_term: int
+        :param long_term: The number of memories to include in the context. With a token_budget, this can be None to rank every memory.
+        :type long_term: int
+        :param token_budget: If set, the best ranked memories which fit in this many tokens are used, in chronological order.
+        :type token_budget: int
+        :param scorer: A shimeji.scoring.Scorer to rank memories by, see search.
+        :type scorer: Scorer
+        """
+        memories = self.search(now, long_term, exclude_recent=short_term, scorer=scorer)
+
+        if token_budget is not None:
+            return format_memories(pack_memories(memories, token_budget))
 
-    return text
+        memories.reverse()
+        return format_memories(memories)
@@ -1,11 +1,22 @@
+import os
+import json
 import time
+import asyncio
+import base64
+import numpy as np
+from typing import List, Optional, Union
 from pydantic import BaseModel
-from difflib import SequenceMatcher
+from shimeji.dedup import DuplicateIndex, deduplicate, normalized_text_hash, similar
 
 sukima_epoch = 1621123998
 
+_last_snowflake = 0
+
 def snowflake():
-    return int((time.time() - sukima_epoch) * 10**5)
+    # strictly increasing, so that memories added in a burst never share a created_at
+    global _last_snowflake
+    _last_snowflake = max(int((time.time() - sukima_epoch) * 10**5), _last_snowflake + 1)
+    return _last_snowflake
 
 def to_snowflake(timestamp):
     return int((timestamp - sukima_epoch) * 10**5)
@@ -13,6 +24,9 @@ def to_snowflake(timestamp):
 class Memory(BaseModel):
     """
     A BaseModel for representing a memory.
+
+    The encoding is either ASCII85 text or the raw float32 bytes of the encoding. The scope_id partitions memories by
+    conversation, channel or bot, and is None for memories which belong to no scope.
     """
    
     created_at: int
@@ -20,7 +34,11 @@ class Memory(BaseModel):
     author: str
     text: str
     encoding_model: str
-    encoding: str
+    encoding: Union[str, bytes]
+    scope_id: Optional[int] = None
+
+    class Config:
+        smart_union = True
 
 class MemoryStoreProvider:
     """
@@ -32,11 +50,56 @@ class MemoryStoreProvider:
         Initialize a MemoryStoreProvider.
         """
         self.kwargs = kwargs
+        self.indexes = []
+        # one DuplicateIndex per scope_id, created by check_duplicates()
+        self.duplicate_indexes = {}
+
+    def attach_index(self, index):
+        """
+        Attach an index which is kept up to date as memories are created and deleted.
+
+        :param index: The index to attach. It must implement add(memory) and remove(memory).
+        :type index: MemoryIndex
+        """
+        self.indexes.append(index)
+
+    def _index_add(self, memory: Memory):
+        for index in self.indexes:
+            index.add(memory)
+
+    def _index_remove(self, memory: Memory):
+        for index in self.indexes:
+            index.remove(memory)
+
+    async def stream(self, created_after: int = 0, batch_size: int = 1000, author_id: int = None, scope_id: int = None):
+        """
+        Iterate over the memories created after a snowflake in batches, in created_at order.
 
-    async def count(self):
+        Providers which can read incrementally override this so that only one batch is held in memory at a time. The
+        default implementation slices the result of get().
+
+        :param created_after: The snowflake to stream memories after.
+        :type created_after: int
+        :param batch_size: The number of memories in each batch.
+        :type batch_size: int
+        :param author_id: Only stream memories by this author.
+        :type author_id: int
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
+        :rtype: AsyncIterator[List[Memory]]
+        """
+        memories = await self.get(created_after=created_after, scope_id=scope_id)
+        if author_id is not None:
+            memories = [m for m in memories if m.author_id == author_id]
+        for start in range(0, len(memories), batch_size):
+            yield memories[start:start+batch_size]
+
+    async def count(self, scope_id: int = None):
         """
         Return the number of memories in the MemoryStore.
 
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
         :return: The number of memories in the MemoryStore.
         :rtype: int
         """
@@ -50,6 +113,8 @@ class MemoryStoreProvider:
         :type exclude_duplicates: bool
         :param exclude_duplicates_ratio: Exclude duplicates based upon Sequence Matching techniques. This can be set to None if that is not desired.
         :type exclude_duplicates_ratio: float
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
         """
         raise NotImplementedError('filter() is not implemented')
     
@@ -85,9 +150,71 @@ class MemoryStoreProvider:
         :type encoding_model: str
         :param encoding: The encoding of the memory.
         :type encoding: str
+        :param scope_id: The conversation, channel or bot the memory belongs to.
+        :type scope_id: int
+        :param skip_if_duplicate: If True, the memory is not added when a memory with the same text, up to case and whitespace, exists in its scope.
+        :type skip_if_duplicate: bool
         :rtype: Memory
         """
         raise NotImplementedError('add() is not implemented')
+
+    async def create_many(self, **kwargs):
+        """
+        Add several memories directly to the MemoryStore. Providers override this to write them all at once.
+
+        :param memories: The memories to add to the MemoryStore.
+        :type memories: List[Memory]
+        :rtype: List[Memory]
+        """
+        for memory in kwargs['memories']:
+            await self.create(memory=memory)
+        return kwargs['memories']
+
+    async def add_many(self, **kwargs):
+        """
+        Create and add several memories to the MemoryStore with a single create_many().
+
+        :param memories: The memories to add, each a dict of the author_id, author, text, encoding_model, encoding and optionally scope_id arguments of add().
+        :type memories: List[dict]
+        :param scope_id: The scope of memories which do not set their own.
+        :type scope_id: int
+        :param skip_if_duplicate: If True, memories whose text, up to case and whitespace, exists in their scope in the MemoryStore or earlier in memories are not added.
+        :type skip_if_duplicate: bool
+        :return: The memories which were added.
+        :rtype: List[Memory]
+        """
+        items = [dict(item, scope_id=item.get('scope_id', kwargs.get('scope_id'))) for item in kwargs['memories']]
+        if kwargs.get('skip_if_duplicate'):
+            existing = set()
+            for scope_id in {item['scope_id'] for item in items}:
+                texts = [item['text'] for item in items if item['scope_id'] == scope_id]
+                existing.update((scope_id, digest) for digest in await self._exact_duplicates(texts, scope_id))
+            unique = []
+            for item in items:
+                key = (item['scope_id'], normalized_text_hash(item['text']))
+                if key not in existing:
+                    existing.add(key)
+                    unique.append(item)
+            items = unique
+
+        memories = [Memory(
+            created_at=snowflake(),
+            author_id=item['author_id'],
+            author=item['author'],
+            text=item['text'],
+            encoding_model=item['encoding_model'],
+            encoding=item['encoding'],
+            scope_id=item['scope_id']
+        ) for item in items]
+
+        if memories:
+            await self.create_many(memories=memories)
+
+        return memories
+
+    async def _exact_duplicates(self, texts: List[str], scope_id: int = None) -> set:
+        # the normalized text hashes of the texts which already exist in the scope
+        return {normalized_text_hash(text) for text in texts if await self.check_duplicates(text=text, duplicate_ratio=None, scope_id=scope_id)}
     
     async def check_duplicates(self, **kwargs) -> bool:
         """
@@ -95,17 +222,38 @@ class MemoryStoreProvider:
 
         :param text: The text of the memory.
         :type text: str
-        :param duplicate_ratio: The ratio of the text that must match to be considered a duplicate.
+        :param duplicate_ratio: The ratio of the text that must match to be considered a duplicate. If None, only texts equal up to case and whitespace are duplicates.
         :type duplicate_ratio: float
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
         :rtype: bool
         """
 
         raise NotImplementedError('check_duplicates() is not implemented')
+
+    async def search(self, **kwargs):
+        """
+        Return the memories closest to an encoding, closest first.
+
+        :param encoding: The encoding to search for.
+        :type encoding: Union[str, bytes]
+        :param top_k: The number of memories to return.
+        :type top_k: int
+        :param created_before: Only search memories created before this snowflake.
+        :type created_before: int
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
+        :rtype: List[Memory]
+        """
+
+        raise NotImplementedError('search() is not implemented')
         
 from typing import AsyncIterator, List, Optional
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy import event
 from sqlalchemy.orm import sessionmaker
-from shimeji.sqlcrud import memory
+from sqlalchemy.schema import CreateIndex, CreateTable
+from shimeji.sqlcrud import memory, MemorySQL
 
 class PostgreSQL_MemoryStoreProvider(MemoryStoreProvider):
     """
@@ -117,8 +265,10 @@ class PostgreSQL_MemoryStoreProvider(MemoryStoreProvider):
         Initialize a PostgreSQL_MemoryStoreProvider.
 
         :param database_uri: The URI of the database to connect to.
+        :param binary_encoding: Store encodings in the binary encoding_bin column and return them as bytes, defaults to False, which keeps storing and returning ASCII85 text as before. Setting it to True needs the encoding_bin migration, and changes Memory.encoding to bytes for callers.
         """
-        self.kwargs = kwargs
+        super().__init__(**kwargs)
+        self.binary_encoding = kwargs.get('binary_encoding', False)
 
         if 'database_uri' not in kwargs:
             raise ValueError('database_uri is required')
@@ -126,18 +276,42 @@ class PostgreSQL_MemoryStoreProvider(MemoryStoreProvider):
         self.engine = create_async_engine(kwargs['database_uri'], pool_pre_ping=True)
         self.async_session = sessionmaker(self.engine, expire_on_commit=False, class_=AsyncSession)
     
-    async def count(self) -> int:
+    async def count(self, scope_id: int = None) -> int:
         """
         Return the number of memories in the PostgreSQL_MemoryStoreProvider.
 
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
         :return: The number of memories in the PostgreSQL_MemoryStoreProvider.
         :rtype: int
         """
         async with self.async_session() as session, session.begin():
             return await memory.count(
-                session=session
+                session=session,
+                scope_id=scope_id
             )
     
+    def _to_memory(self, db_obj) -> Memory:
+        if db_obj.encoding_bin is not None:
+            encoding = db_obj.encoding_bin if self.binary_encoding else base64.a85encode(db_obj.encoding_bin).decode()
+        else:
+            encoding = base64.a85decode(db_obj.encoding) if self.binary_encoding else db_obj.encoding
+
+        return Memory.construct(
+            created_at=db_obj.created_at,
+            author_id=db_obj.author_id,
+            author=db_obj.author,
+            text=db_obj.text,
+            encoding_model=db_obj.encoding_model,
+            encoding=encoding,
+            scope_id=db_obj.scope_id
+        )
+
+    def _to_stored_encoding(self, encoding: Union[str, bytes]) -> Union[str, bytes]:
+        if self.binary_encoding:
+            return base64.a85decode(encoding) if isinstance(encoding, str) else bytes(encoding)
+        return encoding if isinstance(encoding, str) else base64.a85encode(encoding).decode()
+
     async def get_session(self) -> AsyncIterator[AsyncSession]:
         """
         Get a session from the database.
@@ -153,22 +327,50 @@ class PostgreSQL_MemoryStoreProvider(MemoryStoreProvider):
             finally:
                 await session.close()
     
-    async def get(self, created_after: int = None) -> List[Memory]:
+    async def get(self, created_after: int = None, scope_id: int = None) -> List[Memory]:
         """
         Get a list of memories created after a certain amount of time from the database.
 
         :param created_after:
         :type MemorySQL
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
         :rtype: List[Memory]
         """
         if created_after is None:
             created_after = 0
         
         async with self.async_session() as session, session.begin():
-            return await memory.get_after_id(
+            return [self._to_memory(db_obj) for db_obj in await memory.get_after_id(
                 session=session,
-                created_at=created_after
-            )
+                created_at=created_after,
+                scope_id=scope_id
+            )]
+    
+    async def stream(self, created_after: int = 0, batch_size: int = 1000, author_id: int = None, scope_id: int = None) -> AsyncIterator[List[Memory]]:
+        """
+        Iterate over the memories created after a snowflake in batches, in created_at order. Rows are read through a
+        server-side cursor, so only one batch is held in memory at a time whatever the size of the table.
+
+        :param created_after: The snowflake to stream memories after.
+        :type created_after: int
+        :param batch_size: The number of memories in each batch.
+        :type batch_size: int
+        :param author_id: Only stream memories by this author.
+        :type author_id: int
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
+        :rtype: AsyncIterator[List[Memory]]
+        """
+        async with self.async_session() as session, session.begin():
+            async for batch in memory.stream_after_id(
+                session=session,
+                created_at=created_after or 0,
+                batch_size=batch_size,
+                author_id=author_id,
+                scope_id=scope_id
+            ):
+                yield [self._to_memory(db_obj) for db_obj in batch]
     
     async def create(self, **kwargs) -> Optional[Memory]:
         """
@@ -180,19 +382,50 @@ class PostgreSQL_MemoryStoreProvider(MemoryStoreProvider):
         """
         memory_obj = kwargs['memory']
         async with self.async_session() as session, session.begin():
-            return await memory.create(
+            db_obj = await memory.create(
                 session=session,
                 created_at=memory_obj.created_at,
                 author_id=memory_obj.author_id,
                 author=memory_obj.author,
                 text=memory_obj.text,
                 encoding_model=memory_obj.encoding_model,
-                encoding=memory_obj.encoding
+                encoding=self._to_stored_encoding(memory_obj.encoding),
+                scope_id=memory_obj.scope_id
+            )
+
+        self._index_add(memory_obj)
+        return db_obj
+
+    async def create_many(self, **kwargs) -> List[Memory]:
+        """
+        Add several memories to the PostgreSQL_MemoryStoreProvider with multi-row inserts in a single transaction.
+
+        :param memories: The memories to add to the PostgreSQL_MemoryStoreProvider.
+        :type memories: List[Memory]
+        :rtype: List[Memory]
+        """
+        memories = kwargs['memories']
+        async with self.async_session() as session, session.begin():
+            await memory.create_many(
+                session=session,
+                memories=[{
+                    'created_at': memory_obj.created_at,
+                    'author_id': memory_obj.author_id,
+                    'author': memory_obj.author,
+                    'text': memory_obj.text,
+                    'encoding_model': memory_obj.encoding_model,
+                    'encoding': self._to_stored_encoding(memory_obj.encoding),
+                    'scope_id': memory_obj.scope_id
+                } for memory_obj in memories]
             )
+
+        for memory_obj in memories:
+            self._index_add(memory_obj)
+        return memories
         
     async def delete(self, **kwargs) -> Optional[Memory]:
         """
-        Delete a memory from the PostgreSQL_MemoryStoreProvider. Only deletes based on the memory's created_at.
+        Delete a memory from the PostgreSQL_MemoryStoreProvider. Deletes based on the memory's created_at and author_id.
 
         :param memory: The memory to delete from the PostgreSQL_MemoryStoreProvider.
         :type Memory: Memory
@@ -200,11 +433,14 @@ class PostgreSQL_MemoryStoreProvider(MemoryStoreProvider):
         """
         memory_obj = kwargs['memory']
         async with self.async_session() as session, session.begin():
-            return await memory.delete(
+            await memory.delete(
                 session=session,
+                created_at=memory_obj.created_at,
                 author_id=memory_obj.author_id
             )
 
+        self._index_remove(memory_obj)
+
     async def add(self, **kwargs):
         """
         Create and add a memory to the MemoryStore.
@@ -217,10 +453,18 @@ class PostgreSQL_MemoryStoreProvider(MemoryStoreProvider):
         :type text: str
         :param encoding_model: The name of the encoding model used to encode the memory.
         :type encoding_model: str
-        :param encoding: The encoding of the memory.
-        :type encoding: str
+        :param encoding: The encoding of the memory, either ASCII85 text or bytes.
+        :type encoding: Union[str, bytes]
+        :param scope_id: The conversation, channel or bot the memory belongs to.
+        :type scope_id: int
+        :param skip_if_duplicate: If True, the memory is not added when a memory with the same text, up to case and whitespace, exists in its scope.
+        :type skip_if_duplicate: bool
+        :return: The memory, or None if it was skipped as a duplicate.
         :rtype: Memory
         """
+
+        if kwargs.get('skip_if_duplicate') and await self._has_exact_duplicate(kwargs['text'], kwargs.get('scope_id')):
+            return None
         
         memory = Memory(
             created_at=snowflake(),
@@ -228,52 +472,844 @@ class PostgreSQL_MemoryStoreProvider(MemoryStoreProvider):
             author=kwargs['author'],
             text=kwargs['text'],
             encoding_model=kwargs['encoding_model'],
-            encoding=kwargs['encoding']
+            encoding=kwargs['encoding'],
+            scope_id=kwargs.get('scope_id')
         )
 
         await self.create(memory=memory)
 
         return memory
 
-    async def filter(self, exclude_duplicates: bool = False, exclude_duplicates_ratio: float = 0.8) -> List[Memory]:
+    async def filter(self, exclude_duplicates: bool = False, exclude_duplicates_ratio: float = 0.8, scope_id: int = None) -> List[Memory]:
         """
-        Filter the memories based on a search string.
+        Return the memories in created_at order, optionally without duplicates. The first memory of each group of duplicates is kept.
 
         :param exclude_duplicates: Exclude duplicates based upon Sequence Matching techniques. This can be set to None if that is not desired.
         :type exclude_duplicates: bool
         :param exclude_duplicates_ratio: Exclude duplicates based upon Sequence Matching techniques. This can be set to None if that is not desired.
         :type exclude_duplicates_ratio: float
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
         :rtype: List[Memory]
         """
 
-        memories = await self.get(created_after=0)
+        memories = await self.get(created_after=0, scope_id=scope_id)
         if exclude_duplicates:
-            for m in memories:
-                for m2 in memories:
-                    if m.text == m2.text:
-                        memories.remove(m2)
-                    if exclude_duplicates_ratio:
-                        if SequenceMatcher(None, m.text, m2.text).ratio() > exclude_duplicates_ratio:
-                            memories.remove(m2)
+            memories = deduplicate(memories, exclude_duplicates_ratio or None)
         
         return memories
     
+    async def _has_exact_duplicate(self, text: str, scope_id: int = None) -> bool:
+        async with self.async_session() as session, session.begin():
+            return await memory.get_by_text_hash(
+                session=session,
+                text_hash=normalized_text_hash(text),
+                scope_id=scope_id
+            ) is not None
+
+    async def _exact_duplicates(self, texts: List[str], scope_id: int = None) -> set:
+        async with self.async_session() as session, session.begin():
+            return await memory.get_existing_text_hashes(
+                session=session,
+                text_hashes=list({normalized_text_hash(text) for text in texts}),
+                scope_id=scope_id
+            )
+
+    async def check_duplicates(self, **kwargs) -> bool:
+        """
+        Check if a memory is a duplicate. Exact duplicates are found with an indexed lookup of the text hash.
+
+        :param text: The text of the memory.
+        :type text: str
+        :param duplicate_ratio: The ratio of the text that must match to be considered a duplicate. If None, only texts equal up to case and whitespace are duplicates.
+        :type duplicate_ratio: float
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
+        :rtype: bool
+        """
+        scope_id = kwargs.get('scope_id')
+        if await self._has_exact_duplicate(kwargs['text'], scope_id):
+            return True
+        if kwargs.get('duplicate_ratio') is None:
+            return False
+
+        if scope_id not in self.duplicate_indexes:
+            self.duplicate_indexes[scope_id] = DuplicateIndex(self, scope_id=scope_id)
+        duplicate_index = self.duplicate_indexes[scope_id]
+        await duplicate_index.sync()
+
+        return duplicate_index.is_duplicate(kwargs['text'], kwargs.get('duplicate_ratio'))
+
+    async def search(self, **kwargs) -> List[Memory]:
+        """
+        Return the memories closest to an encoding by cosine_distance, closest first.
+
+        :param encoding: The encoding to search for.
+        :type encoding: Union[str, bytes]
+        :param top_k: The number of memories to return.
+        :type top_k: int
+        :param created_before: Only search memories created before this snowflake.
+        :type created_before: int
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
+        :rtype: List[Memory]
+        """
+        from shimeji.memory import cosine_distances, decode_encoding, decode_encodings, top_k_indices
+
+        query = decode_encoding(kwargs['encoding'])
+        top_k = kwargs.get('top_k', 256)
+        created_before = kwargs.get('created_before')
+
+        # keep a running top_k over the stream, in created_at order so that ties resolve as in a single pass
+        best, best_scores = [], np.zeros(0, dtype=np.float32)
+        async for batch in self.stream(created_after=0, scope_id=kwargs.get('scope_id')):
+            if created_before is not None:
+                batch = [m for m in batch if m.created_at < created_before]
+            if not batch:
+                continue
+            candidates = best + batch
+            scores = np.concatenate([best_scores, cosine_distances(query, decode_encodings([m.encoding for m in batch]))])
+            keep = np.sort(top_k_indices(scores, top_k))
+            best, best_scores = [candidates[idx] for idx in keep], scores[keep]
+
+        return [best[idx] for idx in top_k_indices(best_scores, top_k)]
+
+class SQLite_MemoryStoreProvider(PostgreSQL_MemoryStoreProvider):
+    """
+    A MemoryStoreProvider using SQLite, which needs no database server.
+
+    It uses the same schema as PostgreSQL_MemoryStoreProvider, creating the table on first connect, and registers
+    a shimeji_distance function on every connection so that search() ranks memories inside the database.
+    """
+
+    distance_function = 'shimeji_distance'
+
+    def __init__(self, **kwargs):
+        """
+        Initialize a SQLite_MemoryStoreProvider.
+
+        :param database_uri: The URI of the database to connect to, such as sqlite+aiosqlite:///memories.db
+        :param binary_encoding: Store encodings in the binary encoding_bin column and return them as bytes, defaults to True. Set to False to store and return ASCII85 text.
+        """
+        # the schema is always created with the encoding_bin column, so there is no older text format to stay compatible with
+        kwargs.setdefault('binary_encoding', True)
+        super().__init__(**kwargs)
+        self._schema_created = False
+        event.listen(self.engine.sync_engine, 'connect', self._on_connect)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        dbapi_connection.create_function(self.distance_function, 2, sqlite_distance, deterministic=True)
+        if self._schema_created:
+            return
+
+        table = MemorySQL.__table__
+        cursor = dbapi_connection.cursor()
+        cursor.execute(str(CreateTable(table, if_not_exists=True).compile(dialect=self.engine.dialect)))
+        for index in table.indexes:
+            cursor.execute(str(CreateIndex(index, if_not_exists=True).compile(dialect=self.engine.dialect)))
+        dbapi_connection.commit()
+        cursor.close()
+        self._schema_created = True
+
+    async def search(self, **kwargs) -> List[Memory]:
+        """
+        Return the memories closest to an encoding by cosine_distance, closest first. The distances are computed by
+        SQLite, so only the top_k rows are returned from the database.
+
+        :param encoding: The encoding to search for.
+        :type encoding: Union[str, bytes]
+        :param top_k: The number of memories to return.
+        :type top_k: int
+        :param created_before: Only search memories created before this snowflake.
+        :type created_before: int
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
+        :rtype: List[Memory]
+        """
+        encoding = kwargs['encoding']
+        async with self.async_session() as session, session.begin():
+            return [self._to_memory(db_obj) for db_obj in await memory.get_nearest(
+                session=session,
+                distance_function=self.distance_function,
+                encoding=base64.a85decode(encoding) if isinstance(encoding, str) else bytes(encoding),
+                top_k=kwargs.get('top_k', 256),
+                created_before=kwargs.get('created_before'),
+                scope_id=kwargs.get('scope_id')
+            )]
+
+def sqlite_distance(encoding: Union[str, bytes], query: bytes) -> Optional[float]:
+    """
+    The cosine_distance between a stored encoding and a query, registered as a SQLite function.
+    """
+    if encoding is None:
+        return None
+    from shimeji.memory import cosine_distance, decode_encoding
+    return float(cosine_distance(np.frombuffer(query, dtype=np.float32), decode_encoding(encoding)))
+
+class Mmap_MemoryStoreProvider(MemoryStoreProvider):
+    """
+    A MemoryStoreProvider using append-only memory-mapped files, which needs no database server.
+
+    The store is a directory holding a float32 encoding matrix, fixed-size records with each memory's metadata and
+    the offset of its strings, and a blob of the memories' author, text and encoding_model strings. Files are mapped
+    with np.memmap so that large histories open instantly and are paged in by the OS. Deletes are tombstones.
+    """
+
+    record_dtype = np.dtype([
+        ('created_at', '<i8'),
+        ('author_id', '<i8'),
+        ('scope_id', '<i8'),
+        ('offset', '<i8'),
+        ('author_length', '<i4'),
+        ('text_length', '<i4'),
+        ('encoding_model_length', '<i4'),
+        ('deleted', 'u1'),
+        ('has_scope', 'u1'),
+        ('padding', 'V2')
+    ])
+    def __init__(self, **kwargs):
+        """
+        Initialize a Mmap_MemoryStoreProvider.
+
+        :param path: The directory to store the memories in. It is created if it does not exist.
+        :param binary_encoding: Return encodings as bytes, defaults to True. Set to False to return ASCII85 text.
+        """
+        super().__init__(**kwargs)
+
+        if 'path' not in kwargs:
+            raise ValueError('path is required')
+
+        self.path = kwargs['path']
+        self.binary_encoding = kwargs.get('binary_encoding', True)
+        os.makedirs(self.path, exist_ok=True)
+
+        self.meta_path = os.path.join(self.path, 'meta.json')
+        self.records_path = os.path.join(self.path, 'records.bin')
+        self.encodings_path = os.path.join(self.path, 'encodings.f32')
+        self.strings_path = os.path.join(self.path, 'strings.bin')
+
+        self.dim = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.dim = json.load(f)['dim']
+
+        for path in (self.records_path, self.encodings_path, self.strings_path):
+            open(path, 'ab').close()
+
+        self.size = os.path.getsize(self.records_path) // self.record_dtype.itemsize
+        self._mapped_size = None
+        self._records = None
+        self._encodings = None
+        self._strings = None
+        self._recover()
+
+    def _write_meta(self):
+        with open(self.meta_path, 'w') as f:
+            json.dump({'dim': self.dim}, f)
+
+    def _recover(self):
+        # drop anything written after the last complete record, such as a partial append
+        with open(self.records_path, 'r+b') as f:
+            f.truncate(self.size * self.record_dtype.itemsize)
+        self._map()
+
+        strings_end = 0
+        if self.size > 0:
+            last = self._records[self.size - 1]
+            strings_end = int(last['offset'] + last['author_length'] + last['text_length'] + last['encoding_model_length'])
+        with open(self.strings_path, 'r+b') as f:
+            f.truncate(strings_end)
+        with open(self.encodings_path, 'r+b') as f:
+            f.truncate(self.size * (self.dim or 0) * 4)
+
+    def _map(self):
+        if self._mapped_size == self.size:
+            return
+
+        if self.size == 0:
+            self._records = np.zeros(0, dtype=self.record_dtype)
+            self._encodings = np.zeros((0, self.dim or 0), dtype=np.float32)
+            self._strings = np.zeros(0, dtype=np.uint8)
+        else:
+            self._records = np.memmap(self.records_path, dtype=self.record_dtype, mode='r+', shape=(self.size,))
+            self._encodings = np.memmap(self.encodings_path, dtype=np.float32, mode='r', shape=(self.size, self.dim))
+            strings_size = os.path.getsize(self.strings_path)
+            self._strings = np.memmap(self.strings_path, dtype=np.uint8, mode='r') if strings_size > 0 else np.zeros(0, dtype=np.uint8)
+        self._mapped_size = self.size
+
+    def _live(self, scope_id: int = None) -> np.array:
+        self._map()
+        live = self._records['deleted'] == 0
+        if scope_id is not None:
+            live &= (self._records['has_scope'] == 1) & (self._records['scope_id'] == scope_id)
+        return live
+
+    def _string(self, offset: int, length: int) -> str:
+        return self._strings[offset:offset+length].tobytes().decode('utf-8')
+
+    def _to_memory(self, idx: int) -> Memory:
+        record = self._records[idx]
+        offset = int(record['offset'])
+        author_length = int(record['author_length'])
+        text_length = int(record['text_length'])
+        encoding = self._encodings[idx].tobytes()
+
+        return Memory.construct(
+            created_at=int(record['created_at']),
+            author_id=int(record['author_id']),
+            author=self._string(offset, author_length),
+            text=self._string(offset + author_length, text_length),
+            encoding_model=self._string(offset + author_length + text_length, int(record['encoding_model_length'])),
+            encoding=encoding if self.binary_encoding else base64.a85encode(encoding).decode(),
+            scope_id=int(record['scope_id']) if record['has_scope'] else None
+        )
+
+    def _find(self, created_at: int, author_id: int) -> Optional[int]:
+        self._map()
+        matches = np.flatnonzero((self._records['created_at'] == created_at) & (self._records['author_id'] == author_id) & (self._records['deleted'] == 0))
+        return int(matches[0]) if len(matches) > 0 else None
+
+    def _get_all(self, created_after: int = 0, scope_id: int = None) -> List[Memory]:
+        live = self._live(scope_id)
+        rows = np.flatnonzero(live & (self._records['created_at'] > created_after))
+        rows = rows[np.argsort(self._records['created_at'][rows], kind='stable')]
+        return [self._to_memory(idx) for idx in rows]
+
+    async def count(self, scope_id: int = None) -> int:
+        """
+        Return the number of memories in the Mmap_MemoryStoreProvider.
+
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
+        :return: The number of memories in the Mmap_MemoryStoreProvider.
+        :rtype: int
+        """
+        return int(np.count_nonzero(self._live(scope_id)))
+
+    async def get(self, created_after: int = None, scope_id: int = None) -> List[Memory]:
+        """
+        Get a list of memories created after a certain amount of time, in created_at order.
+
+        :param created_after: The snowflake to get memories after.
+        :type created_after: int
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
+        :rtype: List[Memory]
+        """
+        if created_after is None:
+            created_after = 0
+
+        return self._get_all(created_after, scope_id)
+
+    async def stream(self, created_after: int = 0, batch_size: int = 1000, author_id: int = None, scope_id: int = None) -> AsyncIterator[List[Memory]]:
+        """
+        Iterate over the memories created after a snowflake in batches, in created_at order. Only the records are
+        sorted up front, memories are built one batch at a time.
+
+        :param created_after: The snowflake to stream memories after.
+        :type created_after: int
+        :param batch_size: The number of memories in each batch.
+        :type batch_size: int
+        :param author_id: Only stream memories by this author.
+        :type author_id: int
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
+        :rtype: AsyncIterator[List[Memory]]
+        """
+        live = self._live(scope_id) & (self._records['created_at'] > (created_after or 0))
+        if author_id is not None:
+            live &= self._records['author_id'] == author_id
+        rows = np.flatnonzero(live)
+        rows = rows[np.argsort(self._records['created_at'][rows], kind='stable')]
+        for start in range(0, len(rows), batch_size):
+            yield [self._to_memory(idx) for idx in rows[start:start+batch_size]]
+
+    async def create(self, **kwargs) -> Optional[Memory]:
+        """
+        Add a memory to the Mmap_MemoryStoreProvider.
+
+        :param memory: The memory to add to the Mmap_MemoryStoreProvider.
+        :type Memory: Memory
+        :rtype: Memory
+        """
+        return (await self.create_many(memories=[kwargs['memory']]))[0]
+
+    async def create_many(self, **kwargs) -> List[Memory]:
+        """
+        Add several memories to the Mmap_MemoryStoreProvider with one append to each file.
+
+        :param memories: The memories to add to the Mmap_MemoryStoreProvider.
+        :type memories: List[Memory]
+        :rtype: List[Memory]
+        """
+        memories = kwargs['memories']
+        encodings = [base64.a85decode(m.encoding) if isinstance(m.encoding, str) else bytes(m.encoding) for m in memories]
+
+        for encoding in encodings:
+            dim = len(encoding) // 4
+            if self.dim is None:
+                self.dim = dim
+                self._write_meta()
+            elif dim != self.dim:
+                raise ValueError(f'Encoding has {dim} dimensions, but the store has {self.dim}')
+
+        records = np.zeros(len(memories), dtype=self.record_dtype)
+        strings = []
+        with open(self.strings_path, 'ab') as f:
+            offset = f.tell()
+            for i, memory_obj in enumerate(memories):
+                author = memory_obj.author.encode('utf-8')
+                text = memory_obj.text.encode('utf-8')
+                encoding_model = memory_obj.encoding_model.encode('utf-8')
+                records[i]['created_at'] = memory_obj.created_at
+                records[i]['author_id'] = memory_obj.author_id
+                if memory_obj.scope_id is not None:
+                    records[i]['scope_id'] = memory_obj.scope_id
+                    records[i]['has_scope'] = 1
+                records[i]['offset'] = offset
+                records[i]['author_length'] = len(author)
+                records[i]['text_length'] = len(text)
+                records[i]['encoding_model_length'] = len(encoding_model)
+                strings.append(author + text + encoding_model)
+                offset += len(strings[-1])
+            f.write(b''.join(strings))
+        with open(self.encodings_path, 'ab') as f:
+            f.write(b''.join(encodings))
+
+        # the records are written last, so a memory only exists once all of its data is on disk
+        with open(self.records_path, 'ab') as f:
+            f.write(records.tobytes())
+        self.size += len(memories)
+
+        for memory_obj in memories:
+            self._index_add(memory_obj)
+        return memories
+
+    async def delete(self, **kwargs) -> Optional[Memory]:
+        """
+        Delete a memory from the Mmap_MemoryStoreProvider by marking its record as deleted. Deletes based on the memory's created_at and author_id.
+
+        :param memory: The memory to delete from the Mmap_MemoryStoreProvider.
+        :type Memory: Memory
+        :rtype: Memory
+        """
+        memory_obj = kwargs['memory']
+        idx = self._find(memory_obj.created_at, memory_obj.author_id)
+        if idx is None:
+            return None
+
+        self._records['deleted'][idx] = 1
+        self._records.flush()
+
+        self._index_remove(memory_obj)
+
+    async def add(self, **kwargs):
+        """
+        Create and add a memory to the MemoryStore.
+
+        :param author_id: The ID of the author of the memory.
+        :type author_id: int
+        :param author: The name of the author of the memory.
+        :type author: str
+        :param text: The text of the memory.
+        :type text: str
+        :param encoding_model: The name of the encoding model used to encode the memory.
+        :type encoding_model: str
+        :param encoding: The encoding of the memory, either ASCII85 text or bytes.
+        :type encoding: Union[str, bytes]
+        :param scope_id: The conversation, channel or bot the memory belongs to.
+        :type scope_id: int
+        :param skip_if_duplicate: If True, the memory is not added when a memory with the same text, up to case and whitespace, exists in its scope.
+        :type skip_if_duplicate: bool
+        :return: The memory, or None if it was skipped as a duplicate.
+        :rtype: Memory
+        """
+
+        if kwargs.get('skip_if_duplicate') and await self.check_duplicates(text=kwargs['text'], duplicate_ratio=None, scope_id=kwargs.get('scope_id')):
+            return None
+
+        memory = Memory(
+            created_at=snowflake(),
+            author_id=kwargs['author_id'],
+            author=kwargs['author'],
+            text=kwargs['text'],
+            encoding_model=kwargs['encoding_model'],
+            encoding=kwargs['encoding'],
+            scope_id=kwargs.get('scope_id')
+        )
+
+        await self.create(memory=memory)
+
+        return memory
+
+    async def filter(self, exclude_duplicates: bool = False, exclude_duplicates_ratio: float = 0.8, scope_id: int = None) -> List[Memory]:
+        """
+        Return the memories in created_at order, optionally without duplicates. The first memory of each group of duplicates is kept.
+
+        :param exclude_duplicates: Exclude duplicates based upon Sequence Matching techniques. This can be set to None if that is not desired.
+        :type exclude_duplicates: bool
+        :param exclude_duplicates_ratio: Exclude duplicates based upon Sequence Matching techniques. This can be set to None if that is not desired.
+        :type exclude_duplicates_ratio: float
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
+        :rtype: List[Memory]
+        """
+
+        memories = await self.get(created_after=0, scope_id=scope_id)
+        if exclude_duplicates:
+            memories = deduplicate(memories, exclude_duplicates_ratio or None)
+
+        return memories
+
     async def check_duplicates(self, **kwargs) -> bool:
         """
         Check if a memory is a duplicate.
 
         :param text: The text of the memory.
         :type text: str
-        :param duplicate_ratio: The ratio of the text that must match to be considered a duplicate.
+        :param duplicate_ratio: The ratio of the text that must match to be considered a duplicate. If None, only texts equal up to case and whitespace are duplicates.
         :type duplicate_ratio: float
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
         :rtype: bool
         """
-        memories = await self.get(created_after=0)
-    
-        for m in memories:
-            if m.text == kwargs['text']:
+        scope_id = kwargs.get('scope_id')
+        if scope_id not in self.duplicate_indexes:
+            self.duplicate_indexes[scope_id] = DuplicateIndex(self, scope_id=scope_id)
+            await self.duplicate_indexes[scope_id].sync()
+
+        return self.duplicate_indexes[scope_id].is_duplicate(kwargs['text'], kwargs.get('duplicate_ratio'))
+
+    async def search(self, **kwargs) -> List[Memory]:
+        """
+        Return the memories closest to an encoding by cosine_distance, closest first. Only the encodings of the live
+        rows in scope are read from the memmap, and only the top_k memories are built.
+
+        :param encoding: The encoding to search for.
+        :type encoding: Union[str, bytes]
+        :param top_k: The number of memories to return.
+        :type top_k: int
+        :param created_before: Only search memories created before this snowflake.
+        :type created_before: int
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
+        :rtype: List[Memory]
+        """
+        from shimeji.memory import cosine_distances, decode_encoding, top_k_indices
+
+        live = self._live(kwargs.get('scope_id'))
+        if kwargs.get('created_before') is not None:
+            live &= self._records['created_at'] < kwargs['created_before']
+        rows = np.flatnonzero(live)
+        if len(rows) == 0:
+            return []
+
+        # in created_at order, so that ties resolve as in the other stores
+        rows = rows[np.argsort(self._records['created_at'][rows], kind='stable')]
+        query = decode_encoding(kwargs['encoding'])
+        scores = cosine_distances(query, self._encodings[rows])
+        return [self._to_memory(rows[idx]) for idx in top_k_indices(scores, kwargs.get('top_k', 256))]
+
+class WriteBehind_MemoryStoreProvider(MemoryStoreProvider):
+    """
+    A MemoryStoreProvider which buffers the memories added to another MemoryStoreProvider and writes them in bulk.
+
+    The buffer is written with a single create_many() once flush_size memories are waiting, flush_interval seconds
+    after the first of them was added, or when flush() or close() is called. Buffered memories are returned by every
+    read and passed to attached indexes right away, so local readers see them before they reach the database.
+    Memories still buffered when the process dies are lost, so call close() on shutdown.
+    """
+
+    def __init__(self, **kwargs):
+        """
+        Initialize a WriteBehind_MemoryStoreProvider.
+
+        :param memorystore: The MemoryStoreProvider to write to.
+        :param flush_size: The number of buffered memories which triggers a flush, defaults to 256.
+        :param flush_interval: The number of seconds a memory may stay buffered, defaults to 1.0.
+        """
+        super().__init__(**kwargs)
+
+        if 'memorystore' not in kwargs:
+            raise ValueError('memorystore is required')
+
+        self.memorystore = kwargs['memorystore']
+        self.flush_size = kwargs.get('flush_size', 256)
+        self.flush_interval = kwargs.get('flush_interval', 1.0)
+        self.pending = []
+        # the exception raised by the last timed flush, which runs in the background
+        self.flush_error = None
+        self._lock = None
+        self._timer = None
+
+    async def __aenter__(self) -> 'WriteBehind_MemoryStoreProvider':
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _get_lock(self) -> asyncio.Lock:
+        # created lazily so that it belongs to the running event loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _schedule(self):
+        if self.pending and self._timer is None:
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._timer = None
+        try:
+            await self.flush()
+            self.flush_error = None
+        except Exception as e:
+            # the memories stay buffered and are retried by the next flush
+            self.flush_error = e
+            self._schedule()
+
+    async def flush(self) -> int:
+        """
+        Write every buffered memory to the underlying MemoryStoreProvider.
+
+        :return: The number of memories written.
+        :rtype: int
+        """
+        async with self._get_lock():
+            if self._timer is not None and self._timer is not asyncio.current_task():
+                self._timer.cancel()
+                self._timer = None
+
+            memories = list(self.pending)
+            if memories:
+                await self.memorystore.create_many(memories=memories)
+                # deletes wait for the lock, so during the write memories are only appended and the written ones are still first
+                del self.pending[:len(memories)]
+
+        self._schedule()
+        return len(memories)
+
+    async def close(self):
+        """
+        Stop the flush timer and write every buffered memory.
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _buffered(self, created_after: int = 0, author_id: int = None, scope_id: int = None) -> List[Memory]:
+        memories = [m for m in self.pending if m.created_at > created_after
+            and (author_id is None or m.author_id == author_id)
+            and (scope_id is None or m.scope_id == scope_id)]
+        return sorted(memories, key=lambda m: (m.created_at, m.author_id))
+
+    async def count(self, scope_id: int = None) -> int:
+        """
+        Return the number of memories in the WriteBehind_MemoryStoreProvider, including buffered ones.
+
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
+        :rtype: int
+        """
+        async with self._get_lock():
+            return await self.memorystore.count(scope_id=scope_id) + len(self._buffered(scope_id=scope_id))
+
+    async def get(self, created_after: int = None, scope_id: int = None) -> List[Memory]:
+        """
+        Get a list of memories created after a certain amount of time, in created_at order, including buffered ones.
+
+        :param created_after: The snowflake to get memories after.
+        :type created_after: int
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
+        :rtype: List[Memory]
+        """
+        memories = []
+        async for batch in self.stream(created_after=created_after or 0, scope_id=scope_id):
+            memories.extend(batch)
+        return memories
+
+    async def stream(self, created_after: int = 0, batch_size: int = 1000, author_id: int = None, scope_id: int = None) -> AsyncIterator[List[Memory]]:
+        """
+        Iterate over the memories created after a snowflake in batches, in created_at order. Buffered memories are
+        merged into the batches of the underlying MemoryStoreProvider.
+
+        :param created_after: The snowflake to stream memories after.
+        :type created_after: int
+        :param batch_size: The number of memories in each batch.
+        :type batch_size: int
+        :param author_id: Only stream memories by this author.
+        :type author_id: int
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
+        :rtype: AsyncIterator[List[Memory]]
+        """
+        buffered = self._buffered(created_after or 0, author_id, scope_id)
+        # a memory being flushed can be read from both places
+        keys = {(m.created_at, m.author_id) for m in buffered}
+
+        async for batch in self.memorystore.stream(created_after=created_after, batch_size=batch_size, author_id=author_id, scope_id=scope_id):
+            batch = [m for m in batch if (m.created_at, m.author_id) not in keys]
+            if not batch:
+                continue
+            last = (batch[-1].created_at, batch[-1].author_id)
+            split = 0
+            while split < len(buffered) and (buffered[split].created_at, buffered[split].author_id) <= last:
+                split += 1
+            if split > 0:
+                batch = sorted(batch + buffered[:split], key=lambda m: (m.created_at, m.author_id))
+                buffered = buffered[split:]
+            yield batch
+
+        for start in range(0, len(buffered), batch_size):
+            yield buffered[start:start+batch_size]
+
+    async def create(self, **kwargs) -> Memory:
+        """
+        Buffer a memory to be added to the underlying MemoryStoreProvider.
+
+        :param memory: The memory to add.
+        :type Memory: Memory
+        :rtype: Memory
+        """
+        return (await self.create_many(memories=[kwargs['memory']]))[0]
+
+    async def create_many(self, **kwargs) -> List[Memory]:
+        """
+        Buffer several memories to be added to the underlying MemoryStoreProvider.
+
+        :param memories: The memories to add.
+        :type memories: List[Memory]
+        :rtype: List[Memory]
+        """
+        memories = kwargs['memories']
+        self.pending.extend(memories)
+        for memory_obj in memories:
+            self._index_add(memory_obj)
+
+        if len(self.pending) >= self.flush_size:
+            await self.flush()
+        else:
+            self._schedule()
+        return memories
+
+    async def delete(self, **kwargs):
+        """
+        Delete a memory, either from the buffer or from the underlying MemoryStoreProvider.
+
+        :param memory: The memory to delete.
+        :type Memory: Memory
+        """
+        memory_obj = kwargs['memory']
+        key = (memory_obj.created_at, memory_obj.author_id)
+        async with self._get_lock():
+            buffered = [i for i, m in enumerate(self.pending) if (m.created_at, m.author_id) == key]
+            if buffered:
+                del self.pending[buffered[0]]
+            else:
+                await self.memorystore.delete(memory=memory_obj)
+
+        self._index_remove(memory_obj)
+
+    async def add(self, **kwargs) -> Optional[Memory]:
+        """
+        Create and buffer a memory.
+
+        :param author_id: The ID of the author of the memory.
+        :type author_id: int
+        :param author: The name of the author of the memory.
+        :type author: str
+        :param text: The text of the memory.
+        :type text: str
+        :param encoding_model: The name of the encoding model used to encode the memory.
+        :type encoding_model: str
+        :param encoding: The encoding of the memory, either ASCII85 text or bytes.
+        :type encoding: Union[str, bytes]
+        :param scope_id: The conversation, channel or bot the memory belongs to.
+        :type scope_id: int
+        :param skip_if_duplicate: If True, the memory is not added when a memory with the same text, up to case and whitespace, exists in its scope.
+        :type skip_if_duplicate: bool
+        :return: The memory, or None if it was skipped as a duplicate.
+        :rtype: Memory
+        """
+        memories = await self.add_many(memories=[kwargs], skip_if_duplicate=kwargs.get('skip_if_duplicate'))
+        return memories[0] if memories else None
+
+    async def _exact_duplicates(self, texts: List[str], scope_id: int = None) -> set:
+        buffered = {normalized_text_hash(m.text) for m in self._buffered(scope_id=scope_id)}
+        return (buffered & {normalized_text_hash(text) for text in texts}) | await self.memorystore._exact_duplicates(texts, scope_id)
+
+    async def filter(self, exclude_duplicates: bool = False, exclude_duplicates_ratio: float = 0.8, scope_id: int = None) -> List[Memory]:
+        """
+        Return the memories in created_at order, including buffered ones, optionally without duplicates. The first memory of each group of duplicates is kept.
+
+        :param exclude_duplicates: Exclude duplicates based upon Sequence Matching techniques. This can be set to None if that is not desired.
+        :type exclude_duplicates: bool
+        :param exclude_duplicates_ratio: Exclude duplicates based upon Sequence Matching techniques. This can be set to None if that is not desired.
+        :type exclude_duplicates_ratio: float
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
+        :rtype: List[Memory]
+        """
+        memories = await self.get(created_after=0, scope_id=scope_id)
+        if exclude_duplicates:
+            memories = deduplicate(memories, exclude_duplicates_ratio or None)
+
+        return memories
+
+    async def check_duplicates(self, **kwargs) -> bool:
+        """
+        Check if a memory is a duplicate of a buffered memory or of a memory in the underlying MemoryStoreProvider.
+
+        :param text: The text of the memory.
+        :type text: str
+        :param duplicate_ratio: The ratio of the text that must match to be considered a duplicate. If None, only texts equal up to case and whitespace are duplicates.
+        :type duplicate_ratio: float
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
+        :rtype: bool
+        """
+        text = kwargs['text']
+        duplicate_ratio = kwargs.get('duplicate_ratio')
+        scope_id = kwargs.get('scope_id')
+        digest = normalized_text_hash(text)
+        for memory_obj in self._buffered(scope_id=scope_id):
+            if normalized_text_hash(memory_obj.text) == digest:
                 return True
-            elif SequenceMatcher(None, m.text, kwargs['text']).ratio() > kwargs['duplicate_ratio']:
+            if duplicate_ratio is not None and similar(memory_obj.text, text, duplicate_ratio):
                 return True
-    
-        return False
+
+        return await self.memorystore.check_duplicates(text=text, duplicate_ratio=duplicate_ratio, scope_id=scope_id)
+
+    async def search(self, **kwargs) -> List[Memory]:
+        """
+        Return the memories closest to an encoding by cosine_distance, closest first, including buffered ones.
+
+        :param encoding: The encoding to search for.
+        :type encoding: Union[str, bytes]
+        :param top_k: The number of memories to return.
+        :type top_k: int
+        :param created_before: Only search memories created before this snowflake.
+        :type created_before: int
+        :param scope_id: The conversation, channel or bot to read from. If None, memories from every scope are read.
+        :type scope_id: int
+        :rtype: List[Memory]
+        """
+        from shimeji.memory import cosine_distances, decode_encoding, decode_encodings, top_k_indices
+
+        buffered = self._buffered(scope_id=kwargs.get('scope_id'))
+        if kwargs.get('created_before') is not None:
+            buffered = [m for m in buffered if m.created_at < kwargs['created_before']]
+        stored = await self.memorystore.search(**kwargs)
+        if not buffered:
+            return stored
+
+        keys = {(m.created_at, m.author_id) for m in buffered}
+        candidates = sorted([m for m in stored if (m.created_at, m.author_id) not in keys] + buffered, key=lambda m: (m.created_at, m.author_id))
+        scores = cosine_distances(decode_encoding(kwargs['encoding']), decode_encodings([m.encoding for m in candidates]))
+        return [candidates[idx] for idx in top_k_indices(scores, kwargs.get('top_k', 256))]
@@ -1,12 +1,20 @@
 import aiohttp
+import asyncio
 from typing import Optional, List, Any
 from pydantic import BaseModel
 from .util import tokenizer
-import requests
+from .batching import MicroBatcher, SingleFlight
+from .scheduler import RequestScheduler, PRIORITY_RESPOND, PRIORITY_SHOULD_RESPOND, PRIORITY_HIDDEN, PRIORITY_IMAGE_LABEL
+from .background import background_loop
 import json
 import copy
+import math
+import random
 
 
+# the sampling temperature of the should_respond probe
+SHOULD_RESPOND_TEMP = 0.25
+
 class ModelGenArgs(BaseModel):
     max_length: int
     max_time: Optional[float] = None
@@ -87,38 +95,177 @@ class ModelProvider:
 
         :param endpoint_url: The URL of the endpoint.
         :type endpoint_url: str
+        :param embedding_cache: An EmbeddingCache for the results of hidden_async.
+        :type embedding_cache: EmbeddingCache
+        :param pool_size: The maximum number of open connections, defaults to 100.
+        :type pool_size: int
+        :param pool_size_per_host: The maximum number of open connections to one host, defaults to 32. 0 means no limit.
+        :type pool_size_per_host: int
+        :param keepalive_timeout: The number of seconds an idle connection is kept open, defaults to 60.
+        :type keepalive_timeout: float
+        :param timeout: The number of seconds a request may take in total, defaults to 300.
+        :type timeout: float
+        :param connect_timeout: The number of seconds to wait for a connection, defaults to 10.
+        :type connect_timeout: float
+        :param background_loop: The BackgroundLoop the synchronous methods run on, defaults to the one shared by all ModelProviders.
+        :type background_loop: BackgroundLoop
+        :param coalesce: Whether concurrent generate_async calls with identical requests share one request to the endpoint, defaults to False.
+        :type coalesce: bool
+        :param cache_ttl: The number of seconds coalesced results of low temperature requests are reused for, defaults to 0.
+        :type cache_ttl: float
+        :param cache_max_temp: The highest temperature whose results are reused, defaults to 0.3.
+        :type cache_max_temp: float
+        :param scheduler: The RequestScheduler that orders and limits requests to the endpoint. If None, one is created from the following kwargs.
+        :type scheduler: RequestScheduler
+        :param concurrency_limits: The number of concurrent requests allowed to each endpoint ('generate', 'hidden' and 'image_label'). Endpoints missing from it are unlimited.
+        :type concurrency_limits: Dict[str, int]
+        :param total_concurrency: The number of concurrent requests allowed across all endpoints. If None, it is unlimited.
+        :type total_concurrency: int
+        :param rate_limits: The number of requests per second allowed to each endpoint.
+        :type rate_limits: Dict[str, float]
         """
         self.endpoint_url = endpoint_url
         self.kwargs = kwargs
+        self.embedding_cache = kwargs.get('embedding_cache')
+        self.background = kwargs.get('background_loop') or background_loop()
+        self.scheduler = kwargs.get('scheduler') or RequestScheduler(
+            limits=kwargs.get('concurrency_limits'),
+            total_limit=kwargs.get('total_concurrency'),
+            rates=kwargs.get('rate_limits')
+        )
+        self.single_flight = None
+        if kwargs.get('coalesce'):
+            self.single_flight = SingleFlight(ttl=kwargs.get('cache_ttl', 0.0))
+        # aiohttp sessions are bound to the event loop they were created in, so there is one per loop
+        self._sessions = {}
         if 'args' not in kwargs:
             raise Exception('default args is required')
         self.auth()
+
+    def session(self) -> aiohttp.ClientSession:
+        """Return the ModelProvider's HTTP session for the running event loop, creating it on first use.
+
+        The session keeps connections alive between requests, so only the first request to a host pays for
+        connection setup.
+
+        :return: The session.
+        :rtype: aiohttp.ClientSession
+        """
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            # forget sessions of loops which no longer run
+            self._sessions = {l: s for l, s in self._sessions.items() if not l.is_closed()}
+            connector = aiohttp.TCPConnector(
+                limit=self.kwargs.get('pool_size', 100),
+                limit_per_host=self.kwargs.get('pool_size_per_host', 32),
+                keepalive_timeout=self.kwargs.get('keepalive_timeout', 60)
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=self.kwargs.get('timeout', 300),
+                connect=self.kwargs.get('connect_timeout', 10)
+            )
+            session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._sessions[loop] = session
+        return session
+
+    def run_sync(self, coroutine):
+        """Run a coroutine on the ModelProvider's background loop and wait for its result.
+
+        :param coroutine: The coroutine to run, such as one returned by generate_async.
+        :type coroutine: Awaitable
+        :return: The result of the coroutine.
+        :rtype: Any
+        """
+        return self.background.run(coroutine)
+
+    async def coalesce(self, payload, temp, call):
+        """Make a generation request, or wait for an identical one that is already in flight if coalesce is enabled.
+
+        :param payload: The JSON payload identifying the request, including the endpoint.
+        :type payload: Any
+        :param temp: The sampling temperature of the request. Results are only reused after the request finished if it is at most cache_max_temp.
+        :type temp: float
+        :param call: A coroutine function making the request.
+        :type call: Callable[[], Awaitable[str]]
+        :return: The result of the request.
+        :rtype: str
+        """
+        if self.single_flight is None:
+            return await call()
+        cacheable = temp is not None and temp <= self.kwargs.get('cache_max_temp', 0.3)
+        return await self.single_flight.run(SingleFlight.key(payload), call, cacheable=cacheable)
+
+    async def aclose(self):
+        """Close the ModelProvider's HTTP sessions, including the one the synchronous methods use.
+        """
+        current = asyncio.get_running_loop()
+        sessions, self._sessions = self._sessions, {}
+        for loop, session in sessions.items():
+            if session.closed:
+                continue
+            if loop is current:
+                await session.close()
+            elif loop.is_running():
+                await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(session.close(), loop))
+
+    def close(self):
+        """Close the ModelProvider's HTTP sessions from synchronous code.
+        """
+        self.run_sync(self.aclose())
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
     
     def auth(self):
-        """Authenticate with the ModelProvider's endpoint.
+        """Authenticate with the ModelProvider's endpoint. By default this runs auth_async on the background loop.
+
+        :raises NotImplementedError: If the authentication method is not implemented.
+        """
+        self.run_sync(self.auth_async())
+
+    async def auth_async(self):
+        """Authenticate with the ModelProvider's endpoint asynchronously.
 
         :raises NotImplementedError: If the authentication method is not implemented.
         """
         raise NotImplementedError('auth method is required')
 
     def generate(self, args):
-        """Generate a response from the ModelProvider's endpoint.
+        """Generate a response from the ModelProvider's endpoint. This runs generate_async on the background loop.
         
         :param args: The arguments to pass to the endpoint.
         :type args: dict
         :raises NotImplementedError: If the generate method is not implemented.
         """
-        raise NotImplementedError('generate method is required')
+        return self.run_sync(self.generate_async(args))
     
-    async def generate_async(self, args):
+    async def generate_async(self, args, priority=PRIORITY_RESPOND):
         """Generate a response from the ModelProvider's endpoint asynchronously.
         
         :param args: The arguments to pass to the endpoint.
         :type args: dict
+        :param priority: The scheduler priority class of the request, defaults to PRIORITY_RESPOND.
+        :type priority: int
         :raises NotImplementedError: If the generate method is not implemented.
         """
         raise NotImplementedError('generate method is required')
     
+    async def generate_stream_async(self, args, priority=PRIORITY_RESPOND):
+        """Generate a response from the ModelProvider's endpoint, yielding the text as it is generated. By default the whole response is yielded at once.
+
+        :param args: The arguments to pass to the endpoint.
+        :type args: dict
+        :param priority: The scheduler priority class of the request, defaults to PRIORITY_RESPOND.
+        :type priority: int
+        :return: An async iterator over the pieces of the response.
+        :rtype: AsyncIterator[str]
+        """
+        yield await self.generate_async(args, priority)
+
     async def hidden_async(self, model, text, layer):
         """Fetch a layer's hidden states from text.
         
@@ -146,7 +293,7 @@ class ModelProvider:
         raise NotImplementedError('image_label_async method is required')
 
     def should_respond(self, context, name):
-        """Determine if the ModelProvider predicts that the name should respond to the given context.
+        """Determine if the ModelProvider predicts that the name should respond to the given context. This runs should_respond_async on the background loop.
 
         :param context: The context to use.
         :type context: str
@@ -154,9 +301,9 @@ class ModelProvider:
         :type name: str
         :raises NotImplementedError: If the should_respond method is not implemented.
         """
-        raise NotImplementedError('should_respond method is required')
+        return self.run_sync(self.should_respond_async(context, name))
     
-    def should_respond_async(self, context, name):
+    async def should_respond_async(self, context, name):
         """Determine if the ModelProvider predicts that the name should respond to the given context asynchronously.
 
         :param context: The context to use.
@@ -168,15 +315,15 @@ class ModelProvider:
         raise NotImplementedError('should_respond method is required')
 
     def response(self, context):
-        """Generate a response from the ModelProvider's endpoint.
+        """Generate a response from the ModelProvider's endpoint. This runs response_async on the background loop.
             
         :param context: The context to use.
         :type context: str
         :raises NotImplementedError: If the response method is not implemented.
         """
-        raise NotImplementedError('response method is required')
+        return self.run_sync(self.response_async(context))
     
-    def response_async(self, context):
+    async def response_async(self, context):
         """Generate a response from the ModelProvider's endpoint asynchronously.
             
         :param context: The context to use.
@@ -185,19 +332,109 @@ class ModelProvider:
         """
         raise NotImplementedError('response method is required')
 
+    async def response_stream_async(self, context, top_logprobs=None):
+        """Generate a response from the ModelProvider's endpoint, yielding the text as it is generated. By default the whole response is yielded at once.
+
+        :param context: The context to use.
+        :type context: str
+        :param top_logprobs: If a list, the endpoint is asked for the top logprobs of each generated token, and those it returns are appended to it as {token: logprob} dicts. By default none are returned.
+        :type top_logprobs: list
+        :return: An async iterator over the pieces of the response.
+        :rtype: AsyncIterator[str]
+        """
+        yield await self.response_async(context)
+
+    async def fused_response_async(self, context, name):
+        """Decide whether the name should respond and generate its response in a single generation.
+
+        The line after the context is generated with response_stream_async, asking for the top logprobs of its tokens.
+        The decision is sampled from the first token's logprobs at the should_respond temperature, SHOULD_RESPOND_TEMP,
+        so the name responds about as often as with should_respond_async. If it should not respond, the stream is closed
+        so that the rest is never generated. If it should but the line was sampled for another speaker, the response is
+        generated with response_async after all, which costs a second request. Endpoints which return no logprobs are
+        decided from the generated text instead, that is at the response's temperature.
+
+        The saving depends on streaming. With a provider whose response_stream_async yields the whole response at once,
+        the full line is generated before the decision is made, so a line for another speaker costs a whole response
+        instead of the few tokens of should_respond_async.
+
+        The context should end where the next speaker's name would go, as it does for should_respond_async.
+
+        :param context: The context to use.
+        :type context: str
+        :param name: The name to check.
+        :type name: str
+        :return: The response after the name, or None if the name should not respond.
+        :rtype: Optional[str]
+        """
+        generated = ''
+        top_logprobs = []
+        decision = None
+        stream = self.response_stream_async(context, top_logprobs=top_logprobs)
+        try:
+            async for output in stream:
+                generated += output
+                if decision is None and top_logprobs:
+                    decision = random.random() < name_probability(top_logprobs[0], name, SHOULD_RESPOND_TEMP)
+                    if not decision:
+                        return None
+                if not (generated.startswith(name) or name.startswith(generated)):
+                    break
+        finally:
+            await stream.aclose()
+
+        if not generated.startswith(name):
+            if decision:
+                return await self.response_async(f'{context}{name}:')
+            return None
+        response = generated[len(name):]
+        return response[1:] if response.startswith(':') else response
+
+def name_probability(logprobs: dict, name: str, temp: float) -> float:
+    """
+    The probability that a token starting the name is sampled at a temperature, given the top logprobs of the token.
+
+    :param logprobs: The top logprobs of the token, by token text.
+    :type logprobs: dict
+    :param name: The name.
+    :type name: str
+    :param temp: The sampling temperature.
+    :type temp: float
+    :rtype: float
+    """
+    if not logprobs:
+        return 0.0
+    top = max(logprobs.values())
+    weights = {token: math.exp((logprob - top) / temp) for token, logprob in logprobs.items()}
+    matching = sum(weight for token, weight in weights.items() if token and (name.startswith(token) or token.startswith(name)))
+    return matching / sum(weights.values())
+
 class Sukima_ModelProvider(ModelProvider):
     def __init__(self, endpoint_url: str, **kwargs):
         """Constructor for Sukima_ModelProvider.
 
         :param endpoint_url: The URL for the Sukima endpoint.
         :type endpoint_url: str
+        :param batch_hidden: Whether to send concurrent hidden_async calls for the same model and layer as one request, defaults to False.
+        :type batch_hidden: bool
+        :param batch_size: The largest number of texts in a batched hidden states request, defaults to 32.
+        :type batch_size: int
+        :param batch_delay: The longest time in seconds a hidden_async call waits for its batch to fill, defaults to 0.005.
+        :type batch_delay: float
         """
 
         super().__init__(endpoint_url, **kwargs)
-        self.auth()
+
+        self.hidden_batcher = None
+        if kwargs.get('batch_hidden'):
+            self.hidden_batcher = MicroBatcher(
+                lambda key, texts: self._fetch_hidden(key[0], texts, key[1]),
+                max_size=kwargs.get('batch_size', 32),
+                max_delay=kwargs.get('batch_delay', 0.005)
+            )
     
-    def auth(self):
-        """Authenticate with the Sukima endpoint.
+    async def auth_async(self):
+        """Authenticate with the Sukima endpoint asynchronously.
 
         :raises Exception: If the authentication fails.
         """
@@ -205,14 +442,16 @@ class Sukima_ModelProvider(ModelProvider):
         if 'username' not in self.kwargs and 'password' not in self.kwargs:
             raise Exception('username, password, and or token are not in kwargs')
         
+        session = self.session()
         try:
-            r = requests.post(f'{self.endpoint_url}/api/v1/users/token', data={'username': self.kwargs['username'], 'password': self.kwargs['password']})
+            async with session.post(f'{self.endpoint_url}/api/v1/users/token', data={'username': self.kwargs['username'], 'password': self.kwargs['password']}) as resp:
+                if resp.status == 200:
+                    js = await resp.json()
+                    self.token = js['access_token']
+                else:
+                    raise Exception(f'Could not authenticate with Sukima. Error: {await resp.text()}')
         except Exception as e:
             raise e
-        if r.status_code == 200:
-            self.token = r.json()['access_token']
-        else:
-            raise Exception(f'Could not authenticate with Sukima. Error: {r.text}')
         
     def conv_listobj_to_listdict(self, list_objects): 
         """Convert the elements of a list to a dictionary for JSON compatability.
@@ -231,17 +470,8 @@ class Sukima_ModelProvider(ModelProvider):
         else:
             return list_objects
     
-    def generate(self, args: ModelGenRequest):
-        """Generate a response from the Sukima endpoint.
-        
-        :param args: The arguments to pass to the endpoint.
-        :type args: dict
-        :return: The response from the endpoint.
-        :rtype: str
-        :raises Exception: If the request fails.
-        """
-
-        args = {
+    def _request_args(self, args: ModelGenRequest) -> dict:
+        return {
             'model': args.model,
             'prompt': args.prompt,
             'sample_args': {
@@ -255,7 +485,7 @@ class Sukima_ModelProvider(ModelProvider):
                 'rep_p_range': args.sample_args.rep_p_range,
                 'rep_p_slope': args.sample_args.rep_p_slope,
                 'bad_words': args.sample_args.bad_words,
-                'logit_biases': self.conv_listobj_to_listdict(args.sample_args.logit_biases)
+                'logit_biases': self.conv_listobj_to_listdict(args.sample_args.logit_biases)  
             },
             'gen_args': {
                 'max_length': args.gen_args.max_length,
@@ -266,51 +496,25 @@ class Sukima_ModelProvider(ModelProvider):
                 'best_of': args.gen_args.best_of
             }
         }
-        try:
-            r = requests.post(f'{self.endpoint_url}/api/v1/models/generate', data=json.dumps(args), headers={'Authorization': f'Bearer {self.token}'})
-        except Exception as e:
-            raise e
-        if r.status_code == 200:
-            return r.json()['output'][len(args['prompt']):]
-        else:
-            raise Exception(f'Could not generate text with Sukima. Error: {r.json()}')
-    
-    async def generate_async(self, args: ModelGenRequest):
+
+    async def generate_async(self, args: ModelGenRequest, priority: int = PRIORITY_RESPOND):
         """Generate a response from the Sukima endpoint asynchronously.
         
         :param args: The arguments to pass to the endpoint.
         :type args: dict
+        :param priority: The scheduler priority class of the request, defaults to PRIORITY_RESPOND.
+        :type priority: int
         :return: The response from the endpoint.
         :rtype: str
         :raises Exception: If the request fails.
         """ 
   
-        args = {
-            'model': args.model,
-            'prompt': args.prompt,
-            'sample_args': {
-                'temp': args.sample_args.temp,
-                'top_p': args.sample_args.top_p,
-                'top_a': args.sample_args.top_a,
-                'top_k': args.sample_args.top_k,
-                'typical_p': args.sample_args.typical_p,
-                'tfs': args.sample_args.tfs,
-                'rep_p': args.sample_args.rep_p,
-                'rep_p_range': args.sample_args.rep_p_range,
-                'rep_p_slope': args.sample_args.rep_p_slope,
-                'bad_words': args.sample_args.bad_words,
-                'logit_biases': self.conv_listobj_to_listdict(args.sample_args.logit_biases)  
-            },
-            'gen_args': {
-                'max_length': args.gen_args.max_length,
-                'max_time': args.gen_args.max_time,
-                'min_length': args.gen_args.min_length,
-                'eos_token_id': args.gen_args.eos_token_id,
-                'logprobs': args.gen_args.logprobs,
-                'best_of': args.gen_args.best_of
-            }
-        }
-        async with aiohttp.ClientSession() as session:
+        args = self._request_args(args)
+        return await self.coalesce(['generate', args], args['sample_args']['temp'], lambda: self._generate(args, priority))
+
+    async def _generate(self, args: dict, priority: int) -> str:
+        async with self.scheduler.slot('generate', priority):
+            session = self.session()
             try:
                 async with session.post(f'{self.endpoint_url}/api/v1/models/generate', json=args, headers={'Authorization': f'Bearer {self.token}'}) as resp:
                     if resp.status == 200:
@@ -321,6 +525,52 @@ class Sukima_ModelProvider(ModelProvider):
             except Exception as e:
                 raise e
 
+    async def generate_stream_async(self, args: ModelGenRequest, priority: int = PRIORITY_RESPOND, top_logprobs: list = None):
+        """Generate a response from the Sukima endpoint, yielding the text as it is generated.
+
+        The request asks for server-sent events, each carrying the newly generated text as {"output": "..."} and
+        ending with [DONE]. An endpoint that does not stream answers with plain JSON, whose output is yielded at once.
+        When args.gen_args.logprobs is set, events may also carry "logprobs", a list with a {token: logprob} dict of
+        the top logprobs of each new token.
+
+        :param args: The arguments to pass to the endpoint.
+        :type args: dict
+        :param priority: The scheduler priority class of the request, defaults to PRIORITY_RESPOND.
+        :type priority: int
+        :param top_logprobs: If a list, the logprobs returned by the endpoint are appended to it.
+        :type top_logprobs: list
+        :return: An async iterator over the pieces of the response.
+        :rtype: AsyncIterator[str]
+        :raises Exception: If the request fails.
+        """
+
+        args = self._request_args(args)
+        args['stream'] = True
+        async with self.scheduler.slot('generate', priority):
+            session = self.session()
+            async with session.post(f'{self.endpoint_url}/api/v1/models/generate', json=args, headers={'Authorization': f'Bearer {self.token}', 'Accept': 'text/event-stream'}) as resp:
+                if resp.status != 200:
+                    raise Exception(f'Could not generate response. Error: {await resp.text()}')
+                if resp.content_type != 'text/event-stream':
+                    js = await resp.json()
+                    if top_logprobs is not None:
+                        top_logprobs.extend(js.get('logprobs') or [])
+                    yield js['output'][len(args['prompt']):]
+                    return
+
+                async for line in resp.content:
+                    line = line.decode('utf-8').rstrip('\r\n')
+                    if not line.startswith('data:'):
+                        continue
+                    data = line[5:].strip()
+                    if data == '[DONE]':
+                        return
+                    js = json.loads(data)
+                    if top_logprobs is not None:
+                        top_logprobs.extend(js.get('logprobs') or [])
+                    if js['output']:
+                        yield js['output']
+
     async def hidden_async(self, model, text, layer):
         """Fetch a layer's hidden states from text.
 
@@ -332,16 +582,64 @@ class Sukima_ModelProvider(ModelProvider):
         :type layer: int
         """
 
-        async with aiohttp.ClientSession() as session:
+        if self.embedding_cache is not None:
+            hidden = self.embedding_cache.get(model, layer, text)
+            if hidden is not None:
+                return hidden
+
+        if self.hidden_batcher is not None:
+            return await self.hidden_batcher.submit((model, layer), text)
+
+        async with self.scheduler.slot('hidden', PRIORITY_HIDDEN):
+            session = self.session()
             try:
                 async with session.post(f'{self.endpoint_url}/api/v1/models/hidden', json={'model': model, 'prompt': text, 'layers': [layer]}, headers={'Authorization': f'Bearer {self.token}'}) as resp:
                     if resp.status == 200:
-                        return (await resp.json())[f'{layer}'][0]
+                        hidden = (await resp.json())[f'{layer}'][0]
+                        if self.embedding_cache is not None:
+                            self.embedding_cache.put(model, layer, text, hidden)
+                        return hidden
                     else:
                         raise Exception(f'Could not fetch hidden states. Error: {await resp.text()}')
             except Exception as e:
                 raise e
 
+    async def hidden_batch_async(self, model, texts, layer):
+        """Fetch a layer's hidden states for several texts with a single request.
+
+        :param model: The model to extract hidden states from.
+        :type model: str
+        :param texts: The texts to use.
+        :type texts: list
+        :param layer: The layer to fetch the hidden states from.
+        :type layer: int
+        :return: The hidden states of each text, in the order of texts.
+        :rtype: list
+        """
+
+        hidden = [None] * len(texts)
+        if self.embedding_cache is not None:
+            hidden = [self.embedding_cache.get(model, layer, text) for text in texts]
+        missing = [text for text, states in zip(texts, hidden) if states is None]
+        if missing:
+            fetched = iter(await self._fetch_hidden(model, missing, layer))
+            hidden = [states if states is not None else next(fetched) for states in hidden]
+        return hidden
+
+    async def _fetch_hidden(self, model, texts, layer):
+        # the endpoint takes a list of prompts and returns the hidden states of each, repeated texts are sent once
+        unique = list(dict.fromkeys(texts))
+        async with self.scheduler.slot('hidden', PRIORITY_HIDDEN):
+            session = self.session()
+            async with session.post(f'{self.endpoint_url}/api/v1/models/hidden', json={'model': model, 'prompt': unique, 'layers': [layer]}, headers={'Authorization': f'Bearer {self.token}'}) as resp:
+                if resp.status != 200:
+                    raise Exception(f'Could not fetch hidden states. Error: {await resp.text()}')
+                hidden = dict(zip(unique, (await resp.json())[f'{layer}']))
+
+        if self.embedding_cache is not None:
+            self.embedding_cache.put_many(model, layer, list(hidden.keys()), list(hidden.values()))
+        return [hidden[text] for text in texts]
+
     async def image_label_async(self, model, url, labels):
         """Classify an image with labels (CLIP).
 
@@ -353,7 +651,8 @@ class Sukima_ModelProvider(ModelProvider):
         :type labels: list
         """
 
-        async with aiohttp.ClientSession() as session:
+        async with self.scheduler.slot('image_label', PRIORITY_IMAGE_LABEL):
+            session = self.session()
             try:
                 async with session.post(f'{self.endpoint_url}/api/v1/models/classify', json={'model': model, 'prompt': url, 'labels': labels}, headers={'Authorization': f'Bearer {self.token}'}) as resp:
                     if resp.status == 200:
@@ -363,39 +662,6 @@ class Sukima_ModelProvider(ModelProvider):
             except Exception as e:
                 raise e
             
-    def should_respond(self, context, name):
-        """Determine if the Sukima endpoint predicts that the name should respond to the given context.
-
-        :param context: The context to use.
-        :type context: str
-        :param name: The name to check.
-        :type name: str
-        :return: Whether or not the name should respond to the given context.
-        :rtype: bool
-        """
-
-        phrase_bias = ModelPhraseBiasArgs
-        phrase_bias.sequences = [name]
-        phrase_bias.bias = 1.5
-        phrase_bias.ensure_sequence_finish = True
-        phrase_bias.generate_once = True
-
-        args = copy.deepcopy(self.kwargs['args'])
-        args.prompt = context
-        args.gen_args.max_length = 10
-        args.gen_args.eos_token_id = 25
-        args.gen_args.best_of = None
-        args.sample_args.temp = 0.25
-        args.sample_args.rep_p = None
-        args.sample_args.rep_p_range = None
-        args.sample_args.rep_p_slope = None
-        args.sample_args.phrase_biases = phrase_bias
-        response = self.generate(args)
-        if name in response:
-            return True
-        else:
-            return False
-
     async def should_respond_async(self, context, name):
         """Determine if the Sukima endpoint predicts that the name should respond to the given context asynchronously.
 
@@ -417,19 +683,19 @@ class Sukima_ModelProvider(ModelProvider):
         args.gen_args.max_length = 10
         args.gen_args.eos_token_id = 25
         args.gen_args.best_of = None
-        args.sample_args.temp = 0.25
+        args.sample_args.temp = SHOULD_RESPOND_TEMP
         args.sample_args.rep_p = None
         args.sample_args.rep_p_range = None
         args.sample_args.rep_p_slope = None
         args.sample_args.phrase_biases = phrase_bias
-        response = await self.generate_async(args)
+        response = await self.generate_async(args, PRIORITY_SHOULD_RESPOND)
         if response.startswith(name):
             return True
         else:
             return False
 
-    def response(self, context):
-        """Generate a response from the Sukima endpoint.
+    async def response_async(self, context):
+        """Generate a response from the Sukima endpoint asynchronously.
 
         :param context: The context to use.
         :type context: str
@@ -440,23 +706,27 @@ class Sukima_ModelProvider(ModelProvider):
         args.prompt = context
         args.gen_args.eos_token_id = 198
         args.gen_args.min_length = 1
-        response = self.generate(args)
+        response = await self.generate_async(args)
         return response
 
-    async def response_async(self, context):
-        """Generate a response from the Sukima endpoint asynchronously.
+    async def response_stream_async(self, context, top_logprobs=None):
+        """Generate a response from the Sukima endpoint, yielding the text as it is generated.
 
         :param context: The context to use.
         :type context: str
-        :return: The response from the endpoint.
-        :rtype: str
+        :param top_logprobs: If a list, the endpoint is asked for the top 10 logprobs of each generated token, and those it returns are appended to it.
+        :type top_logprobs: list
+        :return: An async iterator over the pieces of the response.
+        :rtype: AsyncIterator[str]
         """
-        args = self.kwargs['args']
+        args = copy.deepcopy(self.kwargs['args'])
         args.prompt = context
         args.gen_args.eos_token_id = 198
         args.gen_args.min_length = 1
-        response = await self.generate_async(args)
-        return response
+        if top_logprobs is not None:
+            args.gen_args.logprobs = 10
+        async for output in self.generate_stream_async(args, top_logprobs=top_logprobs):
+            yield output
 
 class TextSynth_ModelProvider(ModelProvider):
     def __init__(self, endpoint_url: str = 'https://api.textsynth.com', **kwargs):
@@ -468,7 +738,6 @@ class TextSynth_ModelProvider(ModelProvider):
         :type token: str
         """
         super().__init__(endpoint_url, **kwargs)
-        self.auth()
     
     def auth(self):
         """Authenticate with the TextSynth endpoint.
@@ -479,11 +748,13 @@ class TextSynth_ModelProvider(ModelProvider):
             raise Exception('token is not in kwargs')
         self.token = self.kwargs['token']
     
-    async def generate_async(self, args: ModelGenRequest) -> str:
+    async def generate_async(self, args: ModelGenRequest, priority: int = PRIORITY_RESPOND) -> str:
         """Generate a response from the TextSynth endpoint.
         
         :param args: The arguments to pass to the endpoint.
         :type args: dict
+        :param priority: The scheduler priority class of the request, defaults to PRIORITY_RESPOND.
+        :type priority: int
         :return: The response from the endpoint.
         :rtype: str
         :raises Exception: If the request fails.
@@ -497,7 +768,11 @@ class TextSynth_ModelProvider(ModelProvider):
             'top_k': args.sample_args.top_k,
             'stop': tokenizer.decode(args.gen_args.eos_token_id)
         }
-        async with aiohttp.ClientSession() as session:
+        return await self.coalesce(['completions', model, args], args['temperature'], lambda: self._generate(model, args, priority))
+
+    async def _generate(self, model: str, args: dict, priority: int) -> str:
+        async with self.scheduler.slot('generate', priority):
+            session = self.session()
             try:
                 async with session.post(f'{self.endpoint_url}/v1/engines/{model}/completions', json=args, headers={'Authorization': f'Bearer {self.token}'}) as resp:
                     if resp.status == 200:
@@ -521,8 +796,8 @@ class TextSynth_ModelProvider(ModelProvider):
         args = copy.deepcopy(self.kwargs['args'])
         args.prompt = context
         args.gen_args.max_length = 10
-        args.sample_args.temp = 0.25
-        response = await self.generate_async(args)
+        args.sample_args.temp = SHOULD_RESPOND_TEMP
+        response = await self.generate_async(args, PRIORITY_SHOULD_RESPOND)
         if response.startswith(name):
             return True
         else:
@@ -12,7 +12,17 @@ class Postprocessor:
         """
         raise NotImplementedError(f'{self.__class__} is an abstract class')
 
-class NewlinePrunerPostprocessor:
+    def stable_prefix(self, context: str) -> str:
+        """Process the part of a response generated so far, returning only the part of the result that more text cannot change. It must be a prefix of the result for the whole response. By default nothing is stable until the response is complete.
+
+        :param context: The response generated so far.
+        :type context: str
+        :return: The processed text that is final.
+        :rtype: str
+        """
+        return ''
+
+class NewlinePrunerPostprocessor(Postprocessor):
     """Postprocessor that removes newlines.
     """
     def __call__(self, context: str) -> str:
@@ -23,4 +33,14 @@ class NewlinePrunerPostprocessor:
         :return: The processed context which has no trailing newlines.
         :rtype: str
         """
+        return context.rstrip('\n')
+
+    def stable_prefix(self, context: str) -> str:
+        """Process the part of a response generated so far.
+
+        :param context: The response generated so far.
+        :type context: str
+        :return: The response without its trailing newlines, which later text may keep.
+        :rtype: str
+        """
         return context.rstrip('\n')
\ No newline at end of file
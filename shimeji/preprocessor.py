@@ -1,5 +1,6 @@
+import asyncio
 from .util import *
-from .memory import memory_context, memory_sort
+from .memory import MemoryIndex
 from .memorystore_provider import MemoryStoreProvider
 
 class Preprocessor:
@@ -19,28 +20,116 @@ class Preprocessor:
         """
         raise NotImplementedError(f'{self.__class__} is an abstract class')
 
+    async def call_async(self, context: str, is_respond: bool, name: str) -> str:
+        """Process the given context asynchronously before the ModelProvider is called. By default this calls __call__.
+
+        :param context: The context to preprocess.
+        :type context: str
+        :param is_respond: Whether the context is being built for a chatbot response.
+        :type is_respond: bool
+        :param name: The name of the chatbot.
+        :type name: str
+        :return: The processed context.
+        :rtype: str
+        """
+        return self(context, is_respond=is_respond, name=name)
+
+    def prefetch(self, name: str):
+        """Start any slow work for the next response in the background, such as while should_respond is waiting for the model. By default this does nothing.
+
+        :param name: The name of the chatbot.
+        :type name: str
+        """
+        pass
+
 class MemoryPreprocessor(Preprocessor):
     """A Preprocessor that builds the long-term memory context."""
-    def __init__(self, memorystore: MemoryStoreProvider, short_term: int, long_term: int):
+    def __init__(self, memorystore: MemoryStoreProvider, short_term: int, long_term: int, index: MemoryIndex = None, use_for_should_respond: bool = False, scope_id: int = None, token_budget: int = None, scorer=None):
         """Constructor for MemoryPreprocessor which uses the most recent memory as the present memory to build the long-term memory context.
 
         :param memorystore: The memory store to use.
         :type memorystore: MemoryStoreProvider
-        :param short_term: The number of short-term memories to use which will be left out of the long-term memory context.
+        :param short_term: The number of short-term memories to use which will be left out of the long-term memory context. If None, only the present memory is left out.
         :type short_term: int
         :param long_term: The number of long-term memories to use.
         :type long_term: int
+        :param index: The MemoryIndex to retrieve memories from. If None, a new one is attached to the memory store.
+        :type index: MemoryIndex
+        :param use_for_should_respond: Whether to add the long-term memory context when deciding whether to respond. If False, retrieval for the response is started in the background instead.
+        :type use_for_should_respond: bool
+        :param scope_id: The conversation, channel or bot whose memories are used when a new index is created.
+        :type scope_id: int
+        :param token_budget: If set, the long-term memory context is packed into this many tokens, with the memories in chronological order.
+        :type token_budget: int
+        :param scorer: The shimeji.scoring.Scorer used to rank memories, such as a WeightedScorer. Defaults to cosine_distance.
+        :type scorer: Scorer
         """
         self.memorystore = memorystore
         self.short_term = short_term
         self.long_term = long_term
+        self.index = index if index is not None else MemoryIndex(memorystore, scope_id=scope_id)
+        self.use_for_should_respond = use_for_should_respond
+        self.token_budget = token_budget
+        self.scorer = scorer
+        self._prefetched = None
+        self._cached = None
+
+    def _long_term_context(self) -> str:
+        now = self.index.latest()
+        if now is None:
+            return ''
+        key = (now.created_at, now.author_id)
+        if self._cached is None or self._cached[0] != key:
+            # now is the newest memory, so it is excluded along with the short-term memories
+            short_term = 1 if self.short_term is None else self.short_term + 1
+            self._cached = (key, self.index.context(now, short_term=short_term, long_term=self.long_term, token_budget=self.token_budget, scorer=self.scorer))
+        return self._cached[1]
+
+    async def _fetch(self) -> str:
+        # only the memories newer than the index's cursor are fetched
+        await self.index.sync()
+        return self._long_term_context()
+
+    def prefetch(self, name: str):
+        """Fetch new memories and retrieve the long-term memory context in the background.
+
+        :param name: The name of the chatbot.
+        :type name: str
+        """
+        if self._prefetched is not None and self._prefetched.done():
+            # a prefetch that was never used is stale, retrieve its exception so it is not reported
+            if not self._prefetched.cancelled():
+                self._prefetched.exception()
+            self._prefetched = None
+        if self._prefetched is None:
+            self._prefetched = asyncio.ensure_future(self._fetch())
     
     def __call__(self, context: str, is_respond: bool, name: str) -> str:
-        memories = self.memorystore.get(created_after=0)
-        now = memories[-1]
-        memories.remove(now)
-        long_term_context = memory_context(now, memories, short_term=self.short_term, long_term=self.long_term)
-        return long_term_context + context
+        """Add the long-term memory context using the memories already in the index, without fetching new ones.
+
+        The index must have been synced with the memory store, by call_async, prefetch or MemoryIndex.sync, or it would
+        silently miss every memory that was stored before it was created.
+        """
+        if not is_respond and not self.use_for_should_respond:
+            return context
+        if self.index.memorystore is not None and not self.index.synced:
+            raise RuntimeError('the memory index was never synced with the memory store, use call_async or await index.sync() first')
+        return self._long_term_context() + context
+
+    async def call_async(self, context: str, is_respond: bool, name: str) -> str:
+        """Fetch new memories and add the long-term memory context, using the prefetched context if there is one.
+        """
+        if not is_respond and not self.use_for_should_respond:
+            self.prefetch(name)
+            return context
+
+        if self._prefetched is not None:
+            prefetched, self._prefetched = self._prefetched, None
+            await prefetched
+            # memories added locally since the prefetch are already in the index
+            return self._long_term_context() + context
+
+        return await self._fetch() + context
 
 class ContextPreprocessor(Preprocessor):
     """A Preprocessor that builds a context from a list of ContextEntry objects."""
@@ -140,7 +229,7 @@ class ContextPreprocessor(Preprocessor):
                     activated_entries.append(i)
             if i.insertion_position > 0 or i.insertion_position < 0:
                 if i.reserved_tokens == 0:
-                    i.reserved_tokens = len(tokenizer.encode(i.text))
+                    i.reserved_tokens = count_text_tokens(i.text)
         
         activated_entries = list(set(activated_entries))
         # sort activated_entries by insertion_order
@@ -150,7 +239,7 @@ class ContextPreprocessor(Preprocessor):
         for i in activated_entries:
             reserved = 0
             if i.reserved_tokens > 0:
-                len_tokens = len(tokenizer.encode(i.text))
+                len_tokens = count_text_tokens(i.text)
                 if len_tokens < i.reserved_tokens:
                     budget -= len_tokens
                 else:
@@ -160,10 +249,9 @@ class ContextPreprocessor(Preprocessor):
                 else:
                     reserved = len_tokens
             
-            text = i.get_text(budget + reserved, self.token_budget)
-            ctxtext = text.splitlines(keepends=False)
-            trimmed_tokenized = tokenizer.encode(text)
-            budget -= len(trimmed_tokenized) - reserved
+            tokens = i.trim(budget + reserved, self.token_budget)
+            ctxtext = tokenizer.decode(tokens).splitlines(keepends=False)
+            budget -= len(tokens) - reserved
             ctxinsertion = i.insertion_position
 
             before = []
@@ -0,0 +1,252 @@
+from typing import List, Union
+import numpy as np
+import json
+
+from shimeji.memory import cosine_distances, cosine_similarity, decode_encoding
+from shimeji.ann import kmeans
+
+class Quantizer:
+    """Abstract class for quantizers which compress encodings into fixed-size codes.
+
+    Codes are rows of a uint8 matrix, so they can be stored as bytes and kept in a contiguous array.
+    Distances are computed from the codes directly.
+    """
+    def __init__(self, dim: int = None):
+        """Constructor for Quantizer.
+
+        :param dim: The number of dimensions of the encodings. If None, it is set by the first encoding or by training.
+        :type dim: int
+        """
+        self.dim = dim
+
+    @property
+    def is_trained(self) -> bool:
+        return True
+
+    def code_size(self) -> int:
+        """The number of bytes in a code.
+
+        :rtype: int
+        """
+        raise NotImplementedError('code_size method is required')
+
+    def train(self, vectors: np.array):
+        """Train the quantizer on a sample of encodings, if it needs training.
+
+        :param vectors: The encodings to train on, of shape (N, d).
+        :type vectors: np.array
+        """
+        self.dim = vectors.shape[1]
+
+    def encode(self, vectors: np.array) -> np.array:
+        """Compress encodings into codes.
+
+        :param vectors: The encodings, of shape (N, d).
+        :type vectors: np.array
+        :return: The codes, of shape (N, code_size).
+        :rtype: np.array
+        """
+        raise NotImplementedError('encode method is required')
+
+    def decode(self, codes: np.array) -> np.array:
+        """Reconstruct approximate encodings from codes.
+
+        :param codes: The codes, of shape (N, code_size).
+        :type codes: np.array
+        :return: The encodings, of shape (N, d).
+        :rtype: np.array
+        """
+        raise NotImplementedError('decode method is required')
+
+    def distances(self, query: np.array, codes: np.array, metric: str = 'distance', chunk_size: int = 1024) -> np.array:
+        """Score a query against every code, decoding at most chunk_size codes at a time.
+
+        :param query: The query encoding, of shape (d,).
+        :type query: np.array
+        :param codes: The codes, of shape (N, code_size).
+        :type codes: np.array
+        :param metric: Either 'distance' for cosine_distance or 'similarity' for cosine similarity.
+        :type metric: str
+        :return: The scores, of shape (N,).
+        :rtype: np.array
+        """
+        if metric not in ('distance', 'similarity'):
+            raise ValueError(f'Unknown metric: {metric}')
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), chunk_size):
+            chunk = self.decode(codes[start:start+chunk_size])
+            if metric == 'distance':
+                scores[start:start+len(chunk)] = cosine_distances(query, chunk)
+            else:
+                scores[start:start+len(chunk)] = cosine_similarity(query, chunk)
+        return scores
+
+    def is_code(self, buffer: bytes) -> bool:
+        """Check whether a stored encoding is a code from this quantizer rather than raw float32 bytes.
+
+        :param buffer: The stored encoding.
+        :type buffer: bytes
+        :rtype: bool
+        """
+        if self.dim is None:
+            raise ValueError(f'{self.__class__.__name__} needs dim to tell codes from raw encodings')
+        return len(buffer) == self.code_size() and len(buffer) != self.dim * 4
+
+    def encode_bytes(self, encoding: Union[str, bytes, list]) -> bytes:
+        """Compress a single encoding into the bytes of its code, for storing in a MemoryStoreProvider.
+
+        :param encoding: The encoding, either ASCII85 text, float32 bytes or a list of floats.
+        :type encoding: Union[str, bytes, list]
+        :rtype: bytes
+        """
+        if isinstance(encoding, (str, bytes, bytearray, memoryview)):
+            vector = decode_encoding(encoding)
+        else:
+            vector = np.asarray(encoding, dtype=np.float32)
+        return self.encode(vector[None, :]).tobytes()
+
+    def from_bytes(self, buffers: List[bytes]) -> np.array:
+        """Turn stored codes back into a code matrix.
+
+        :param buffers: The stored codes.
+        :type buffers: List[bytes]
+        :return: The codes, of shape (N, code_size).
+        :rtype: np.array
+        """
+        return np.frombuffer(b''.join(buffers), dtype=np.uint8).reshape(len(buffers), self.code_size())
+
+class Float16Quantizer(Quantizer):
+    """A Quantizer which stores encodings as float16, halving their size."""
+    def code_size(self) -> int:
+        return self.dim * 2
+
+    def encode(self, vectors: np.array) -> np.array:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        return np.ascontiguousarray(vectors.astype(np.float16)).view(np.uint8)
+
+    def decode(self, codes: np.array) -> np.array:
+        return np.ascontiguousarray(codes).view(np.float16).astype(np.float32)
+
+class Int8Quantizer(Quantizer):
+    """A Quantizer which stores encodings as int8 with a float32 scale per encoding, about a quarter of their size."""
+    def code_size(self) -> int:
+        return self.dim + 4
+
+    def encode(self, vectors: np.array) -> np.array:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        scales = np.max(np.abs(vectors), axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.empty((len(vectors), self.dim + 4), dtype=np.uint8)
+        codes[:, :4] = scales.astype(np.float32).view(np.uint8).reshape(-1, 4)
+        codes[:, 4:] = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8).view(np.uint8)
+        return codes
+
+    def decode(self, codes: np.array) -> np.array:
+        scales = np.ascontiguousarray(codes[:, :4]).view(np.float32)
+        return np.ascontiguousarray(codes[:, 4:]).view(np.int8).astype(np.float32) * scales
+
+class ProductQuantizer(Quantizer):
+    """A Quantizer which splits encodings into subspaces and stores the index of the nearest of 256 centroids for each.
+
+    Distances are computed with per-subspace lookup tables, without reconstructing the encodings. The quantizer must be
+    trained on a sample of encodings before use.
+    """
+    def __init__(self, dim: int = None, subspaces: int = 256, iterations: int = 20, seed: int = 0):
+        """Constructor for ProductQuantizer.
+
+        :param dim: The number of dimensions of the encodings, which must be divisible by subspaces.
+        :type dim: int
+        :param subspaces: The number of subspaces, which is also the number of bytes in a code.
+        :type subspaces: int
+        :param iterations: The number of k-means iterations used for training.
+        :type iterations: int
+        :param seed: The random seed used for training.
+        :type seed: int
+        """
+        super().__init__(dim)
+        self.subspaces = subspaces
+        self.iterations = iterations
+        self.seed = seed
+        self.codebooks = None
+
+    @property
+    def is_trained(self) -> bool:
+        return self.codebooks is not None
+
+    def code_size(self) -> int:
+        return self.subspaces
+
+    def train(self, vectors: np.array):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.shape[1] % self.subspaces != 0:
+            raise ValueError(f'{vectors.shape[1]} dimensions cannot be split into {self.subspaces} subspaces')
+        self.dim = vectors.shape[1]
+        subdim = self.dim // self.subspaces
+
+        self.codebooks = np.zeros((self.subspaces, 256, subdim), dtype=np.float32)
+        for j in range(self.subspaces):
+            centroids = kmeans(vectors[:, j*subdim:(j+1)*subdim], 256, iterations=self.iterations, seed=self.seed + j)
+            self.codebooks[j, :len(centroids)] = centroids
+
+    def encode(self, vectors: np.array) -> np.array:
+        if not self.is_trained:
+            raise ValueError('ProductQuantizer must be trained before encoding')
+        vectors = np.asarray(vectors, dtype=np.float32)
+        subdim = self.dim // self.subspaces
+        codes = np.empty((len(vectors), self.subspaces), dtype=np.uint8)
+        for j in range(self.subspaces):
+            sub = vectors[:, j*subdim:(j+1)*subdim]
+            centroids = self.codebooks[j]
+            distances = np.sum(sub * sub, axis=1)[:, None] - 2 * (sub @ centroids.T) + np.sum(centroids * centroids, axis=1)[None, :]
+            codes[:, j] = np.argmin(distances, axis=1)
+        return codes
+
+    def decode(self, codes: np.array) -> np.array:
+        return self.codebooks[np.arange(self.subspaces)[None, :], codes].reshape(len(codes), self.dim)
+
+    def distances(self, query: np.array, codes: np.array, metric: str = 'distance', chunk_size: int = 1024) -> np.array:
+        subdim = self.dim // self.subspaces
+        subqueries = np.asarray(query, dtype=np.float32).reshape(self.subspaces, 1, subdim)
+        if metric == 'distance':
+            tables = np.sum(np.sqrt((np.abs(self.codebooks - subqueries) / 1000.0) + 1e-6), axis=2)
+        elif metric == 'similarity':
+            tables = np.sum(self.codebooks * subqueries, axis=2)
+            norms = np.sum(self.codebooks * self.codebooks, axis=2)
+        else:
+            raise ValueError(f'Unknown metric: {metric}')
+
+        subspaces = np.arange(self.subspaces)[None, :]
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), chunk_size):
+            chunk = codes[start:start+chunk_size]
+            scores[start:start+len(chunk)] = np.sum(tables[subspaces, chunk], axis=1)
+            if metric == 'similarity':
+                lengths = np.sqrt(np.sum(norms[subspaces, chunk], axis=1)) * np.linalg.norm(query)
+                scores[start:start+len(chunk)] /= np.maximum(lengths, 1e-6)
+        return scores
+
+    def save(self, path: str):
+        """Save the trained codebooks to a .npz file.
+
+        :param path: The path to save to.
+        :type path: str
+        """
+        config = {'dim': self.dim, 'subspaces': self.subspaces, 'iterations': self.iterations, 'seed': self.seed}
+        np.savez(path, config=np.array(json.dumps(config)), codebooks=self.codebooks)
+
+    @classmethod
+    def load(cls, path: str) -> 'ProductQuantizer':
+        """Load codebooks saved with save().
+
+        :param path: The path to load from.
+        :type path: str
+        :rtype: ProductQuantizer
+        """
+        with np.load(path) as data:
+            quantizer = cls(**json.loads(str(data['config'])))
+            quantizer.codebooks = data['codebooks']
+        return quantizer
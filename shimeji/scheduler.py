@@ -0,0 +1,245 @@
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+import asyncio
+import heapq
+import itertools
+import time
+
+# priority classes of model requests, lower values are served first
+PRIORITY_RESPOND=0
+PRIORITY_SHOULD_RESPOND=1
+PRIORITY_HIDDEN=2
+PRIORITY_IMAGE_LABEL=3
+
+PRIORITY_NAMES = {
+    PRIORITY_RESPOND: 'respond',
+    PRIORITY_SHOULD_RESPOND: 'should_respond',
+    PRIORITY_HIDDEN: 'hidden',
+    PRIORITY_IMAGE_LABEL: 'image_label'
+}
+
+class PriorityLimiter:
+    """
+    A semaphore which hands free slots to the waiter with the highest priority, and in arrival order within a priority.
+    """
+
+    def __init__(self, limit: Optional[int] = None):
+        """
+        Initialize a PriorityLimiter.
+
+        :param limit: The number of slots. If None, every acquire succeeds at once.
+        :type limit: int
+        """
+        self.limit = limit
+        self.active = 0
+        self.waiters = []
+        self.max_queued = 0
+        self._order = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        return len(self.waiters)
+
+    async def acquire(self, priority: int):
+        """
+        Wait for a free slot.
+
+        :param priority: The priority class of the request, lower values are served first.
+        :type priority: int
+        """
+        if self.limit is None or (self.active < self.limit and not self.waiters):
+            self.active += 1
+            return
+
+        entry = (priority, next(self._order), asyncio.get_running_loop().create_future())
+        heapq.heappush(self.waiters, entry)
+        self.max_queued = max(self.max_queued, len(self.waiters))
+        try:
+            await entry[2]
+        except asyncio.CancelledError:
+            if entry[2].done() and not entry[2].cancelled():
+                # the slot was handed over just as the waiter was cancelled
+                self.release()
+            elif entry in self.waiters:
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+            raise
+
+    def release(self):
+        """
+        Free a slot, handing it to the next waiter if there is one.
+        """
+        while self.waiters:
+            future = heapq.heappop(self.waiters)[2]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+class TokenBucket:
+    """
+    A token bucket allowing rate requests per second on average, with bursts of up to burst requests.
+
+    Requests which find the bucket empty wait in a heap like PriorityLimiter's, and each token is handed to the waiter
+    with the highest priority as soon as it is added, so that a rate limited reply does not queue behind probes.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        """
+        Initialize a TokenBucket.
+
+        :param rate: The number of tokens added per second.
+        :type rate: float
+        :param burst: The largest number of tokens the bucket holds, defaults to max(rate, 1).
+        :type burst: float
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.waiters = []
+        self._order = itertools.count()
+        self._timer = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _grant(self):
+        # hand every whole token to the waiters in priority order, then wake up again when the next one is added
+        self._refill()
+        while self.waiters and self.tokens >= 1:
+            future = heapq.heappop(self.waiters)[2]
+            if not future.done():
+                self.tokens -= 1
+                future.set_result(None)
+        if self.waiters and self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later((1 - self.tokens) / self.rate, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._grant()
+
+    async def acquire(self, priority: int = 0):
+        """
+        Take a token, waiting until one is available.
+
+        :param priority: The priority class of the request, lower values are served first.
+        :type priority: int
+        """
+        self._refill()
+        if not self.waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+
+        entry = (priority, next(self._order), asyncio.get_running_loop().create_future())
+        heapq.heappush(self.waiters, entry)
+        self._grant()
+        try:
+            await entry[2]
+        except asyncio.CancelledError:
+            if entry[2].done() and not entry[2].cancelled():
+                # the token was handed over just as the waiter was cancelled
+                self.tokens += 1
+                self._grant()
+            elif entry in self.waiters:
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+            raise
+
+class RequestScheduler:
+    """
+    Schedules the requests a ModelProvider makes to its endpoints.
+
+    Each endpoint has its own concurrency limit and optionally a token bucket rate limit, and total_limit caps the
+    requests in flight across all endpoints, such as the passes a single model server can run at once. Whenever a
+    slot frees up, it goes to the waiting request with the highest priority class, so that replies are not starved by
+    embedding and classification traffic.
+    """
+
+    def __init__(self, limits: Dict[str, int] = None, default_limit: Optional[int] = None, total_limit: Optional[int] = None, rates: Dict[str, float] = None, bursts: Dict[str, float] = None):
+        """
+        Initialize a RequestScheduler.
+
+        :param limits: The number of concurrent requests allowed to each endpoint, such as {'generate': 4, 'hidden': 2}.
+        :type limits: Dict[str, int]
+        :param default_limit: The number of concurrent requests allowed to endpoints missing from limits. If None, they are unlimited.
+        :type default_limit: int
+        :param total_limit: The number of concurrent requests allowed across all endpoints. If None, it is unlimited.
+        :type total_limit: int
+        :param rates: The number of requests per second allowed to each endpoint. Endpoints missing from rates are not rate limited.
+        :type rates: Dict[str, float]
+        :param bursts: The burst size of each endpoint's rate limit, defaults to its rate.
+        :type bursts: Dict[str, float]
+        """
+        self.limits = limits or {}
+        self.default_limit = default_limit
+        self.total = PriorityLimiter(total_limit)
+        self.limiters = {}
+        bursts = bursts or {}
+        self.buckets = {endpoint: TokenBucket(rate, bursts.get(endpoint)) for endpoint, rate in (rates or {}).items()}
+        self.requests = {}
+        self.wait_time = {}
+
+    def _limiter(self, endpoint: str) -> PriorityLimiter:
+        limiter = self.limiters.get(endpoint)
+        if limiter is None:
+            limiter = self.limiters[endpoint] = PriorityLimiter(self.limits.get(endpoint, self.default_limit))
+        return limiter
+
+    @asynccontextmanager
+    async def slot(self, endpoint: str, priority: int):
+        """
+        Wait until a request to an endpoint may be made, and hold its slot until the context exits.
+
+        :param endpoint: The name of the endpoint, such as 'generate', 'hidden' or 'image_label'.
+        :type endpoint: str
+        :param priority: The priority class of the request, one of the PRIORITY_ constants.
+        :type priority: int
+        """
+        start = time.perf_counter()
+        # the rate token is taken before any slot, so that requests waiting for their rate limit hold no slot
+        # which a request to another endpoint could be waiting for
+        bucket = self.buckets.get(endpoint)
+        if bucket is not None:
+            await bucket.acquire(priority)
+
+        limiter = self._limiter(endpoint)
+        await limiter.acquire(priority)
+        try:
+            await self.total.acquire(priority)
+            try:
+                key = (endpoint, priority)
+                self.requests[key] = self.requests.get(key, 0) + 1
+                self.wait_time[key] = self.wait_time.get(key, 0.0) + time.perf_counter() - start
+                yield
+            finally:
+                self.total.release()
+        finally:
+            limiter.release()
+
+    def stats(self) -> dict:
+        """
+        The queue depth and wait time statistics of every endpoint.
+
+        :return: For each endpoint, the requests in flight, the requests queued now and at most, and per priority class the number of requests and their mean wait in seconds.
+        :rtype: dict
+        """
+        stats = {}
+        for endpoint, limiter in self.limiters.items():
+            priorities = {}
+            for (key_endpoint, priority), requests in self.requests.items():
+                if key_endpoint == endpoint:
+                    priorities[PRIORITY_NAMES.get(priority, priority)] = {
+                        'requests': requests,
+                        'mean_wait': self.wait_time[(endpoint, priority)] / requests
+                    }
+            stats[endpoint] = {
+                'active': limiter.active,
+                'queued': limiter.queued,
+                'max_queued': limiter.max_queued,
+                'priorities': priorities
+            }
+        stats['total'] = {'active': self.total.active, 'queued': self.total.queued, 'max_queued': self.total.max_queued}
+        return stats
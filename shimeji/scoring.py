@@ -0,0 +1,106 @@
+from typing import Dict, List
+import numpy as np
+
+from shimeji.memorystore_provider import Memory
+from shimeji.memory import score_memories
+
+# snowflakes count units of 10 microseconds
+SNOWFLAKES_PER_SECOND = 10**5
+
+class Scorer:
+    """Abstract class for retrieval scorers, which can be passed to memory_sort and MemoryIndex.search.
+
+    A scorer starts from the cosine scores of its metric, which the caller computes in whichever way suits its
+    storage, and adjusts them with the created_at and author_id of every candidate in a single vectorized pass.
+    """
+    metric = 'distance'
+    largest = False
+
+    def weight(self, scores: np.array, created_at: np.array, author_id: np.array, now: Memory) -> np.array:
+        """Adjust the scores of the candidates.
+
+        :param scores: The scores of the candidates under the scorer's metric.
+        :type scores: np.array
+        :param created_at: The created_at of every candidate.
+        :type created_at: np.array
+        :param author_id: The author_id of every candidate.
+        :type author_id: np.array
+        :param now: The current memory.
+        :type now: Memory
+        :return: The final scores, where higher is better if largest is True.
+        :rtype: np.array
+        """
+        return scores
+
+    def __call__(self, now: Memory, then: List[Memory]) -> np.array:
+        """Score every memory against the current memory.
+
+        :param now: The current memory.
+        :type now: Memory
+        :param then: The memories to score.
+        :type then: List[Memory]
+        :rtype: np.array
+        """
+        created_at = np.fromiter((memory.created_at for memory in then), dtype=np.int64, count=len(then))
+        author_id = np.fromiter((memory.author_id for memory in then), dtype=np.int64, count=len(then))
+        return self.weight(score_memories(now, then, self.metric), created_at, author_id, now)
+
+class DistanceScorer(Scorer):
+    """A Scorer which ranks by a cosine metric alone, like memory_sort without a scorer."""
+    def __init__(self, metric: str = 'distance'):
+        """Constructor for DistanceScorer.
+
+        :param metric: Either 'distance' for cosine_distance or 'similarity' for cosine similarity.
+        :type metric: str
+        """
+        if metric not in ('distance', 'similarity'):
+            raise ValueError(f'Unknown metric: {metric}')
+        self.metric = metric
+        self.largest = metric == 'similarity'
+
+class WeightedScorer(Scorer):
+    """A Scorer which blends cosine similarity with an exponential decay on age and per-author weights.
+
+    The score of a memory is author_weight * ((1 + similarity) / 2 + recency_weight * 0.5 ** (age / half_life)),
+    where the age is measured from the current memory. Higher scores are better.
+    """
+    metric = 'similarity'
+    largest = True
+
+    def __init__(self, half_life: float = 86400.0, recency_weight: float = 0.5, author_weights: Dict[int, float] = None, default_author_weight: float = 1.0):
+        """Constructor for WeightedScorer.
+
+        :param half_life: The age in seconds at which the recency bonus is halved. If None, age is ignored.
+        :type half_life: float
+        :param recency_weight: The recency bonus of a memory created at the same time as the current memory.
+        :type recency_weight: float
+        :param author_weights: Multipliers for the scores of memories by each author_id.
+        :type author_weights: Dict[int, float]
+        :param default_author_weight: The multiplier for authors missing from author_weights.
+        :type default_author_weight: float
+        """
+        self.half_life = half_life
+        self.recency_weight = recency_weight
+        self.default_author_weight = default_author_weight
+
+        author_weights = author_weights or {}
+        # sorted keys so that weights are looked up with searchsorted instead of a dictionary per memory
+        order = np.argsort(np.array(list(author_weights.keys()), dtype=np.int64))
+        self.author_ids = np.array(list(author_weights.keys()), dtype=np.int64)[order]
+        self.author_weights = np.array(list(author_weights.values()), dtype=np.float32)[order]
+
+    def _author_weights(self, author_id: np.array) -> np.array:
+        weights = np.full(len(author_id), self.default_author_weight, dtype=np.float32)
+        if len(self.author_ids) == 0:
+            return weights
+        idx = np.minimum(np.searchsorted(self.author_ids, author_id), len(self.author_ids) - 1)
+        known = self.author_ids[idx] == author_id
+        weights[known] = self.author_weights[idx[known]]
+        return weights
+
+    def weight(self, scores: np.array, created_at: np.array, author_id: np.array, now: Memory) -> np.array:
+        scores = (1.0 + np.asarray(scores, dtype=np.float32)) / 2.0
+        if self.half_life is not None and self.recency_weight:
+            age = np.maximum(now.created_at - np.asarray(created_at, dtype=np.int64), 0) / (self.half_life * SNOWFLAKES_PER_SECOND)
+            scores = scores + self.recency_weight * np.exp2(-age).astype(np.float32)
+        return scores * self._author_weights(np.asarray(author_id, dtype=np.int64))
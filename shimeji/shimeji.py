@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from shimeji.model_provider import ModelProvider
 from shimeji.memorystore_provider import MemoryStoreProvider
@@ -10,6 +11,10 @@ class ChatBot:
         :type name: str
         :param model_provider: The model provider to use.
         :type model_provider: ModelProvider
+        :param fused: Whether conditional_response decides and responds in a single generation with fused_response_async, defaults to False. This only saves model time if the model provider streams, see ModelProvider.fused_response_async.
+        :type fused: bool
+        :param speculative: Whether conditional_response_async starts generating the response while should_respond_async is still deciding, defaults to False.
+        :type speculative: bool
         """
 
         self.name = name
@@ -17,11 +22,19 @@ class ChatBot:
 
         self.preprocessors = kwargs.get('preprocessors', [])
         self.postprocessors = kwargs.get('postprocessors', [])
+        self.fused = kwargs.get('fused', False)
+        self.speculative = kwargs.get('speculative', False)
+
+        # responses started speculatively, those thrown away because the chatbot should not respond, and those
+        # cancelled before they finished
+        self.speculations = 0
+        self.speculations_wasted = 0
+        self.speculations_cancelled = 0
 
         self.conversation_chain = []
 
     def should_respond(self, text, push_chain):
-        """Determine if the chatbot should respond to the given text or conversation chain.
+        """Determine if the chatbot should respond to the given text or conversation chain. This runs should_respond_async on the model provider's background loop.
 
         :param text: The response text.
         :type text: str
@@ -31,16 +44,7 @@ class ChatBot:
         :rtype: bool
         """
 
-        if push_chain:
-            self.conversation_chain.append(text)
-        if self.conversation_chain:
-            text = '\n'.join(self.conversation_chain)
-        
-        if self.preprocessors:
-            for preprocessor in self.preprocessors:
-                text = preprocessor(text, is_respond=False, name=self.name)
-        
-        return self.model_provider.should_respond(text, self.name)
+        return self.model_provider.run_sync(self.should_respond_async(text, push_chain))
 
     async def should_respond_async(self, text, push_chain):
         """Determine if the chatbot should respond to the given text or conversation chain asynchronously.
@@ -60,12 +64,25 @@ class ChatBot:
         
         if self.preprocessors:
             for preprocessor in self.preprocessors:
-                text = preprocessor(text, is_respond=False, name=self.name)
+                preprocessor.prefetch(name=self.name)
+            for preprocessor in self.preprocessors:
+                text = await preprocessor.call_async(text, is_respond=False, name=self.name)
         
         return await self.model_provider.should_respond_async(text, self.name)
 
     def respond(self, text, push_chain):
-        """Respond to the given text or conversation chain.
+        """Respond to the given text or conversation chain. This runs respond_async on the model provider's background loop.
+
+        :param text: The response text.
+        :type text: str
+        :param push_chain: Whether to push the response to the conversation chain.
+        :type push_chain: bool
+        """
+
+        return self.model_provider.run_sync(self.respond_async(text, push_chain))
+    
+    async def respond_async(self, text, push_chain):
+        """Respond to the given text or conversation chain asynchronously.
 
         :param text: The response text.
         :type text: str
@@ -80,9 +97,9 @@ class ChatBot:
 
         if self.preprocessors:
             for preprocessor in self.preprocessors:
-                text = preprocessor.__call__(text, is_respond=True, name=self.name)
+                text = await preprocessor.call_async(text, is_respond=True, name=self.name)
         
-        response = self.model_provider.response(text)
+        response = await self.model_provider.response_async(text)
 
         if self.postprocessors:
             for postprocessor in self.postprocessors:
@@ -92,14 +109,20 @@ class ChatBot:
             self.conversation_chain.append(f'{self.name}:{response}')
         
         return response
-    
-    async def respond_async(self, text, push_chain):
-        """Respond to the given text or conversation chain asynchronously.
+
+    async def respond_stream(self, text, push_chain):
+        """Respond to the given text or conversation chain, yielding the response as it is generated.
+
+        Postprocessors are applied to the text generated so far, and only the part of the result which later text
+        cannot change is yielded, using each postprocessor's stable_prefix. Postprocessors without one hold the
+        response back until it is complete. The yielded pieces join up to the same text respond_async returns.
 
         :param text: The response text.
         :type text: str
         :param push_chain: Whether to push the response to the conversation chain.
         :type push_chain: bool
+        :return: An async iterator over the pieces of the response.
+        :rtype: AsyncIterator[str]
         """
 
         if push_chain:
@@ -109,21 +132,118 @@ class ChatBot:
 
         if self.preprocessors:
             for preprocessor in self.preprocessors:
-                text = preprocessor.__call__(text, is_respond=True, name=self.name)
-        
-        response = await self.model_provider.response_async(text)
+                text = await preprocessor.call_async(text, is_respond=True, name=self.name)
+
+        response = ''
+        sent = ''
+        async for output in self.model_provider.response_stream_async(text):
+            response += output
+            stable = response
+            for postprocessor in self.postprocessors:
+                stable_prefix = getattr(postprocessor, 'stable_prefix', None)
+                stable = stable_prefix(stable) if stable_prefix is not None else ''
+            if len(stable) > len(sent) and stable.startswith(sent):
+                yield stable[len(sent):]
+                sent = stable
 
         if self.postprocessors:
             for postprocessor in self.postprocessors:
                 response = postprocessor.__call__(response)
-        
+
+        if response.startswith(sent) and len(response) > len(sent):
+            yield response[len(sent):]
+
         if push_chain:
             self.conversation_chain.append(f'{self.name}:{response}')
-        
+
+    async def fused_response_async(self, text, push_chain=True):
+        """Respond to the given text or conversation chain if the chatbot should respond, using one generation for both.
+
+        The context is preprocessed as for respond_async, so that it includes the long-term memories, and the
+        '{name}:' a ContextPreprocessor ends it with is left off for the model to decide. The model continues the
+        conversation and the chatbot responds if the next line starts with its name, see
+        ModelProvider.fused_response_async. Otherwise generation is stopped after the first few tokens if the model
+        provider streams.
+
+        :param text: The response text.
+        :type text: str
+        :param push_chain: Whether to push the text and the response to the conversation chain.
+        :type push_chain: bool
+        :return: The response, or None if the chatbot should not respond.
+        :rtype: Optional[str]
+        """
+
+        if push_chain:
+            self.conversation_chain.append(text)
+        if self.conversation_chain:
+            text = '\n'.join(self.conversation_chain)
+
+        if self.preprocessors:
+            for preprocessor in self.preprocessors:
+                text = await preprocessor.call_async(text, is_respond=True, name=self.name)
+            if text.endswith(f'\n{self.name}:'):
+                text = text[:-len(self.name) - 1]
+
+        response = await self.model_provider.fused_response_async(text, self.name)
+        if response is None:
+            return None
+
+        if self.postprocessors:
+            for postprocessor in self.postprocessors:
+                response = postprocessor.__call__(response)
+
+        if push_chain:
+            self.conversation_chain.append(f'{self.name}:{response}')
+
         return response
 
+    async def _speculative_response_async(self, text, push_chain):
+        if push_chain:
+            self.conversation_chain.append(text)
+
+        self.speculations += 1
+        should_respond = asyncio.ensure_future(self.should_respond_async(text, False))
+        response = asyncio.ensure_future(self.respond_async(text, False))
+        try:
+            if await should_respond:
+                return await response
+        finally:
+            if not response.done():
+                response.cancel()
+                self.speculations_cancelled += 1
+            should_respond.cancel()
+
+        self.speculations_wasted += 1
+        # wait for the cancellation to reach the HTTP request, and retrieve the response's exception if it failed
+        await asyncio.gather(response, return_exceptions=True)
+        return None
+
+    async def conditional_response_async(self, text, push_chain=True):
+        """Respond to the given text or conversation chain if the chatbot should respond asynchronously.
+
+        If the chatbot is speculative, the response is generated while should_respond_async is deciding, and it is
+        cancelled, along with its request, if the chatbot should not respond. The response then costs one model call
+        of latency instead of two, at the price of the wasted generations counted in speculations_wasted.
+
+        :param text: The response text.
+        :type text: str
+        :param push_chain: Whether to push the text to the conversation chain.
+        :type push_chain: bool
+        :return: The response, or None if the chatbot should not respond.
+        :rtype: Optional[str]
+        """
+
+        if self.fused:
+            return await self.fused_response_async(text, push_chain)
+        if self.speculative:
+            return await self._speculative_response_async(text, push_chain)
+        if await self.should_respond_async(text, push_chain):
+            return await self.respond_async(text, False)
+        else:
+            return None
+
     def conditional_response(self, text, push_chain=True):
-        """Respond to the given text or conversation chain if the chatbot should respond.
+        """Respond to the given text or conversation chain if the chatbot should respond. This runs conditional_response_async on the model provider's background loop.
 
         :param text: The response text.
         :type text: str
@@ -133,7 +253,4 @@ class ChatBot:
         :rtype: bool
         """
 
-        if self.should_respond(text, push_chain):
-            return self.respond(text, False)
-        else:
-            return None
+        return self.model_provider.run_sync(self.conditional_response_async(text, push_chain))
@@ -12,7 +12,7 @@ class Base:
     def __tablename__(cls) -> str:
         return cls.__name__.lower()
 
-from sqlalchemy import Column, String, Table, BigInteger, Integer, func
+from sqlalchemy import Column, String, Table, BigInteger, Index, Integer, LargeBinary, func
 
 # models
 class MemorySQL(Base):
@@ -26,14 +26,23 @@ class MemorySQL(Base):
     author = Column(String, unique=False)
     text = Column(String, unique=False)
     encoding_model = Column(String, unique=False)
-    encoding = Column(String)
+    encoding = Column(String, nullable=True)
+    encoding_bin = Column(LargeBinary, nullable=True)
+    text_hash = Column(String(64), index=True, nullable=True)
+    scope_id = Column(BigInteger, nullable=True)
+
+    __table_args__ = (
+        Index('ix_memories_scope_id_created_at', 'scope_id', 'created_at'),
+        Index('ix_memories_scope_id_text_hash', 'scope_id', 'text_hash'),
+    )
 
 # crud
-from typing import Any, Generic, Optional, Type, TypeVar
+from typing import Any, AsyncIterator, Generic, Optional, Type, TypeVar, Union
 
 from pydantic import BaseModel
-from sqlalchemy import select
+from sqlalchemy import insert, select
 from sqlalchemy.ext.asyncio import AsyncSession
+from shimeji.dedup import normalized_text_hash
 
 ModelType = TypeVar("ModelType", bound=Base)
 CreateSchemaType = TypeVar("CreateSchemaType", bound=BaseModel)
@@ -47,28 +56,55 @@ class CrudBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
         return (await session.execute(select(self.model).where(self.model.id == id))).scalars().first()
 
 class CrudMemory(CrudBase[MemorySQL, MemorySQL, MemorySQL]):
-    async def get_all(self, session: AsyncSession) -> List[MemorySQL]:
-        return (await session.execute(select(self.model))).scalars().all()
+    def _scoped(self, query, scope_id: Optional[int]):
+        # None reads every scope
+        return query if scope_id is None else query.where(self.model.scope_id == scope_id)
+
+    async def get_all(self, session: AsyncSession, scope_id: Optional[int] = None) -> List[MemorySQL]:
+        return (await session.execute(self._scoped(select(self.model), scope_id))).scalars().all()
     
-    async def get_after_id(self, session: AsyncSession, created_at: int) -> List[MemorySQL]:
-        return (await session.execute(select(self.model).where(self.model.created_at > created_at))).scalars().all()
+    async def get_after_id(self, session: AsyncSession, created_at: int, scope_id: Optional[int] = None) -> List[MemorySQL]:
+        query = self._scoped(select(self.model).where(self.model.created_at > created_at), scope_id)
+        return (await session.execute(query.order_by(self.model.created_at, self.model.author_id))).scalars().all()
     
-    async def create(self, session: AsyncSession, created_at: int, author_id: int, author: str, text:str, encoding_model: str, encoding: str) -> MemorySQL:
-        db_obj = MemorySQL(
-            created_at=created_at,
-            author_id=author_id,
-            author=author,
-            text=text,
-            encoding_model=encoding_model,
-            encoding=encoding
-        )
+    async def stream_after_id(self, session: AsyncSession, created_at: int, batch_size: int = 1000, author_id: Optional[int] = None, scope_id: Optional[int] = None) -> AsyncIterator[List[MemorySQL]]:
+        query = self._scoped(select(self.model).where(self.model.created_at > created_at), scope_id)
+        if author_id is not None:
+            query = query.where(self.model.author_id == author_id)
+        query = query.order_by(self.model.created_at, self.model.author_id).execution_options(yield_per=batch_size)
+        result = await session.stream(query)
+        async for batch in result.scalars().partitions(batch_size):
+            yield batch
+
+    def _row(self, created_at: int, author_id: int, author: str, text: str, encoding_model: str, encoding: Union[str, bytes], scope_id: Optional[int] = None) -> dict:
+        return {
+            'created_at': created_at,
+            'author_id': author_id,
+            'scope_id': scope_id,
+            'author': author,
+            'text': text,
+            'text_hash': normalized_text_hash(text),
+            'encoding_model': encoding_model,
+            'encoding': encoding if isinstance(encoding, str) else None,
+            'encoding_bin': None if isinstance(encoding, str) else encoding
+        }
+
+    async def create(self, session: AsyncSession, created_at: int, author_id: int, author: str, text:str, encoding_model: str, encoding: Union[str, bytes], scope_id: Optional[int] = None) -> MemorySQL:
+        db_obj = MemorySQL(**self._row(created_at, author_id, author, text, encoding_model, encoding, scope_id))
 
         session.add(db_obj)
         await session.commit()
 
         return db_obj
+
+    async def create_many(self, session: AsyncSession, memories: List[dict], chunk_size: int = 1000) -> None:
+        # multi-row INSERTs, chunked to stay under the database's limit on bound parameters
+        rows = [self._row(**memory) for memory in memories]
+        for start in range(0, len(rows), chunk_size):
+            await session.execute(insert(self.model).values(rows[start:start+chunk_size]))
+        await session.commit()
     
-    async def update(self, session: AsyncSession, created_at: str, author_id: int, author: str, text:str, encoding_model: str, encoding: str) -> MemorySQL:
+    async def update(self, session: AsyncSession, created_at: str, author_id: int, author: str, text:str, encoding_model: str, encoding: Union[str, bytes]) -> MemorySQL:
         db_obj = (await session.execute(select(self.model).where(self.model.created_at == created_at))).scalars().first()
         
         if db_obj is None:
@@ -77,15 +113,17 @@ class CrudMemory(CrudBase[MemorySQL, MemorySQL, MemorySQL]):
         db_obj.author_id = author_id
         db_obj.author = author
         db_obj.text = text
+        db_obj.text_hash = normalized_text_hash(text)
         db_obj.encoding_model = encoding_model
-        db_obj.encoding = encoding
+        db_obj.encoding = encoding if isinstance(encoding, str) else None
+        db_obj.encoding_bin = None if isinstance(encoding, str) else encoding
 
         await session.commit()
 
         return db_obj
     
-    async def delete(self, session: AsyncSession, author_id: int) -> None:
-        db_obj = (await session.execute(select(self.model).where(self.model.author_id == author_id))).scalars().first()
+    async def delete(self, session: AsyncSession, created_at: int, author_id: int) -> None:
+        db_obj = (await session.execute(select(self.model).where(self.model.created_at == created_at, self.model.author_id == author_id))).scalars().first()
         
         if db_obj is None:
             return None
@@ -95,7 +133,22 @@ class CrudMemory(CrudBase[MemorySQL, MemorySQL, MemorySQL]):
 
         return None
     
-    async def count(self, session: AsyncSession) -> int:
-        return (await session.execute(select(func.count(self.model.created_at)))).scalars().first()
+    async def get_by_text_hash(self, session: AsyncSession, text_hash: str, scope_id: Optional[int] = None) -> Optional[MemorySQL]:
+        query = self._scoped(select(self.model).where(self.model.text_hash == text_hash), scope_id)
+        return (await session.execute(query.limit(1))).scalars().first()
+
+    async def get_existing_text_hashes(self, session: AsyncSession, text_hashes: List[str], scope_id: Optional[int] = None) -> set:
+        query = self._scoped(select(self.model.text_hash).where(self.model.text_hash.in_(text_hashes)), scope_id)
+        return set((await session.execute(query)).scalars().all())
+
+    async def get_nearest(self, session: AsyncSession, distance_function: str, encoding: bytes, top_k: int, created_before: Optional[int] = None, scope_id: Optional[int] = None) -> List[MemorySQL]:
+        distance = getattr(func, distance_function)(func.coalesce(self.model.encoding_bin, self.model.encoding), encoding)
+        query = self._scoped(select(self.model), scope_id)
+        if created_before is not None:
+            query = query.where(self.model.created_at < created_before)
+        return (await session.execute(query.order_by(distance, self.model.created_at).limit(top_k))).scalars().all()
+
+    async def count(self, session: AsyncSession, scope_id: Optional[int] = None) -> int:
+        return (await session.execute(self._scoped(select(func.count(self.model.created_at)), scope_id))).scalars().first()
 
 memory = CrudMemory(MemorySQL)
\ No newline at end of file
@@ -1,8 +1,24 @@
 import re
+from functools import lru_cache
 from transformers import AutoTokenizer
 
 tokenizer = AutoTokenizer.from_pretrained('gpt2')
 
+def count_tokens(text):
+    return len(tokenizer.encode(text))
+
+# the same lines, such as retrieved memories and the conversation so far, come back turn after turn, so their token
+# counts are cached. Whole contexts are not, as they are new on every turn and would only fill the cache
+@lru_cache(maxsize=4096)
+def count_line_tokens(line):
+    return count_tokens(line)
+
+def count_text_tokens(text):
+    # the tokenizer never merges a newline with the text around it, so a text is counted one cached line at a time.
+    # Only runs of blank lines, which it may merge into fewer tokens, are overcounted
+    lines = text.split('\n')
+    return sum(count_line_tokens(line) for line in lines) + len(lines) - 1
+
 TRIM_DIR_TOP=0
 TRIM_DIR_BOTTOM=1
 TRIM_DIR_NONE=2
@@ -0,0 +1,53 @@
+import asyncio
+import time
+from aiohttp import web
+from mock_server import HOST, serve
+from shimeji.model_provider import Sukima_ModelProvider, ModelGenRequest, ModelGenArgs, ModelSampleArgs
+
+PORT = 8765
+
+# the mock model server runs one forward pass at a time, like a single GPU,
+# and a pass costs a fixed overhead plus a little per prompt in the batch
+PASS_OVERHEAD = 0.02
+PASS_PER_PROMPT = 0.0005
+
+async def hidden(request):
+    js = await request.json()
+    prompts = js['prompt'] if isinstance(js['prompt'], list) else [js['prompt']]
+    async with request.app['gpu']:
+        await asyncio.sleep(PASS_OVERHEAD + PASS_PER_PROMPT * len(prompts))
+    request.app['stats']['requests'] += 1
+    states = [[float(len(prompt)), float(sum(map(ord, prompt)) % 97)] for prompt in prompts]
+    return web.json_response({str(layer): states for layer in js['layers']})
+
+async def run(model_provider, texts):
+    start = time.perf_counter()
+    results = await asyncio.gather(*[model_provider.hidden_async('mock', text, -1) for text in texts])
+    return results, time.perf_counter() - start
+
+async def main():
+    app = serve(PORT, {'/api/v1/models/hidden': hidden}, gpu=asyncio.Lock, stats=lambda: {'requests': 0})
+
+    model_args = ModelGenRequest(model='mock', prompt='', sample_args=ModelSampleArgs(), gen_args=ModelGenArgs(max_length=10))
+    texts = [f'user{i % 50}: message number {i}' for i in range(256)]
+
+    single = Sukima_ModelProvider(f'http://{HOST}:{PORT}', username='username', password='password', args=model_args)
+    app['stats']['requests'] = 0
+    single_results, single_time = await run(single, texts)
+    single_requests = app['stats']['requests']
+
+    batched = Sukima_ModelProvider(f'http://{HOST}:{PORT}', username='username', password='password', args=model_args, batch_hidden=True, batch_size=32, batch_delay=0.005)
+    app['stats']['requests'] = 0
+    batched_results, batched_time = await run(batched, texts)
+    batched_requests = app['stats']['requests']
+    await single.aclose()
+    await batched.aclose()
+
+    assert batched_results == single_results, 'batched results differ'
+    print(f'unbatched: {len(texts) / single_time:8.1f} texts/s, {single_requests} requests')
+    print(f'batched:   {len(texts) / batched_time:8.1f} texts/s, {batched_requests} requests')
+    print(f'speedup:   {single_time / batched_time:.1f}x')
+    assert batched_time < single_time, 'batching did not improve throughput'
+
+if __name__ == '__main__':
+    asyncio.run(main())
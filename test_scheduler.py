@@ -0,0 +1,89 @@
+import asyncio
+import time
+from aiohttp import web
+from mock_server import HOST, serve
+from shimeji.model_provider import Sukima_ModelProvider, ModelGenRequest, ModelGenArgs, ModelSampleArgs
+
+PORT = 8767
+
+# the mock model server runs one forward pass at a time, like a single GPU, and serves passes in arrival order
+PASS_TIME = 0.01
+
+async def forward(request):
+    async with request.app['gpu']:
+        await asyncio.sleep(PASS_TIME)
+
+async def hidden(request):
+    js = await request.json()
+    await forward(request)
+    return web.json_response({str(layer): [[float(len(js['prompt']))]] for layer in js['layers']})
+
+async def generate(request):
+    js = await request.json()
+    await forward(request)
+    return web.json_response({'output': js['prompt'] + ' hello'})
+
+async def run(model_provider):
+    # a burst of embedding traffic is already queued when a user-facing reply is requested
+    hidden = [asyncio.ensure_future(model_provider.hidden_async('mock', f'text {i}', -1)) for i in range(50)]
+    await asyncio.sleep(PASS_TIME)
+    start = time.perf_counter()
+    await model_provider.response_async('User: hi\nBot:')
+    latency = time.perf_counter() - start
+    await asyncio.gather(*hidden)
+    return latency
+
+async def main():
+    serve(PORT, {'/api/v1/models/hidden': hidden, '/api/v1/models/generate': generate}, gpu=asyncio.Lock)
+
+    model_args = ModelGenRequest(model='mock', prompt='', sample_args=ModelSampleArgs(), gen_args=ModelGenArgs(max_length=10))
+
+    unlimited = Sukima_ModelProvider(f'http://{HOST}:{PORT}', username='username', password='password', args=model_args)
+    unlimited_latency = await run(unlimited)
+
+    scheduled = Sukima_ModelProvider(f'http://{HOST}:{PORT}', username='username', password='password', args=model_args, total_concurrency=1)
+    scheduled_latency = await run(scheduled)
+
+    print(f'unscheduled: reply after {unlimited_latency * 1000:6.1f} ms')
+    print(f'scheduled:   reply after {scheduled_latency * 1000:6.1f} ms')
+    for endpoint, stats in scheduled.scheduler.stats().items():
+        print(f'{endpoint}: {stats}')
+    assert scheduled_latency < unlimited_latency / 2, 'the reply was not served ahead of the embeddings'
+
+    # 20 requests pass at once with the burst, the other 20 take a second at 20 per second
+    limited = Sukima_ModelProvider(f'http://{HOST}:{PORT}', username='username', password='password', args=model_args, rate_limits={'hidden': 20.0})
+    start = time.perf_counter()
+    await asyncio.gather(*[limited.hidden_async('mock', f'text {i}', -1) for i in range(40)])
+    elapsed = time.perf_counter() - start
+    print(f'rate limited: 40 requests at 20/s took {elapsed:.2f} s')
+    assert elapsed > 0.9, 'the rate limit was not applied'
+
+    # rate limited embeddings must not hold the only slot while they wait for their rate token
+    throttled = Sukima_ModelProvider(f'http://{HOST}:{PORT}', username='username', password='password', args=model_args, total_concurrency=1, rate_limits={'hidden': 1.0})
+    embeddings = [asyncio.ensure_future(throttled.hidden_async('mock', f'text {i}', -1)) for i in range(3)]
+    await asyncio.sleep(PASS_TIME * 3)
+    start = time.perf_counter()
+    await throttled.response_async('User: hi\nBot:')
+    throttled_latency = time.perf_counter() - start
+    print(f'throttled:   reply after {throttled_latency * 1000:6.1f} ms while embeddings wait for their rate limit')
+    assert throttled_latency < 0.2, 'the reply waited behind rate limited embeddings'
+    for task in embeddings:
+        task.cancel()
+    await asyncio.gather(*embeddings, return_exceptions=True)
+
+    # once the burst is spent, rate tokens go to the reply before the probes queued ahead of it
+    probed = Sukima_ModelProvider(f'http://{HOST}:{PORT}', username='username', password='password', args=model_args, rate_limits={'generate': 10.0})
+    probes = [asyncio.ensure_future(probed.should_respond_async('User: hi\nBot:', 'Bot')) for i in range(20)]
+    await asyncio.sleep(PASS_TIME)
+    start = time.perf_counter()
+    await probed.response_async('User: hi\nBot:')
+    probed_latency = time.perf_counter() - start
+    print(f'probed:      reply after {probed_latency * 1000:6.1f} ms behind 10 probes waiting for their rate limit')
+    assert probed_latency < 0.3, 'the reply waited behind rate limited probes'
+    await asyncio.gather(*probes)
+
+    for model_provider in (unlimited, scheduled, limited, throttled, probed):
+        await model_provider.aclose()
+
+if __name__ == '__main__':
+    asyncio.run(main())
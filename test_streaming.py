@@ -0,0 +1,60 @@
+import asyncio
+import json
+import time
+from aiohttp import web
+from mock_server import HOST, serve
+from shimeji import ChatBot
+from shimeji.model_provider import Sukima_ModelProvider, ModelGenRequest, ModelGenArgs, ModelSampleArgs
+from shimeji.postprocessor import NewlinePrunerPostprocessor
+
+PORT = 8766
+
+# the mock model server generates one token at a time, like a real model
+TOKEN_TIME = 0.02
+TOKENS = [' Hello', ' there', ',', ' how', ' are', ' you', ' today', '?', '\n']
+
+async def generate(request):
+    js = await request.json()
+    if not js.get('stream'):
+        await asyncio.sleep(TOKEN_TIME * len(TOKENS))
+        return web.json_response({'output': js['prompt'] + ''.join(TOKENS)})
+
+    resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+    await resp.prepare(request)
+    for piece in TOKENS:
+        await asyncio.sleep(TOKEN_TIME)
+        await resp.write(f'data: {json.dumps({"output": piece})}\n\n'.encode('utf-8'))
+    await resp.write(b'data: [DONE]\n\n')
+    await resp.write_eof()
+    return resp
+
+async def main():
+    serve(PORT, {'/api/v1/models/generate': generate})
+
+    model_args = ModelGenRequest(model='mock', prompt='', sample_args=ModelSampleArgs(), gen_args=ModelGenArgs(max_length=10))
+    model_provider = Sukima_ModelProvider(f'http://{HOST}:{PORT}', username='username', password='password', args=model_args)
+    chatbot = ChatBot(name='Bot', model_provider=model_provider, postprocessors=[NewlinePrunerPostprocessor()])
+
+    start = time.perf_counter()
+    response = await chatbot.respond_async('User: hi', push_chain=False)
+    full_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    first_time = None
+    pieces = []
+    async for piece in chatbot.respond_stream('User: hi', push_chain=True):
+        if first_time is None:
+            first_time = time.perf_counter() - start
+        pieces.append(piece)
+    stream_time = time.perf_counter() - start
+
+    assert ''.join(pieces) == response, 'streamed response differs'
+    assert chatbot.conversation_chain[-1] == f'Bot:{response}', 'streamed response was not pushed'
+    print(f'blocking:  first text after {full_time * 1000:6.1f} ms')
+    print(f'streaming: first text after {first_time * 1000:6.1f} ms, done after {stream_time * 1000:6.1f} ms in {len(pieces)} pieces')
+    assert first_time < full_time / 2, 'streaming did not improve time to first text'
+
+    await model_provider.aclose()
+
+if __name__ == '__main__':
+    asyncio.run(main())